@@ -0,0 +1,191 @@
+"""
+Нагрузочное сравнение синхронного и асинхронного режима БД (DB_ASYNC=0/1).
+
+Готовит временную SQLite с каталогом тестов, учреждением и пачкой ключей,
+затем для каждого режима поднимает uvicorn и гоняет параллельные сценарии
+«start-test → submit-answers → /stats/summary». Выводит JSON с req/s и
+перцентилями задержек по каждому режиму.
+
+Запускать из каталога, где лежит пакет SPTOVZ:
+
+    python -m SPTOVZ.benchmarks.bench_async_db --flows 300 --concurrency 32
+"""
+from __future__ import annotations
+import argparse
+import asyncio
+import json
+import os
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Dict, List
+from uuid import uuid4
+
+import httpx
+
+MODES = {"sync": "0", "async": "1"}
+
+
+def _seed(db_url: str, keys: int) -> tuple[str, List[str]]:
+    """Каталог, учреждение с пользователем и keys ключей. Возвращает (token, codes)."""
+    # DATABASE_URL читается при импорте SPTOVZ.database — выставляем до импорта
+    os.environ["DATABASE_URL"] = db_url
+    from SPTOVZ import models
+    from SPTOVZ.database import Base, SessionLocal, engine
+    from SPTOVZ.utils.key_codes import issue_keys
+    from SPTOVZ.utils.migrations import upgrade_schema
+    from SPTOVZ.utils.test_loader import import_all
+
+    Base.metadata.create_all(bind=engine)
+    upgrade_schema(engine)
+    with SessionLocal() as db:
+        import_all(db)
+        institution = models.Institution(id=str(uuid4()), name="Бенчмарк", education_type="school")
+        user = models.User(
+            id=str(uuid4()), email=f"bench-{uuid4().hex[:8]}@example.com",
+            password_hash="-", institution_id=institution.id,
+        )
+        cls = models.Class(id=str(uuid4()), name="bench", institution_id=institution.id, teacher_id=user.id)
+        db.add_all([institution, user, cls])
+        db.flush()
+        codes = issue_keys(db, cls, "school", "A", keys)
+        db.commit()
+        token = user.id
+    engine.dispose()
+    return token, codes
+
+
+def _percentile(values: List[float], pct: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    idx = min(len(ordered) - 1, max(0, round(pct / 100 * len(ordered)) - 1))
+    return ordered[idx]
+
+
+async def _wait_ready(client: httpx.AsyncClient, timeout: float = 60.0) -> None:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            if (await client.get("/openapi.json")).status_code == 200:
+                return
+        except httpx.TransportError:
+            pass
+        await asyncio.sleep(0.2)
+    raise RuntimeError("Сервер не поднялся")
+
+
+async def _drive(base_url: str, token: str, codes: List[str], concurrency: int, seed: int) -> Dict[str, object]:
+    rnd = random.Random(seed)
+    latencies: Dict[str, List[float]] = {"start": [], "submit": [], "stats": []}
+    errors = 0
+    # пакет вопросов клиент берёт один раз (как браузер из кэша)
+    bundles: Dict[str, list] = {}
+    queue: asyncio.Queue = asyncio.Queue()
+    for code in codes:
+        queue.put_nowait(code)
+
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(base_url=base_url, timeout=60.0, limits=limits) as client:
+        await _wait_ready(client)
+
+        async def _timed(kind: str, coro):
+            started = time.perf_counter()
+            response = await coro
+            latencies[kind].append(time.perf_counter() - started)
+            response.raise_for_status()
+            return response
+
+        async def _worker() -> None:
+            nonlocal errors
+            while not queue.empty():
+                code = queue.get_nowait()
+                try:
+                    started = await _timed("start", client.post("/session/start-test", json={
+                        "code": code, "age": 14, "gender": rnd.choice(("male", "female")), "diagnosis": "vision",
+                    }))
+                    body = started.json()
+                    if body["bundle"]["url"] not in bundles:
+                        bundles[body["bundle"]["url"]] = (await client.get(body["bundle"]["url"])).json()["questions"]
+                    questions = bundles[body["bundle"]["url"]]
+                    answers = [{"id": q["id"], "value": rnd.randint(1, 10)} for q in questions]
+                    await _timed("submit", client.post(
+                        "/session/submit-answers", json={"session_id": body["session_id"], "answers": answers},
+                    ))
+                    await _timed("stats", client.get("/stats/summary", headers={"Authorization": f"Bearer {token}"}))
+                except httpx.HTTPError:
+                    errors += 1
+
+        started = time.perf_counter()
+        await asyncio.gather(*(_worker() for _ in range(concurrency)))
+        elapsed = time.perf_counter() - started
+
+    requests = sum(len(v) for v in latencies.values())
+    return {
+        "flows": len(codes),
+        "errors": errors,
+        "elapsed_s": round(elapsed, 3),
+        "req_per_s": round(requests / elapsed, 1) if elapsed else None,
+        "latency_ms": {
+            kind: {
+                "p50": round(statistics.median(values) * 1000, 1) if values else None,
+                "p95": round(_percentile(values, 95) * 1000, 1),
+            }
+            for kind, values in latencies.items()
+        },
+    }
+
+
+def _run_mode(mode: str, db_url: str, port: int, token: str, codes: List[str], concurrency: int, seed: int):
+    env = dict(os.environ, DATABASE_URL=db_url, DB_ASYNC=MODES[mode])
+    server = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "SPTOVZ.main:app", "--port", str(port), "--log-level", "warning"],
+        env=env,
+    )
+    try:
+        return asyncio.run(_drive(f"http://127.0.0.1:{port}", token, codes, concurrency, seed))
+    finally:
+        server.terminate()
+        server.wait(timeout=30)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--flows", type=int, default=300, help="сценариев на режим")
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--db", type=Path, default=None, help="файл SQLite (по умолчанию — временный)")
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    tmpdir = None
+    db_path = args.db
+    if db_path is None:
+        tmpdir = tempfile.TemporaryDirectory()
+        db_path = Path(tmpdir.name) / "bench.db"
+    db_url = f"sqlite:///{db_path}"
+
+    try:
+        token, codes = _seed(db_url, args.flows * len(MODES))
+        results = {}
+        for i, mode in enumerate(MODES):
+            chunk = codes[i * args.flows:(i + 1) * args.flows]
+            results[mode] = _run_mode(mode, db_url, args.port, token, chunk, args.concurrency, args.seed)
+    finally:
+        if tmpdir is not None:
+            tmpdir.cleanup()
+
+    sync_rps, async_rps = results["sync"]["req_per_s"], results["async"]["req_per_s"]
+    print(json.dumps({
+        "concurrency": args.concurrency,
+        **results,
+        "async_vs_sync": round(async_rps / sync_rps, 2) if sync_rps and async_rps else None,
+    }, ensure_ascii=False, indent=2))
+
+
+if __name__ == "__main__":
+    main()
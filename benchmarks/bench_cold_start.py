@@ -0,0 +1,94 @@
+"""
+Холодный старт: время от запуска процесса до первого рассчитанного результата
+без бинарного снимка (YAML) и со снимком (utils/snapshot.py).
+
+Каждый прогон — отдельный процесс: импорт SPTOVZ.main (create_all,
+прогрев конфигураций, индекс каталога) и один compute_emspt. Дополнительно
+замеряется полный переимпорт каталога (import_all --force).
+
+    python -m SPTOVZ.benchmarks.bench_cold_start --runs 5
+"""
+from __future__ import annotations
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+CHILD = r"""
+import json, time
+started = time.perf_counter()
+from SPTOVZ.main import app
+app_ms = (time.perf_counter() - started) * 1000
+from SPTOVZ.utils.emspt_engine import Profile, compute_emspt, scoring_config_stats
+compute_emspt({q: 5 for q in range(1, 120)}, Profile("A", "vision", "male"))
+first_ms = (time.perf_counter() - started) * 1000
+from SPTOVZ.database import SessionLocal
+from SPTOVZ.utils.test_loader import import_all
+with SessionLocal() as db:
+    catalog_ms = import_all(db, force=True, workers=1)["timings"]["total_ms"]
+stats = scoring_config_stats()
+print(json.dumps({
+    "app_import_ms": app_ms,
+    "first_result_ms": first_ms,
+    "catalog_import_ms": catalog_ms,
+    "yaml_parses": stats["yaml_parses"],
+    "snapshot_configs": stats["snapshot_configs"],
+}))
+"""
+
+
+def _run(env: dict) -> dict:
+    started = time.perf_counter()
+    out = subprocess.run([sys.executable, "-c", CHILD], env=env, capture_output=True, text=True, check=True)
+    result = json.loads(out.stdout.strip().splitlines()[-1])
+    result["process_ms"] = (time.perf_counter() - started) * 1000
+    return result
+
+
+def _summary(runs: list) -> dict:
+    keys = ("process_ms", "app_import_ms", "first_result_ms", "catalog_import_ms")
+    return {
+        **{f"{k}_median": round(statistics.median(r[k] for r in runs), 1) for k in keys},
+        "yaml_parses": runs[-1]["yaml_parses"],
+        "snapshot_configs": runs[-1]["snapshot_configs"],
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--runs", type=int, default=5)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        tmp = Path(tmp)
+        snapshot = tmp / "catalog.snapshot"
+        base_env = dict(os.environ, DATABASE_URL=f"sqlite:///{tmp / 'bench.db'}")
+
+        subprocess.run(
+            [sys.executable, "-m", "SPTOVZ.utils.snapshot", "build", "--path", str(snapshot)],
+            env=base_env, check=True, capture_output=True,
+        )
+        # первый прогон создаёт схему и каталог в БД — в замеры не входит
+        _run(dict(base_env, SNAPSHOT_PATH=str(tmp / "missing.snapshot")))
+
+        results = {}
+        for mode, path in (("yaml", tmp / "missing.snapshot"), ("snapshot", snapshot)):
+            env = dict(base_env, SNAPSHOT_PATH=str(path))
+            results[mode] = _summary([_run(env) for _ in range(args.runs)])
+
+    before = results["yaml"]["first_result_ms_median"]
+    after = results["snapshot"]["first_result_ms_median"]
+    print(json.dumps({
+        "runs": args.runs,
+        **results,
+        "first_result_speedup": round(before / after, 2) if after else None,
+    }, ensure_ascii=False, indent=2))
+
+
+if __name__ == "__main__":
+    main()
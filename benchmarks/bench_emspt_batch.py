@@ -0,0 +1,68 @@
+"""
+Сравнение скалярного compute_emspt и пакетного compute_emspt_batch
+на синтетических сессиях.
+
+    python -m SPTOVZ.benchmarks.bench_emspt_batch --sessions 100000
+"""
+from __future__ import annotations
+import argparse
+import json
+import random
+import time
+
+from SPTOVZ.utils.emspt_engine import available_profiles, compute_emspt, get_scoring_config
+from SPTOVZ.utils.emspt_batch import answers_to_matrix, compute_emspt_batch
+
+
+def _synthetic_sessions(n: int, seed: int):
+    rnd = random.Random(seed)
+    profiles = available_profiles()
+    sessions = []
+    for _ in range(n):
+        profile = rnd.choice(profiles)
+        n_questions = get_scoring_config(profile).n_questions
+        # часть сессий с завышенной шкалой ЛЖ, чтобы покрыть коррекцию
+        top = rnd.choice((6, 10, 10))
+        answers = {q: rnd.randint(1, top) for q in range(1, n_questions + 1)}
+        sessions.append((profile, answers))
+    return sessions
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--sessions", type=int, default=100_000)
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    sessions = _synthetic_sessions(args.sessions, args.seed)
+    profiles = [p for p, _ in sessions]
+    width = max(get_scoring_config(p).n_questions for p in available_profiles())
+
+    started = time.perf_counter()
+    scalar = [compute_emspt(answers, profile) for profile, answers in sessions]
+    scalar_s = time.perf_counter() - started
+
+    started = time.perf_counter()
+    matrix = answers_to_matrix((a for _, a in sessions), width)
+    matrix_s = time.perf_counter() - started
+
+    started = time.perf_counter()
+    batch = compute_emspt_batch(matrix, profiles)
+    batch_s = time.perf_counter() - started
+
+    identical = json.dumps(scalar, ensure_ascii=False) == json.dumps(batch, ensure_ascii=False)
+
+    print(json.dumps({
+        "sessions": args.sessions,
+        "scalar_s": round(scalar_s, 3),
+        "matrix_build_s": round(matrix_s, 3),
+        "batch_s": round(batch_s, 3),
+        "speedup": round(scalar_s / batch_s, 1) if batch_s else None,
+        "identical": identical,
+    }, indent=2))
+    if not identical:
+        raise SystemExit("batch и scalar дали разные результаты")
+
+
+if __name__ == "__main__":
+    main()
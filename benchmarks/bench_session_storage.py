@@ -0,0 +1,191 @@
+"""
+Хранение сессий: JSON-столбцы answers/result против упакованных столбцов.
+
+Во временной SQLite заводятся завершённые сессии в старом виде (JSON),
+затем выполняется миграция pack_legacy_sessions, сверка и удаление
+JSON-столбцов (drop_legacy_columns) и VACUUM. Сравниваются
+размер таблицы test_sessions (dbstat), время полного чтения для выгрузки
+и для пересчёта, а также проверяется, что после миграции результат
+и ответы читаются без изменений.
+
+    python -m SPTOVZ.benchmarks.bench_session_storage --sessions 20000
+"""
+from __future__ import annotations
+import argparse
+import json
+import os
+import random
+import tempfile
+import time
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import Any, Dict, List
+from uuid import uuid4
+
+
+def _table_bytes(engine, name: str) -> int:
+    with engine.connect() as conn:
+        return conn.exec_driver_sql("SELECT sum(pgsize) FROM dbstat WHERE name = ?", (name,)).scalar() or 0
+
+
+def _seed_legacy(engine, count: int, seed: int) -> Dict[str, Any]:
+    """Сессии так, как их писал submit-answers до упаковки: answers/result — JSON."""
+    from sqlalchemy import JSON, column, insert, table
+    from sqlalchemy.orm import Session
+    from SPTOVZ import models
+    from SPTOVZ.models.session import headline_columns
+    from SPTOVZ.utils.emspt_batch import answers_to_matrix, compute_emspt_batch
+    from SPTOVZ.utils.emspt_engine import available_profiles, get_scoring_config
+    from SPTOVZ.utils.key_codes import issue_keys
+
+    with engine.begin() as conn:
+        conn.exec_driver_sql("ALTER TABLE test_sessions ADD COLUMN answers JSON")
+        conn.exec_driver_sql("ALTER TABLE test_sessions ADD COLUMN result JSON")
+
+    rnd = random.Random(seed)
+    profiles = available_profiles()
+    with Session(engine) as db:
+        institution = models.Institution(id=str(uuid4()), name="Бенчмарк: хранение", education_type="school")
+        cls = models.Class(id=str(uuid4()), name="storage", institution_id=institution.id)
+        db.add_all([institution, cls])
+        db.flush()
+        issue_keys(db, cls, "school", "A", 50)
+        db.commit()
+        key_ids = [k.id for k in db.query(models.Key).filter_by(class_id=cls.id)]
+
+    sessions = table(
+        "test_sessions",
+        *(column(name) for name in (
+            "id", "key_id", "age", "gender", "diagnosis", "form_type", "test_name", "started_at", "finished_at",
+            "irp", "irp_interval", "kveripo", "kveripo_interval", "lie_applied",
+        )),
+        column("answers", JSON), column("result", JSON),
+    )
+    by_profile: Dict[Any, List[Dict[int, int]]] = {}
+    for _ in range(count):
+        profile = rnd.choice(profiles)
+        n_questions = get_scoring_config(profile).n_questions
+        top = rnd.choice((6, 10, 10))  # часть сессий — с коррекцией по ЛЖ
+        by_profile.setdefault(profile.cache_key(), []).append(
+            {q: rnd.randint(1, top) for q in range(1, n_questions + 1)}
+        )
+
+    expected: Dict[str, Any] = {}
+    started_at = datetime(2025, 9, 1, 9, 0)
+    with engine.begin() as conn:
+        for key, maps in by_profile.items():
+            profile = next(p for p in profiles if p.cache_key() == key)
+            results = compute_emspt_batch(answers_to_matrix(maps, get_scoring_config(profile).n_questions), profile)
+            rows = []
+            for answers, result in zip(maps, results):
+                sid = str(uuid4())
+                # так их видел JSON-столбец: ключи ответов — строки
+                answers_json = {str(q): v for q, v in answers.items()}
+                expected[sid] = (answers, json.loads(json.dumps(result, ensure_ascii=False)))
+                rows.append({
+                    "id": sid, "key_id": rnd.choice(key_ids), "age": 14, "gender": profile.gender,
+                    "diagnosis": profile.impairment, "form_type": profile.form, "test_name": "bench",
+                    "started_at": started_at, "finished_at": started_at + timedelta(minutes=25),
+                    "answers": answers_json, "result": result, **headline_columns(result),
+                })
+            conn.execute(insert(sessions), rows)
+    return expected
+
+
+def _scan_legacy(engine) -> float:
+    """Полное чтение как раньше: JSON result → шкалы и стэны, JSON answers → словарь."""
+    started = time.perf_counter()
+    with engine.connect() as conn:
+        for answers, result in conn.exec_driver_sql("SELECT answers, result FROM test_sessions"):
+            result = json.loads(result)
+            _ = (json.loads(answers), result["scales"], result["sten"], result["irp"])
+    return time.perf_counter() - started
+
+
+def _scan_packed(engine) -> Dict[str, float]:
+    from sqlalchemy import select
+    from sqlalchemy.orm import Session
+    from SPTOVZ.models.session import TestSession
+    from SPTOVZ.utils.emspt_batch import packed_to_matrix
+    from SPTOVZ.utils.session_export import ExportFilter, iter_export_chunks, scale_names
+
+    timings: Dict[str, float] = {}
+    with Session(engine) as db:
+        started = time.perf_counter()
+        rows = sum(len(chunk) for chunk in iter_export_chunks(db, ExportFilter(), scale_names()))
+        timings["export_s"] = time.perf_counter() - started
+        timings["export_rows"] = rows
+
+        started = time.perf_counter()
+        packed = db.execute(select(TestSession.answers_packed)).scalars().all()
+        packed_to_matrix(packed, max(map(len, packed)))
+        timings["answers_matrix_s"] = time.perf_counter() - started
+    return timings
+
+
+def _verify(engine, expected: Dict[str, Any]) -> Dict[str, int]:
+    from sqlalchemy.orm import Session
+    from SPTOVZ.models.session import TestSession
+
+    mismatched_results = mismatched_answers = 0
+    with Session(engine) as db:
+        for session in db.query(TestSession).yield_per(2000):
+            answers, result = expected[session.id]
+            mismatched_answers += session.answers != answers
+            mismatched_results += session.result != result
+    return {"results": mismatched_results, "answers": mismatched_answers}
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="JSON против упакованного хранения сессий")
+    parser.add_argument("--sessions", type=int, default=20_000)
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        # DATABASE_URL читается при импорте SPTOVZ.database — выставляем до импорта
+        os.environ["DATABASE_URL"] = f"sqlite:///{Path(tmp) / 'storage.db'}"
+        from SPTOVZ.database import Base, engine
+        from SPTOVZ.utils.migrations import drop_legacy_columns, pack_legacy_sessions, upgrade_schema, vacuum
+
+        Base.metadata.create_all(bind=engine)
+        upgrade_schema(engine)
+        expected = _seed_legacy(engine, args.sessions, args.seed)
+        vacuum(engine)
+        legacy_bytes = _table_bytes(engine, "test_sessions")
+        legacy_scan_s = _scan_legacy(engine)
+
+        started = time.perf_counter()
+        pack_legacy_sessions(engine, report=lambda _: None)
+        migrate_s = time.perf_counter() - started
+        started = time.perf_counter()
+        dropped = drop_legacy_columns(engine, report=lambda _: None)
+        drop_s = time.perf_counter() - started
+        vacuum(engine)
+        packed_bytes = _table_bytes(engine, "test_sessions")
+        timings = _scan_packed(engine)
+        mismatches = _verify(engine, expected)
+        engine.dispose()
+
+    print(json.dumps({
+        "sessions": args.sessions,
+        "table_bytes": {"json": legacy_bytes, "packed": packed_bytes},
+        "bytes_per_session": {
+            "json": round(legacy_bytes / args.sessions), "packed": round(packed_bytes / args.sessions),
+        },
+        "size_ratio": round(legacy_bytes / packed_bytes, 1) if packed_bytes else None,
+        "migrate_s": round(migrate_s, 3),
+        "verify_and_drop_s": round(drop_s, 3),
+        "legacy_columns_dropped": dropped,
+        "scan_s": {
+            "json_parse": round(legacy_scan_s, 3),
+            "export_packed": round(timings["export_s"], 3),
+            "answers_matrix_packed": round(timings["answers_matrix_s"], 3),
+        },
+        "export_rows": timings["export_rows"],
+        "mismatches_after_migration": mismatches,
+    }, ensure_ascii=False, indent=2))
+
+
+if __name__ == "__main__":
+    main()
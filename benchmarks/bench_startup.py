@@ -0,0 +1,81 @@
+"""
+Время импорта SPTOVZ.main (готовность воркера) в зависимости от размера
+таблицы users и число запросов к users во время старта.
+
+Пользователи создаются с уже готовыми bcrypt-хэшами — типичная картина
+для рабочей базы. Каждый замер — отдельный процесс.
+
+    python -m SPTOVZ.benchmarks.bench_startup --users 0 20000 100000
+"""
+from __future__ import annotations
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+from pathlib import Path
+
+CHILD = r"""
+import json, time
+from sqlalchemy import event
+from SPTOVZ.database import engine
+users_queries = 0
+
+@event.listens_for(engine, "before_cursor_execute")
+def _count(conn, cursor, statement, *args):
+    global users_queries
+    if "FROM users" in statement:
+        users_queries += 1
+
+started = time.perf_counter()
+import SPTOVZ.main
+print(json.dumps({"import_ms": (time.perf_counter() - started) * 1000, "users_queries": users_queries}))
+"""
+
+SEED = r"""
+import sys
+from uuid import uuid4
+from SPTOVZ.database import Base, engine
+from SPTOVZ import models
+from SPTOVZ.utils.auth import get_password_hash
+Base.metadata.create_all(engine)
+n = int(sys.argv[1])
+password_hash = get_password_hash("password")
+rows = [{"id": str(uuid4()), "email": f"user{i}@example.com", "password_hash": password_hash} for i in range(n)]
+with engine.begin() as conn:
+    for i in range(0, len(rows), 5000):
+        conn.execute(models.User.__table__.insert(), rows[i:i + 5000])
+"""
+
+
+def _child(env: dict, code: str, *argv: str) -> str:
+    out = subprocess.run([sys.executable, "-c", code, *argv], env=env, capture_output=True, text=True, check=True)
+    return out.stdout.strip().splitlines()[-1] if out.stdout.strip() else ""
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--users", type=int, nargs="+", default=[0, 20_000, 100_000])
+    parser.add_argument("--runs", type=int, default=3)
+    args = parser.parse_args()
+
+    results = []
+    for n in args.users:
+        with tempfile.TemporaryDirectory() as tmp:
+            env = dict(os.environ, DATABASE_URL=f"sqlite:///{Path(tmp) / 'bench.db'}")
+            _child(env, SEED, str(n))
+            _child(env, CHILD)  # первый старт: миграции схемы — не в замере
+            runs = [json.loads(_child(env, CHILD)) for _ in range(args.runs)]
+        results.append({
+            "users": n,
+            "import_ms_median": round(statistics.median(r["import_ms"] for r in runs), 1),
+            "users_queries": runs[-1]["users_queries"],
+        })
+
+    print(json.dumps(results, ensure_ascii=False, indent=2))
+
+
+if __name__ == "__main__":
+    main()
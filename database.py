@@ -1,25 +1,250 @@
 import os
+import threading
+import time
 from pathlib import Path
-from sqlalchemy import create_engine
+from typing import Any, Dict, Optional
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import Engine, make_url
+from sqlalchemy.ext.asyncio import AsyncEngine, async_sessionmaker, create_async_engine
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
 from sqlalchemy.orm import sessionmaker, declarative_base
+from sqlalchemy.pool import AsyncAdaptedQueuePool, QueuePool
 from dotenv import load_dotenv
 
 # Загружаем .env, лежащий РЯДОМ с этим файлом (важно при запуске из другого каталога)
 load_dotenv(Path(__file__).with_name(".env"))
 
-DATABASE_URL = os.getenv("DATABASE_URL")
 Base = declarative_base()
 
-# Фолбэк на локальную SQLite, если переменная не задана
-if not DATABASE_URL or not DATABASE_URL.strip():
-    db_path = Path(__file__).with_name("app.db")
-    DATABASE_URL = f"sqlite:///{db_path}"
-    engine = create_engine(DATABASE_URL, connect_args={"check_same_thread": False})
-else:
-    engine = create_engine(DATABASE_URL, pool_pre_ping=True)
-    SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+
+def _env_int(name: str, default: int) -> int:
+    value = os.getenv(name)
+    return int(value) if value and value.strip() else default
+
+
+def _env_str(name: str, default: str) -> str:
+    value = os.getenv(name)
+    return value.strip() if value and value.strip() else default
+
+
+def database_url() -> str:
+    url = os.getenv("DATABASE_URL")
+    # Фолбэк на локальную SQLite, если переменная не задана
+    if not url or not url.strip():
+        return f"sqlite:///{Path(__file__).with_name('app.db')}"
+    return url.strip()
+
+
+# --------------------- Метрики пула ---------------------
+
+class PoolStats:
+    """Счётчики выдачи соединений: сколько раз и как долго ждали свободное."""
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self.checkouts = 0
+        self.waits = 0            # выдачи, ждавшие дольше WAIT_THRESHOLD_S
+        self.wait_total_s = 0.0
+        self.wait_max_s = 0.0
+        self.timeouts = 0
+
+    WAIT_THRESHOLD_S = 0.001
+
+    def record(self, waited: float, timed_out: bool = False) -> None:
+        with self._lock:
+            if timed_out:
+                self.timeouts += 1
+                return
+            self.checkouts += 1
+            if waited >= self.WAIT_THRESHOLD_S:
+                self.waits += 1
+                self.wait_total_s += waited
+                self.wait_max_s = max(self.wait_max_s, waited)
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "checkouts": self.checkouts,
+                "waits": self.waits,
+                "wait_total_s": round(self.wait_total_s, 6),
+                "wait_max_s": round(self.wait_max_s, 6),
+                "timeouts": self.timeouts,
+            }
+
+
+class InstrumentedQueuePool(QueuePool):
+    """QueuePool, замеряющий время ожидания свободного соединения."""
+
+    stats: PoolStats
+
+    def _do_get(self):
+        started = time.perf_counter()
+        try:
+            conn = super()._do_get()
+        except PoolTimeoutError:
+            self.stats.record(time.perf_counter() - started, timed_out=True)
+            raise
+        self.stats.record(time.perf_counter() - started)
+        return conn
+
+    def recreate(self):
+        pool = super().recreate()
+        pool.stats = self.stats
+        return pool
+
+
+class InstrumentedAsyncQueuePool(InstrumentedQueuePool, AsyncAdaptedQueuePool):
+    """То же для AsyncEngine (asyncio-совместимая очередь соединений)."""
+
+
+# --------------------- Фабрика движка ---------------------
+
+def _setup_sqlite(engine: Engine) -> None:
+    """
+    PRAGMA для каждого нового соединения SQLite: WAL (читатели не блокируют
+    писателя), synchronous, busy_timeout. Транзакции открываем сами:
+    по умолчанию BEGIN DEFERRED — чтение в WAL не берёт блокировку записи.
+    Записи открываются как BEGIN IMMEDIATE (WriteSessionLocal, get_write_db,
+    begin_write): отложенная транзакция, которая сначала читала, не может
+    повысить блокировку и сразу получает "database is locked", не дожидаясь
+    busy_timeout.
+    """
+    journal_mode = _env_str("SQLITE_JOURNAL_MODE", "WAL")
+    synchronous = _env_str("SQLITE_SYNCHRONOUS", "NORMAL")
+    busy_timeout = _env_int("SQLITE_BUSY_TIMEOUT_MS", 5000)
+    begin_mode = _env_str("SQLITE_BEGIN_MODE", "DEFERRED").upper()
+
+    @event.listens_for(engine, "connect")
+    def _on_connect(dbapi_conn, _record):
+        # отключаем неявный BEGIN драйвера pysqlite — см. событие "begin"
+        dbapi_conn.isolation_level = None
+        cursor = dbapi_conn.cursor()
+        cursor.execute(f"PRAGMA journal_mode={journal_mode}")
+        cursor.execute(f"PRAGMA synchronous={synchronous}")
+        cursor.execute(f"PRAGMA busy_timeout={busy_timeout}")
+        cursor.close()
+
+    @event.listens_for(engine, "begin")
+    def _on_begin(conn):
+        mode = conn.get_execution_options().get("sqlite_begin_mode", begin_mode)
+        conn.exec_driver_sql(f"BEGIN {mode}")
+
+
+def _engine_options(url: str, poolclass) -> Dict[str, Any]:
+    backend = make_url(url).get_backend_name()
+    kwargs: Dict[str, Any] = {
+        "echo": _env_str("DB_ECHO", "0") == "1",
+        "pool_pre_ping": backend != "sqlite",
+    }
+    connect_args: Dict[str, Any] = {}
+
+    is_memory = backend == "sqlite" and make_url(url).database in (None, "", ":memory:")
+    if not is_memory:
+        kwargs.update(
+            poolclass=poolclass,
+            pool_size=_env_int("DB_POOL_SIZE", 5),
+            max_overflow=_env_int("DB_MAX_OVERFLOW", 10),
+            pool_timeout=_env_int("DB_POOL_TIMEOUT", 30),
+            pool_recycle=_env_int("DB_POOL_RECYCLE", 1800),
+        )
+
+    if backend == "sqlite":
+        connect_args["check_same_thread"] = False
+    elif backend == "postgresql":
+        statement_timeout = _env_int("DB_STATEMENT_TIMEOUT_MS", 0)
+        if statement_timeout:
+            connect_args["options"] = f"-c statement_timeout={statement_timeout}"
+
+    kwargs["connect_args"] = connect_args
+    return kwargs
+
+
+def _finish_engine(engine: Engine) -> Engine:
+    if isinstance(engine.pool, InstrumentedQueuePool):
+        engine.pool.stats = PoolStats()
+    if engine.dialect.name == "sqlite":
+        _setup_sqlite(engine)
+    return engine
+
+
+def create_app_engine(url: Optional[str] = None, **overrides: Any) -> Engine:
+    """
+    Движок с настройками из переменных окружения:
+
+      DB_POOL_SIZE, DB_MAX_OVERFLOW, DB_POOL_TIMEOUT (с), DB_POOL_RECYCLE (с),
+      DB_STATEMENT_TIMEOUT_MS (PostgreSQL), DB_ECHO,
+      SQLITE_JOURNAL_MODE, SQLITE_SYNCHRONOUS, SQLITE_BUSY_TIMEOUT_MS, SQLITE_BEGIN_MODE.
+    """
+    url = url or database_url()
+    kwargs = _engine_options(url, InstrumentedQueuePool)
+    kwargs.update(overrides)
+    return _finish_engine(create_engine(url, **kwargs))
+
+
+def async_database_url(url: str) -> str:
+    """URL с асинхронным драйвером: aiosqlite для SQLite, psycopg (v3) для PostgreSQL."""
+    parsed = make_url(url)
+    backend = parsed.get_backend_name()
+    if backend == "sqlite":
+        return parsed.set(drivername="sqlite+aiosqlite").render_as_string(hide_password=False)
+    if backend == "postgresql":
+        return parsed.set(drivername="postgresql+psycopg").render_as_string(hide_password=False)
+    return url
+
+
+def create_async_app_engine(url: Optional[str] = None, **overrides: Any) -> AsyncEngine:
+    """AsyncEngine с теми же настройками пула и PRAGMA, что и create_app_engine."""
+    url = async_database_url(url or database_url())
+    kwargs = _engine_options(url, InstrumentedAsyncQueuePool)
+    kwargs.update(overrides)
+    async_engine = create_async_engine(url, **kwargs)
+    _finish_engine(async_engine.sync_engine)
+    return async_engine
+
+
+def pool_status(bind: Optional[Engine] = None) -> Dict[str, Any]:
+    """Текущее состояние пула и накопленные метрики ожидания."""
+    if isinstance(bind, AsyncEngine):
+        bind = bind.sync_engine
+    pool = (bind or engine).pool
+    status: Dict[str, Any] = {"pool": type(pool).__name__}
+    if isinstance(pool, QueuePool):
+        status.update(
+            size=pool.size(),
+            checked_out=pool.checkedout(),
+            overflow=pool.overflow(),
+            checked_in=pool.checkedin(),
+        )
+    stats = getattr(pool, "stats", None)
+    if stats is not None:
+        status.update(stats.snapshot())
+    return status
+
+
+DATABASE_URL = database_url()
+engine = create_app_engine(DATABASE_URL)
+# Режимы BEGIN для SQLite (на других СУБД опция ни на что не влияет)
+WRITE_TX = {"sqlite_begin_mode": "IMMEDIATE"}
+READ_TX = {"sqlite_begin_mode": "DEFERRED"}
 
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+# Только чтение (выгрузки, отчёты): DEFERRED при любом SQLITE_BEGIN_MODE —
+# не держит блокировку записи SQLite всё время, пока читается курсор
+ReadSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine.execution_options(**READ_TX))
+# Записи: BEGIN IMMEDIATE — ждут блокировку записи по busy_timeout
+WriteSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine.execution_options(**WRITE_TX))
+
+
+def begin_write(db) -> None:
+    """
+    Открывает в сессии транзакцию записи (BEGIN IMMEDIATE на SQLite).
+    Текущая транзакция сессии (чтение) завершается — несохранённых
+    изменений в ней быть не должно.
+    """
+    if db.in_transaction():
+        db.rollback()
+    db.connection(execution_options=WRITE_TX)
+
 
 def get_db():
     db = SessionLocal()
@@ -27,3 +252,52 @@ def get_db():
         yield db
     finally:
         db.close()
+
+
+def get_write_db():
+    """Сессия для эндпоинтов, которые пишут."""
+    db = WriteSessionLocal()
+    try:
+        yield db
+    finally:
+        db.close()
+
+
+# Асинхронный режим (DB_ASYNC=1): роутеры session и stats работают через AsyncSession
+ASYNC_DB = _env_str("DB_ASYNC", "0") == "1"
+async_engine: Optional[AsyncEngine] = create_async_app_engine(DATABASE_URL) if ASYNC_DB else None
+AsyncSessionLocal = (
+    async_sessionmaker(async_engine, autoflush=False) if async_engine else None
+)
+AsyncWriteSessionLocal = (
+    async_sessionmaker(async_engine.execution_options(**WRITE_TX), autoflush=False) if async_engine else None
+)
+
+
+async def get_async_db():
+    if AsyncSessionLocal is None:
+        raise RuntimeError("Асинхронный режим БД выключен (DB_ASYNC=1)")
+    async with AsyncSessionLocal() as db:
+        yield db
+
+
+async def get_async_write_db():
+    if AsyncWriteSessionLocal is None:
+        raise RuntimeError("Асинхронный режим БД выключен (DB_ASYNC=1)")
+    async with AsyncWriteSessionLocal() as db:
+        yield db
+
+
+def dialect_insert(db, table):
+    """
+    INSERT текущего диалекта — с поддержкой on_conflict_do_update /
+    on_conflict_do_nothing (SQLite и PostgreSQL).
+    """
+    name = db.get_bind().dialect.name
+    if name == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert
+    elif name == "sqlite":
+        from sqlalchemy.dialects.sqlite import insert
+    else:
+        raise NotImplementedError(f"upsert не поддерживается для {name}")
+    return insert(table)
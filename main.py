@@ -1,39 +1,57 @@
+from contextlib import asynccontextmanager
+
 from fastapi import FastAPI, Request
 from fastapi.responses import HTMLResponse
 from fastapi.templating import Jinja2Templates
-from SPTOVZ.utils.auth import get_password_hash, verify_password
-from SPTOVZ.models.user import User
 from sqlalchemy.orm import Session
-from SPTOVZ.database import Base, engine
+from SPTOVZ.database import ASYNC_DB, Base, WriteSessionLocal, engine
 from SPTOVZ import models
 from SPTOVZ.routers import auth as auth_router, class_group as class_router, session as session_router
-from SPTOVZ.routers import stats
+from SPTOVZ.routers import stats, catalog, jobs as jobs_router, metrics as metrics_router
+from SPTOVZ.utils.emspt_engine import warm_scoring_configs
+from SPTOVZ.utils.jobs import start_inprocess_worker, stop_inprocess_worker
+from SPTOVZ.utils.metrics import METRICS_ENABLED, MetricsMiddleware, TimedJSONResponse
+from SPTOVZ.utils.migrations import backfill_key_dates, pack_legacy_sessions, upgrade_schema
+from SPTOVZ.utils.stats_rollup import ensure_rollups
+from SPTOVZ.utils.test_catalog import load_catalog_index
 
-app = FastAPI(title="СПТ ОВЗ")
-Base.metadata.create_all(bind=engine)
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Воркер фоновых задач (JOBS_WORKER=off — задачи выполняет отдельный процесс)
+    start_inprocess_worker()
+    yield
+    stop_inprocess_worker()
+    # дописать отправки, ждущие групповой фиксации (SUBMIT_GROUP_COMMIT=1)
+    session_router.submit_writer.stop()
 
+
+app = FastAPI(title="СПТ ОВЗ", lifespan=lifespan, default_response_class=TimedJSONResponse)
+# Задержки по маршрутам, запросы к БД на запрос, лог медленных (METRICS=0 — выключить)
+if METRICS_ENABLED:
+    app.add_middleware(MetricsMiddleware)
+Base.metadata.create_all(bind=engine)
+upgrade_schema(engine)
+# JSON-столбцы answers/result старых сессий → упакованные столбцы (только заполнение;
+# сами JSON-столбцы удаляет явная команда: python -m SPTOVZ.utils.migrations --drop-legacy)
+pack_legacy_sessions(engine)
+# Конфигурации ЕМ СПТ собираем при старте, а не на первом submit-answers
+warm_scoring_configs()
+# Индекс каталога тестов: выбор теста на start-test — без запросов к БД
 with Session(engine) as db:
-    users = db.query(User).all()
-    updated = 0
-    for u in users:
-        try:
-            # если verify_password не может распознать, считаем пароль "сырой"
-            if not u.password_hash.startswith("$2b$"):  # bcrypt всегда начинается с "$2b$"
-                print(f"[*] Авто-хеширование пароля пользователя {u.email}")
-                u.password_hash = get_password_hash(u.password_hash)
-                updated += 1
-        except Exception:
-            # если не удалось проверить — перехешируем на всякий случай
-            u.password_hash = get_password_hash(u.password_hash)
-            updated += 1
-    if updated:
-        db.commit()
-        print(f"[+] Перехешировано паролей: {updated}")
+    load_catalog_index(db)
+# stats_rollup пуста на установке, обновлённой с версии без агрегатов. Ключи,
+# выданные до столбца created_at, сначала получают дату — иначе агрегаты их не учтут
+with WriteSessionLocal() as db:
+    ensure_rollups(db, stale=backfill_key_dates(db) > 0)
 
 app.include_router(auth_router.router)
 app.include_router(class_router.router)
-app.include_router(session_router.router)
-app.include_router(stats.router)
+app.include_router(catalog.router)
+app.include_router(jobs_router.router)
+app.include_router(metrics_router.router)
+# session и stats — самые нагруженные: при DB_ASYNC=1 подключаем их async-версии
+app.include_router(session_router.async_router if ASYNC_DB else session_router.router)
+app.include_router(stats.async_router if ASYNC_DB else stats.router)
 
 templates = Jinja2Templates(directory="SPTOVZ/templates")
 
@@ -1,5 +1,7 @@
 from .institution import Institution  # noqa: F401
-from .user import User                # noqa: F401
+from .user import User, RevokedToken  # noqa: F401
 from .class_group import Class, Key   # noqa: F401
-from .session import TestSession      # noqa: F401
-from .testbank import TestPassport, TestContent  # noqa: F401
+from .session import TestSession, AnswerBatch  # noqa: F401
+from .testbank import TestPassport, TestContent, CatalogState  # noqa: F401
+from .stats import StatsRollup       # noqa: F401
+from .job import Job                  # noqa: F401
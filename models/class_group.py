@@ -1,6 +1,7 @@
-from sqlalchemy import Column, String, Boolean, ForeignKey
+from sqlalchemy import Column, String, Boolean, DateTime, ForeignKey, Index
 from sqlalchemy.orm import relationship
 from SPTOVZ.database import Base
+from datetime import datetime
 
 class Class(Base):
     __tablename__ = "classes"
@@ -8,7 +9,7 @@ class Class(Base):
     id = Column(String, primary_key=True)
     name = Column(String, nullable=False)
 
-    teacher_id = Column(String, ForeignKey("users.id"))
+    teacher_id = Column(String, ForeignKey("users.id"), index=True)
     teacher = relationship("User", back_populates="classes")
 
     institution_id = Column(String, ForeignKey("institutions.id"))
@@ -33,5 +34,11 @@ class Key(Base):
 
     education_type = Column(String, nullable=False)   # school | college | university
     form_type = Column(String, nullable=False)         # A | B | C
+    created_at = Column(DateTime, default=datetime.utcnow, nullable=True, index=True)
 
-    sessions = relationship("TestSession", back_populates="key")
\ No newline at end of file
+    sessions = relationship("TestSession", back_populates="key")
+
+    __table_args__ = (
+        # список ключей класса в порядке выдачи (keyset-пагинация /class/keys)
+        Index("ix_keys_class_created", "class_id", "created_at", "id"),
+    )
\ No newline at end of file
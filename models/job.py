@@ -0,0 +1,44 @@
+from datetime import datetime
+
+from sqlalchemy import Boolean, Column, DateTime, Index, Integer, JSON, String, Text
+from SPTOVZ.database import Base
+
+
+class Job(Base):
+    """
+    Фоновая задача (выгрузки, пересчёт, PDF, импорт каталога).
+
+    Очередь — сама таблица: воркер забирает задачу атомарным UPDATE
+    (utils/jobs.py), внешний брокер не нужен. Статусы:
+    queued → running → done | error | cancelled; при ошибке задача
+    возвращается в queued с отсрочкой run_after, пока не кончатся попытки.
+    """
+    __tablename__ = "jobs"
+
+    id = Column(String, primary_key=True)
+    kind = Column(String, nullable=False, index=True)
+    status = Column(String, nullable=False, default="queued")
+    owner_id = Column(String, nullable=True, index=True)   # пользователь; None — задача из CLI
+
+    params = Column(JSON, nullable=False, default=dict)
+    result = Column(JSON, nullable=True)
+    error = Column(Text, nullable=True)
+
+    progress = Column(Integer, nullable=False, default=0)
+    total = Column(Integer, nullable=True)
+    message = Column(String, nullable=True)
+
+    attempts = Column(Integer, nullable=False, default=0)
+    max_attempts = Column(Integer, nullable=False, default=3)
+    cancel_requested = Column(Boolean, nullable=False, default=False)
+    worker_id = Column(String, nullable=True)
+
+    created_at = Column(DateTime, default=datetime.utcnow, nullable=False)
+    run_after = Column(DateTime, default=datetime.utcnow, nullable=False)
+    started_at = Column(DateTime, nullable=True)
+    heartbeat_at = Column(DateTime, nullable=True)
+    finished_at = Column(DateTime, nullable=True)
+
+    __table_args__ = (
+        Index("ix_jobs_status_run_after", "status", "run_after"),
+    )
@@ -1,13 +1,18 @@
-from sqlalchemy import Column, String, Integer, DateTime, ForeignKey, JSON
+from sqlalchemy import Column, String, Integer, Float, Boolean, DateTime, ForeignKey, LargeBinary, UniqueConstraint
 from sqlalchemy.orm import relationship
 from SPTOVZ.database import Base
+from SPTOVZ.utils.emspt_engine import (
+    _sten_level, form_lie_scale, form_scale_names, interpretation_text, normalize_level,
+)
 from datetime import datetime
+import struct
+from typing import Any, Dict, List, Mapping, Optional, Tuple
 
 class TestSession(Base):
     __tablename__ = "test_sessions"
 
     id = Column(String, primary_key=True)
-    key_id = Column(String, ForeignKey("keys.id"))
+    key_id = Column(String, ForeignKey("keys.id"), index=True)
     key = relationship("Key", back_populates="sessions")
 
     age = Column(Integer, nullable=False)
@@ -19,5 +24,198 @@ class TestSession(Base):
     started_at = Column(DateTime, default=datetime.utcnow, nullable=False)
     finished_at = Column(DateTime, nullable=True)
 
-    answers = Column(JSON, nullable=True)
-    result = Column(JSON, nullable=True)
+    # Ответы: байт на вопрос в порядке паспорта (вопрос N — байт N-1), 0 — нет ответа.
+    # Читать/писать через .answers (pack_answers / unpack_answers).
+    answers_packed = Column(LargeBinary, nullable=True)
+
+    # Результат расчёта — типизированные столбцы, JSON не хранится.
+    # Читать/писать через .result (encode_result / decode_result): профиль
+    # берётся из столбцов сессии, тексты интерпретаций — из interpretations.yaml
+    # по (шкала, уровень). Уровни хранятся нормализованными:
+    # 'низкий' | 'средний' | 'высокий' | NULL ('—')
+    irp = Column(Float, nullable=True)
+    irp_interval = Column(String, nullable=True, index=True)
+    kveripo = Column(Float, nullable=True)
+    kveripo_interval = Column(String, nullable=True, index=True)
+    lie_raw = Column(Float, nullable=True)
+    lie_applied = Column(Boolean, nullable=True)
+    # Шкалы в порядке keys_*.yaml формы: сырые баллы — int32 в сотых долях, стэны — uint8.
+    # Порядок шкал в keys_*.yaml менять только вместе с пересчётом (utils/rescore.py)
+    scales_raw = Column(LargeBinary, nullable=True)
+    scales_sten = Column(LargeBinary, nullable=True)
+
+    @property
+    def answers(self) -> Optional[Dict[int, int]]:
+        return unpack_answers(self.answers_packed)
+
+    @answers.setter
+    def answers(self, answers: Optional[Mapping[Any, int]]) -> None:
+        self.answers_packed = pack_answers(answers)
+
+    @property
+    def result(self) -> Optional[Dict[str, Any]]:
+        return decode_result(*(getattr(self, name) for name in RESULT_COLUMNS))
+
+    @result.setter
+    def result(self, result: Optional[Dict[str, Any]]) -> None:
+        self.apply_result(result)
+
+    def apply_result(self, result: Optional[Dict[str, Any]]) -> None:
+        """Сохраняет результат расчёта в столбцы (None — очищает)."""
+        for name, value in encode_result(result, self.form_type).items():
+            setattr(self, name, value)
+
+
+# Столбцы, из которых собирается результат, — в порядке аргументов decode_result
+RESULT_COLUMNS: Tuple[str, ...] = (
+    "form_type", "diagnosis", "gender",
+    "irp", "irp_interval", "kveripo", "kveripo_interval",
+    "lie_raw", "lie_applied", "scales_raw", "scales_sten",
+)
+
+
+def result_columns() -> List[Any]:
+    """Атрибуты TestSession для select(...): строку потом раскрывает decode_result(*row)."""
+    return [getattr(TestSession, name) for name in RESULT_COLUMNS]
+
+
+def headline_columns(result: Dict[str, Any] | None) -> Dict[str, Any]:
+    """Значения индексных столбцов TestSession по JSON результата."""
+    result = result or {}
+    return {
+        "irp": result.get("irp"),
+        "irp_interval": normalize_level(result.get("irp_interval")),
+        "kveripo": result.get("kveripo"),
+        "kveripo_interval": normalize_level(result.get("kveripo_interval")),
+        "lie_applied": result.get("lie_applied"),
+    }
+
+
+# --------------------- Упаковка ответов ---------------------
+
+def pack_answers(answers: Optional[Mapping[Any, int]], size: int = 0) -> Optional[bytes]:
+    """
+    {номер вопроса: балл} → байт на вопрос. size — число вопросов теста:
+    массив не короче него, даже если на последние вопросы нет ответа.
+    """
+    if not answers:
+        return None
+    items = {int(qid): int(value) for qid, value in answers.items()}
+    if min(items) < 1:
+        raise ValueError(f"Номер вопроса {min(items)} вне паспорта")
+    packed = bytearray(max(size, max(items)))
+    for qid, value in items.items():
+        if not 0 <= value <= 255:
+            raise ValueError(f"Ответ {value} на вопрос {qid} не помещается в байт")
+        packed[qid - 1] = value
+    return bytes(packed)
+
+
+def unpack_answers(data: Optional[bytes]) -> Optional[Dict[int, int]]:
+    if data is None:
+        return None
+    return {qid: value for qid, value in enumerate(data, start=1) if value}
+
+
+# --------------------- Упаковка результата ---------------------
+
+def scale_layout(form: str) -> Tuple[Tuple[str, ...], str]:
+    """Порядок шкал формы в упакованных массивах и её шкала лжи."""
+    return form_scale_names(form), form_lie_scale(form)
+
+
+def encode_result(result: Optional[Dict[str, Any]], form: str) -> Dict[str, Any]:
+    """Результат compute_emspt → значения столбцов TestSession (для None — все NULL)."""
+    if not result:
+        return {name: None for name in RESULT_COLUMNS[3:]}
+    names = form_scale_names(form)
+    scales = result.get("scales") or {}
+    sten = result.get("sten") or {}
+    if set(scales) != set(names) or set(sten) != set(names):
+        raise ValueError(f"Шкалы результата не совпадают со шкалами формы {form}")
+    return {
+        **headline_columns(result),
+        "lie_raw": result.get("lie_raw"),
+        "scales_raw": struct.pack(f"<{len(names)}i", *(round(scales[name] * 100) for name in names)),
+        "scales_sten": bytes(int(sten[name]) for name in names),
+    }
+
+
+def _number(value: Optional[float]) -> Any:
+    # целые баллы в результате расчёта — int: 12, а не 12.0
+    return int(value) if value is not None and float(value).is_integer() else value
+
+
+def decode_scales(
+    layout: Tuple[Tuple[str, ...], str],
+    scales_raw: bytes,
+    scales_sten: bytes,
+    lie_applied: Optional[bool],
+) -> Tuple[Dict[str, Any], Dict[str, int]]:
+    """Упакованные шкалы → ({шкала: сырой балл}, {шкала: стэн})."""
+    names, lie_scale = layout
+    if len(scales_sten) != len(names) or len(scales_raw) != 4 * len(names):
+        raise ValueError(f"Упакованные шкалы не совпадают с keys_*.yaml ({len(names)} шкал)")
+    raw: Dict[str, Any] = {}
+    for name, hundredths in zip(names, struct.unpack(f"<{len(names)}i", scales_raw)):
+        value = round(hundredths / 100, 2)
+        # после коррекции по ЛЖ баллы шкал (кроме самой ЛЖ) — дробные
+        raw[name] = value if lie_applied and name != lie_scale else _number(value)
+    return raw, dict(zip(names, scales_sten))
+
+
+def decode_result(
+    form: str,
+    impairment: Optional[str],
+    gender: str,
+    irp: Optional[float],
+    irp_interval: Optional[str],
+    kveripo: Optional[float],
+    kveripo_interval: Optional[str],
+    lie_raw: Optional[float],
+    lie_applied: Optional[bool],
+    scales_raw: Optional[bytes],
+    scales_sten: Optional[bytes],
+) -> Optional[Dict[str, Any]]:
+    """Столбцы TestSession → результат в том же виде, что вернул compute_emspt."""
+    if scales_raw is None or scales_sten is None:
+        return None
+    raw, sten = decode_scales(scale_layout(form), scales_raw, scales_sten, lie_applied)
+    interpretations = {}
+    for scale, value in sten.items():
+        if value:
+            level = _sten_level(value)
+            interpretations[scale] = {"sten": value, "level": level, "text": interpretation_text(scale, level)}
+    return {
+        "scales": raw,
+        "lie_raw": _number(lie_raw) if lie_raw is not None else 0,
+        "lie_applied": bool(lie_applied),
+        "irp": irp,
+        "irp_interval": irp_interval or "—",
+        "kveripo": kveripo,
+        "kveripo_interval": kveripo_interval or "—",
+        "sten": sten,
+        "interpretations": interpretations,
+        "profile": {"form": form, "impairment": impairment, "gender": gender},
+    }
+
+
+class AnswerBatch(Base):
+    """
+    Порция автосохранения ответов (PATCH /session/{id}/answers).
+    Только добавление: порции склеиваются по seq, поздняя перекрывает
+    ответ на тот же вопрос. data — упакованные пары (вопрос, ответ),
+    см. utils/answer_store.py. Удаляются при завершении сессии.
+    """
+    __tablename__ = "answer_batches"
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    session_id = Column(String, ForeignKey("test_sessions.id"), nullable=False)
+    seq = Column(Integer, nullable=False)
+    data = Column(LargeBinary, nullable=False)
+    created_at = Column(DateTime, default=datetime.utcnow, nullable=False)
+
+    __table_args__ = (
+        # повтор той же порции после обрыва связи не дублирует её
+        UniqueConstraint("session_id", "seq", name="uq_answer_batch_seq"),
+    )
@@ -0,0 +1,38 @@
+from sqlalchemy import Column, String, Integer, Date, UniqueConstraint
+from SPTOVZ.database import Base
+
+
+class StatsRollup(Base):
+    """
+    Предагрегированная статистика: одна строка на корзину
+    (учреждение, класс, форма, нозология, пол, день).
+
+    Ключи попадают в корзину с пустыми impairment/gender по дню выдачи,
+    завершённые сессии — по дню finished_at. Обновляется инкрементально
+    в той же транзакции, что и исходные данные (utils/stats_rollup.py).
+    """
+    __tablename__ = "stats_rollup"
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+
+    institution_id = Column(String, nullable=False, index=True)
+    class_id = Column(String, nullable=False, index=True)
+    form_type = Column(String, nullable=False)
+    impairment = Column(String, nullable=False, default="")
+    gender = Column(String, nullable=False, default="")
+    day = Column(Date, nullable=False)
+
+    keys_total = Column(Integer, nullable=False, default=0)
+    completed = Column(Integer, nullable=False, default=0)
+    irp_low = Column(Integer, nullable=False, default=0)
+    irp_mid = Column(Integer, nullable=False, default=0)
+    irp_high = Column(Integer, nullable=False, default=0)
+    kveripo_low = Column(Integer, nullable=False, default=0)
+    kveripo_high = Column(Integer, nullable=False, default=0)
+
+    __table_args__ = (
+        UniqueConstraint(
+            "institution_id", "class_id", "form_type", "impairment", "gender", "day",
+            name="uq_stats_rollup_bucket",
+        ),
+    )
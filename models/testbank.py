@@ -1,4 +1,5 @@
-from sqlalchemy import Column, String, Integer, JSON, UniqueConstraint
+from datetime import datetime
+from sqlalchemy import Column, String, Integer, JSON, DateTime, UniqueConstraint
 from SPTOVZ.database import Base
 
 class TestPassport(Base):
@@ -18,6 +19,9 @@ class TestPassport(Base):
     form = Column(String, nullable=False)
     locale  = Column(String,  nullable=False, default="ru")
 
+    # sha256 исходного YAML: импорт пропускает неизменённые файлы
+    content_hash = Column(String, nullable=True)
+
     __table_args__ = (
         UniqueConstraint("institution", "impairment", "version", name="uq_test_quad"),
     )
@@ -32,3 +36,15 @@ class TestContent(Base):
     # Сырые данные теста из YAML
     questions = Column(JSON, nullable=False)
     scoring   = Column(JSON, nullable=True)
+
+
+class CatalogState(Base):
+    """
+    Номер версии каталога (одна строка, id=1). Увеличивается при каждом
+    импорте; процессы сравнивают его со своей копией индекса каталога.
+    """
+    __tablename__ = "catalog_state"
+
+    id = Column(Integer, primary_key=True)
+    version = Column(Integer, nullable=False, default=0)
+    updated_at = Column(DateTime, nullable=True, default=datetime.utcnow)
@@ -1,5 +1,5 @@
 # SPTOVZ/models/user.py
-from sqlalchemy import Column, String, ForeignKey
+from sqlalchemy import Column, Float, ForeignKey, String
 from sqlalchemy.orm import relationship
 from SPTOVZ.database import Base
 
@@ -20,3 +20,16 @@ class User(Base):
 
     # связь с классами, которые создаёт учитель
     classes = relationship("Class", back_populates="teacher")
+
+
+class RevokedToken(Base):
+    """
+    Отозванный (logout) подписанный токен — по jti до истечения его срока.
+    Общий список для всех воркеров: каждый подтягивает его в память
+    не чаще раза в AUTH_REVOCATION_SYNC_S (utils/auth.py).
+    """
+    __tablename__ = "revoked_tokens"
+
+    jti = Column(String, primary_key=True)
+    # exp токена (unix-время): после него строка не нужна
+    expires_at = Column(Float, nullable=False, index=True)
@@ -1,4 +1,6 @@
+from __future__ import annotations
 from fastapi import APIRouter, Depends, HTTPException, status
+from fastapi.concurrency import run_in_threadpool
 from fastapi.security import OAuth2PasswordRequestForm
 from sqlalchemy.orm import Session
 from uuid import uuid4
@@ -11,12 +13,18 @@ from SPTOVZ.models.user import User
 from SPTOVZ.models.institution import Institution
 from SPTOVZ.utils.auth import verify_password
 
-from SPTOVZ.database import get_db
+from SPTOVZ.database import begin_write, get_db
 from SPTOVZ.models.user import User
 from SPTOVZ.models.institution import Institution
 from SPTOVZ.schemas.user import UserCreate, UserResponse
-from SPTOVZ.utils.auth import get_password_hash, verify_password
-from SPTOVZ.utils.auth import get_current_user
+from SPTOVZ.utils.auth import get_password_hash_async, verify_and_update_async
+from SPTOVZ.utils.auth import (
+    Principal,
+    create_access_token,
+    get_current_user,
+    login_principal,
+    revoke_token,
+)
 from fastapi.security import OAuth2PasswordBearer
 from fastapi import Depends
 from SPTOVZ.database import get_db
@@ -27,28 +35,28 @@ oauth2_scheme = OAuth2PasswordBearer(tokenUrl="/token")
 router = APIRouter(tags=["auth"])
 
 @router.get("/me")
-def get_profile(token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)):
+def get_profile(user: Principal = Depends(get_current_user)):
     """
-    Возвращает профиль пользователя по токену (user.id)
+    Возвращает профиль пользователя — из подписанного токена, без запросов к БД
     """
-    user = db.query(User).filter(User.id == token).first()
-    if not user:
-        raise HTTPException(status_code=404, detail="Not Found")
-
-    institution = db.query(Institution).filter(Institution.id == user.institution_id).first()
-
     return {
         "email": user.email,
-        "institution_name": institution.name if institution else None,
-        "education_type": institution.education_type if institution else None
+        "institution_name": user.institution_name,
+        "education_type": user.education_type,
     }
 
 
-@router.post("/register", response_model=UserResponse)
-def register(payload: UserCreate, db: Session = Depends(get_db)):
-    if db.query(User).filter(User.email == payload.email).first():
-        raise HTTPException(status_code=400, detail="Email already registered")
+@router.post("/logout")
+def logout(token: str = Depends(oauth2_scheme)):
+    revoke_token(token)
+    return {"ok": True}
 
+
+def _email_taken(db: Session, email: str) -> bool:
+    return db.query(User).filter(User.email == email).first() is not None
+
+
+def _create_user(db: Session, payload: UserCreate, password_hash: str) -> User:
     inst = Institution(
         id=str(uuid4()),
         name=payload.institution_name,
@@ -57,21 +65,50 @@ def register(payload: UserCreate, db: Session = Depends(get_db)):
     user = User(
         id=str(uuid4()),
         email=payload.email,
-        password_hash=get_password_hash(payload.password),
+        password_hash=password_hash,
         institution_id=inst.id,
     )
+    # проверка email и bcrypt были в читающей транзакции — запись отдельной
+    begin_write(db)
     db.add_all([inst, user])
     db.commit()
     db.refresh(user)
     return user
 
+
+@router.post("/register", response_model=UserResponse)
+async def register(payload: UserCreate, db: Session = Depends(get_db)):
+    # Запросы к БД — в пуле потоков, bcrypt — в отдельном пуле процессов
+    if await run_in_threadpool(_email_taken, db, payload.email):
+        raise HTTPException(status_code=400, detail="Email already registered")
+
+    password_hash = await get_password_hash_async(payload.password)
+    return await run_in_threadpool(_create_user, db, payload, password_hash)
+
+def _find_user(db: Session, email: str) -> User | None:
+    return db.query(User).filter(User.email == email).first()
+
+
+def _login_principal(db: Session, user: User, new_hash: str | None) -> Principal:
+    if new_hash:
+        # ленивое перехэширование: старые/«сырые» пароли обновляются при входе
+        begin_write(db)
+        user.password_hash = new_hash
+        db.commit()
+    return login_principal(db, user)
+
+
 @router.post("/token")
-def login(form: OAuth2PasswordRequestForm = Depends(), db: Session = Depends(get_db)):
+async def login(form: OAuth2PasswordRequestForm = Depends(), db: Session = Depends(get_db)):
     """
-    Упрощённая авторизация: токен = id пользователя.
+    Выдаёт подписанный токен (utils/tokens.py) с id пользователя и учреждения.
     """
-    user = db.query(User).filter(User.email == form.username).first()
-    if not user or not verify_password(form.password, user.password_hash):
+    user = await run_in_threadpool(_find_user, db, form.username)
+    verified, new_hash = (
+        await verify_and_update_async(form.password, user.password_hash) if user else (False, None)
+    )
+    if not verified:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Неверный логин или пароль")
-
-    return {"access_token": user.id, "token_type": "bearer"}
\ No newline at end of file
+    principal = await run_in_threadpool(_login_principal, db, user, new_hash)
+    token, claims = create_access_token(principal)
+    return {"access_token": token, "token_type": "bearer", "expires_in": claims["exp"] - claims["iat"]}
@@ -0,0 +1,28 @@
+# SPTOVZ/routers/catalog.py
+from fastapi import APIRouter, Depends, HTTPException, Request, Response
+from sqlalchemy.orm import Session
+
+from SPTOVZ.database import get_db
+from SPTOVZ.utils.test_bundles import CACHE_CONTROL, get_bundle
+
+router = APIRouter(prefix="/tests", tags=["Catalog"])
+
+
+@router.get("/{code}/v{version}-{digest}")
+def get_test_bundle(code: str, version: int, digest: str, request: Request, db: Session = Depends(get_db)):
+    """
+    Пакет вопросов теста. Тело неизменно для адреса (code, version, digest):
+    сильный ETag, Cache-Control: immutable, заранее сжатые gzip/br.
+    Устаревший digest — 404, клиент берёт новую ссылку из start-test.
+    """
+    bundle = get_bundle(db, code, version, digest)
+    if bundle is None:
+        raise HTTPException(status_code=404, detail="Тест не найден")
+
+    body, encoding, etag = bundle.encoded(request.headers.get("accept-encoding", ""))
+    headers = {"ETag": etag, "Cache-Control": CACHE_CONTROL, "Vary": "Accept-Encoding"}
+    if bundle.matches(request.headers.get("if-none-match", "")):
+        return Response(status_code=304, headers=headers)
+    if encoding:
+        headers["Content-Encoding"] = encoding
+    return Response(content=body, media_type="application/json", headers=headers)
@@ -1,33 +1,34 @@
 from __future__ import annotations
+import base64
+import csv
+import io
+import json
+from datetime import datetime
 from uuid import uuid4
-import secrets
-from typing import List
+from typing import Iterator, List, Literal, Optional, Tuple
 from fastapi import Query
 from SPTOVZ.models.class_group import Key
 from SPTOVZ.models.institution import Institution
-import secrets
 from fastapi import APIRouter, Depends, HTTPException
+from fastapi.responses import StreamingResponse
+from sqlalchemy import and_, or_, select
 from sqlalchemy.orm import Session
 
-from SPTOVZ.database import get_db
+from SPTOVZ.database import ReadSessionLocal, get_db, get_write_db
 from SPTOVZ.models.class_group import Class, Key
-from SPTOVZ.models.user import User
+from SPTOVZ.routers.jobs import get_own_job, job_response
 from SPTOVZ.schemas.class_key import ClassCreate, ClassOut, KeyGenerateRequest, KeyOut
-from SPTOVZ.utils.auth import get_current_user
+from SPTOVZ.utils.auth import Principal, get_current_user
+from SPTOVZ.utils.jobs import enqueue
+from SPTOVZ.utils.pdf_generator import available_formats as pdf_formats
+from SPTOVZ.utils.key_codes import MAX_EXPORT_KEYS, MAX_SYNC_KEYS, issue_keys
 
 router = APIRouter(prefix="/class", tags=["Classes"])
 
 _FORM_MAP = {"school": "A", "college": "B", "university": "C"}
 
-def _gen_code(db: Session) -> str:
-    # 10-символьный код A-Z0-9; проверяем уникальность
-    while True:
-        code = secrets.token_urlsafe(8).upper().replace("-", "")[:10]
-        if not db.query(Key).filter(Key.code == code).first():
-            return code
-
 @router.post("/create", response_model=ClassOut)
-def create_class(payload: ClassCreate, db: Session = Depends(get_db), user: User = Depends(get_current_user)):
+def create_class(payload: ClassCreate, db: Session = Depends(get_write_db), user: Principal = Depends(get_current_user)):
     """
     Создаёт класс, автоматически привязанный к пользователю и учреждению.
     """
@@ -47,7 +48,7 @@ def create_class(payload: ClassCreate, db: Session = Depends(get_db), user: User
     return new_class
 
 @router.get("/", response_model=list[ClassOut])
-def list_classes(db: Session = Depends(get_db), user: User = Depends(get_current_user)):
+def list_classes(db: Session = Depends(get_db), user: Principal = Depends(get_current_user)):
     """
     Возвращает все классы, созданные данным пользователем.
     """
@@ -56,11 +57,12 @@ def list_classes(db: Session = Depends(get_db), user: User = Depends(get_current
 
 
 @router.get("/my", response_model=List[ClassOut])
-def my_classes(db: Session = Depends(get_db), me: User = Depends(get_current_user)):
+def my_classes(db: Session = Depends(get_db), me: Principal = Depends(get_current_user)):
     classes = db.query(Class).filter(Class.teacher_id == me.id).all()
     return [ClassOut(id=c.id, name=c.name, education_type=c.education_type) for c in classes]
 
-def _generate_keys_logic(db: Session, user: User, class_id: str, count: int):
+def _resolve_key_target(db: Session, user: Principal, class_id: str):
+    """Класс пользователя, его учреждение и форма теста для выдачи ключей."""
     # Проверяем, что класс принадлежит этому пользователю
     target_class = db.query(Class).filter(
         Class.id == class_id,
@@ -87,21 +89,14 @@ def _generate_keys_logic(db: Session, user: User, class_id: str, count: int):
     if not form_type:
         raise HTTPException(status_code=400, detail="Неизвестный тип учреждения")
 
-    # Генерируем коды
-    new_keys = []
-    for _ in range(count):
-        code = secrets.token_hex(3).upper()  # 6-значный код, например "A3F91B"
-        key = Key(
-            id=str(uuid4()),
-            code=code,
-            used=False,
-            class_id=target_class.id,
-            education_type=institution.education_type,
-            form_type=form_type
-        )
-        db.add(key)
-        new_keys.append(code)
+    return target_class, institution, form_type
+
 
+def _generate_keys_logic(db: Session, user: Principal, class_id: str, count: int):
+    target_class, institution, form_type = _resolve_key_target(db, user, class_id)
+
+    # Генерируем коды: одна проверка уникальности и один INSERT на пачку
+    new_keys = issue_keys(db, target_class, institution.education_type, form_type, count)
     db.commit()
 
     return {"generated": new_keys, "form": form_type, "education_type": institution.education_type}
@@ -111,41 +106,221 @@ def _generate_keys_logic(db: Session, user: User, class_id: str, count: int):
 @router.post("/generate-keys")
 def generate_keys(
     class_id: str,
-    count: int = Query(1, ge=1, le=100),
-    db: Session = Depends(get_db),
-    user: User = Depends(get_current_user)
+    count: int = Query(1, ge=1, le=MAX_SYNC_KEYS),
+    db: Session = Depends(get_write_db),
+    user: Principal = Depends(get_current_user)
 ):
     return _generate_keys_logic(db, user, class_id, count)
 
 
+# --- Большие партии: генерация и выгрузка CSV фоновой задачей ---
+@router.post("/generate-keys/export")
+def generate_keys_export(
+    class_id: str,
+    count: int = Query(..., ge=1, le=MAX_EXPORT_KEYS),
+    db: Session = Depends(get_write_db),
+    user: Principal = Depends(get_current_user)
+):
+    target_class, institution, form_type = _resolve_key_target(db, user, class_id)
+    job = enqueue(db, "keys_export", {
+        "class_id": target_class.id,
+        "education_type": institution.education_type,
+        "form_type": form_type,
+        "count": count,
+    }, owner_id=user.id, total=count)
+    return {"export_id": job.id, "status": job.status, "url": f"/class/exports/{job.id}"}
+
+
+@router.get("/exports/{export_id}")
+def get_key_export(export_id: str, db: Session = Depends(get_db), user: Principal = Depends(get_current_user)):
+    """Статус выгрузки; когда готово — сам CSV-файл."""
+    return job_response(get_own_job(db, export_id, user))
+
+
+# --------------------- PDF-отчёты ---------------------
+
+@router.post("/reports")
+def create_pdf_report(
+    class_id: Optional[str] = None,
+    format: Literal["pdf", "zip"] = "pdf",
+    db: Session = Depends(get_write_db),
+    user: Principal = Depends(get_current_user)
+):
+    """
+    Сборка PDF-отчётов фоновой задачей: по классу (class_id) или по всем
+    классам учреждения пользователя. Результат — один PDF или zip.
+    """
+    if format not in pdf_formats():
+        raise HTTPException(status_code=503, detail=f"Формат {format} недоступен на сервере")
+    params = {"fmt": format}
+    if class_id is not None:
+        target = db.query(Class).filter(Class.id == class_id, Class.teacher_id == user.id).first()
+        if not target:
+            raise HTTPException(status_code=404, detail="Класс не найден")
+        params["class_id"] = class_id
+    else:
+        if not user.institution_id:
+            raise HTTPException(status_code=400, detail="Учреждение не определено")
+        params["institution_id"] = user.institution_id
+    job = enqueue(db, "pdf_report", params, owner_id=user.id)
+    return {"report_id": job.id, "status": job.status, "url": f"/class/reports/{job.id}"}
+
+
+@router.get("/reports/{report_id}")
+def get_pdf_report(report_id: str, db: Session = Depends(get_db), user: Principal = Depends(get_current_user)):
+    """Статус сборки; когда готово — сам файл."""
+    return job_response(get_own_job(db, report_id, user))
+
+
+# --------------------- Список ключей ---------------------
+
+KEYS_PAGE_MAX = 1000
+KEYS_EXPORT_CHUNK = 2000
+
+
+def _encode_cursor(created_at: Optional[datetime], key_id: str) -> str:
+    raw = json.dumps([created_at.isoformat() if created_at else None, key_id])
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+
+def _decode_cursor(cursor: str) -> Tuple[Optional[datetime], str]:
+    try:
+        created_at, key_id = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+        return (datetime.fromisoformat(created_at) if created_at else None), str(key_id)
+    except Exception:
+        raise HTTPException(status_code=400, detail="Некорректный cursor")
+
+
+def _keys_query(
+    user_id: str,
+    class_id: Optional[str] = None,
+    used: Optional[bool] = None,
+    form: Optional[str] = None,
+    after: Optional[Tuple[Optional[datetime], str]] = None,
+):
+    """
+    Ключи учителя с названием класса одним JOIN, в порядке выдачи
+    (created_at, id). after — позиция курсора: строго после неё.
+    """
+    q = (
+        select(Key.id, Key.code, Key.used, Key.form_type, Key.created_at, Key.class_id, Class.name)
+        .join(Class, Class.id == Key.class_id)
+        .where(Class.teacher_id == user_id)
+    )
+    if class_id:
+        q = q.where(Key.class_id == class_id)
+    if used is not None:
+        q = q.where(Key.used.is_(used))
+    if form:
+        q = q.where(Key.form_type == form)
+    if after is not None:
+        created_at, key_id = after
+        # NULL created_at (ключи до миграции) идут первыми
+        if created_at is None:
+            q = q.where(or_(
+                and_(Key.created_at.is_(None), Key.id > key_id),
+                Key.created_at.isnot(None),
+            ))
+        else:
+            q = q.where(or_(
+                Key.created_at > created_at,
+                and_(Key.created_at == created_at, Key.id > key_id),
+            ))
+    return q.order_by(Key.created_at.asc().nulls_first(), Key.id)
+
+
+def _key_item(row) -> dict:
+    return {
+        "code": row.code,
+        "class_id": row.class_id,
+        "class_name": row.name,
+        "form": row.form_type,
+        "used": bool(row.used),
+        "created_at": row.created_at.isoformat() if row.created_at else None,
+    }
+
+
 @router.get("/keys")
 def list_keys(
+    class_id: Optional[str] = None,
+    used: Optional[bool] = None,
+    form: Optional[Literal["A", "B", "C"]] = None,
+    limit: int = Query(200, ge=1, le=KEYS_PAGE_MAX),
+    cursor: Optional[str] = None,
     db: Session = Depends(get_db),
-    user: User = Depends(get_current_user)
+    user: Principal = Depends(get_current_user)
 ):
-    """Возвращает все коды, созданные этим учителем"""
-    classes = db.query(Class).filter(Class.teacher_id == user.id).all()
-    class_ids = [c.id for c in classes]
+    """
+    Коды, созданные этим учителем, страницами в порядке выдачи.
+    Следующая страница — с cursor=next_cursor (null — страниц больше нет).
+    """
+    after = _decode_cursor(cursor) if cursor else None
+    rows = db.execute(_keys_query(user.id, class_id, used, form, after).limit(limit + 1)).all()
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    return {
+        "items": [_key_item(r) for r in rows],
+        "next_cursor": _encode_cursor(rows[-1].created_at, rows[-1].id) if has_more else None,
+    }
 
-    keys = db.query(Key).filter(Key.class_id.in_(class_ids)).all()
 
-    return [
-        {
-            "code": k.code,
-            "class_name": next((c.name for c in classes if c.id == k.class_id), "—"),
-            "form": k.form_type,
-            "used": k.used,
-        }
-        for k in keys
-    ]
+def _stream_keys(user_id: str, class_id, used, form, fmt: str) -> Iterator[str]:
+    """
+    Генератор выгрузки: своя сессия (живёт, пока отдаётся ответ),
+    строки читаются курсором порциями, в памяти — только текущая порция.
+    """
+    with ReadSessionLocal() as db:
+        result = db.execute(
+            _keys_query(user_id, class_id, used, form).execution_options(
+                stream_results=True, yield_per=KEYS_EXPORT_CHUNK,
+            )
+        )
+        if fmt == "csv":
+            buf = io.StringIO()
+            writer = csv.writer(buf)
+            writer.writerow(["code", "class_name", "form", "used", "created_at"])
+            for rows in result.partitions():
+                for r in rows:
+                    item = _key_item(r)
+                    writer.writerow([item["code"], item["class_name"], item["form"], int(item["used"]), item["created_at"] or ""])
+                yield buf.getvalue()
+                buf.seek(0)
+                buf.truncate()
+            if buf.tell():
+                yield buf.getvalue()
+        else:
+            yield "["
+            first = True
+            for rows in result.partitions():
+                chunk = ",".join(json.dumps(_key_item(r), ensure_ascii=False) for r in rows)
+                yield chunk if first else "," + chunk
+                first = False
+            yield "]"
+
+
+@router.get("/keys/export")
+def export_keys(
+    format: Literal["csv", "json"] = "csv",
+    class_id: Optional[str] = None,
+    used: Optional[bool] = None,
+    form: Optional[Literal["A", "B", "C"]] = None,
+    user: Principal = Depends(get_current_user)
+):
+    """Полная выгрузка ключей потоком (CSV или JSON-массив), без сборки списка в памяти."""
+    media_type = "text/csv; charset=utf-8" if format == "csv" else "application/json"
+    return StreamingResponse(
+        _stream_keys(user.id, class_id, used, form, format),
+        media_type=media_type,
+        headers={"Content-Disposition": f'attachment; filename="keys.{format}"'},
+    )
 
 
 # --- Старый путь для совместимости ---
 @router.post("/keys/generate")
 def generate_keys_alias(
     class_id: str,
-    count: int = 1,
-    db: Session = Depends(get_db),
-    user: User = Depends(get_current_user)
+    count: int = Query(1, ge=1, le=MAX_SYNC_KEYS),
+    db: Session = Depends(get_write_db),
+    user: Principal = Depends(get_current_user)
 ):
     return _generate_keys_logic(db, user, class_id, count)
\ No newline at end of file
@@ -0,0 +1,59 @@
+from typing import Optional
+
+from fastapi import APIRouter, Depends, HTTPException, Query
+from fastapi.responses import FileResponse
+from sqlalchemy import select
+from sqlalchemy.orm import Session
+
+from SPTOVZ.database import get_db, get_write_db
+from SPTOVZ.models.job import Job
+from SPTOVZ.utils.auth import Principal, get_current_user
+from SPTOVZ.utils.jobs import cancel_job, job_file, job_status
+
+router = APIRouter(prefix="/jobs", tags=["Jobs"])
+
+
+def get_own_job(db: Session, job_id: str, user: Principal) -> Job:
+    job = db.get(Job, job_id)
+    if not job or job.owner_id != user.id:
+        raise HTTPException(status_code=404, detail="Задача не найдена")
+    return job
+
+
+def job_response(job: Job):
+    """Статус задачи; когда готово и есть файл — сам файл."""
+    path = job_file(job)
+    if path is not None:
+        return FileResponse(path, media_type=job.result.get("media_type"), filename=path.name)
+    return job_status(job)
+
+
+@router.get("/")
+def list_jobs(
+    status: Optional[str] = None,
+    limit: int = Query(20, ge=1, le=200),
+    db: Session = Depends(get_db),
+    user: Principal = Depends(get_current_user),
+):
+    q = select(Job).where(Job.owner_id == user.id).order_by(Job.created_at.desc()).limit(limit)
+    if status:
+        q = q.where(Job.status == status)
+    return [job_status(job) for job in db.scalars(q)]
+
+
+@router.get("/{job_id}")
+def get_job(job_id: str, db: Session = Depends(get_db), user: Principal = Depends(get_current_user)):
+    return job_status(get_own_job(db, job_id, user))
+
+
+@router.get("/{job_id}/file")
+def get_job_file(job_id: str, db: Session = Depends(get_db), user: Principal = Depends(get_current_user)):
+    job = get_own_job(db, job_id, user)
+    if job_file(job) is None:
+        raise HTTPException(status_code=409, detail=f"Файл ещё не готов (статус: {job.status})")
+    return job_response(job)
+
+
+@router.post("/{job_id}/cancel")
+def cancel(job_id: str, db: Session = Depends(get_write_db), user: Principal = Depends(get_current_user)):
+    return job_status(cancel_job(db, get_own_job(db, job_id, user)))
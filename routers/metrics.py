@@ -0,0 +1,66 @@
+import os
+from typing import Any, Dict, Iterable, Optional
+
+from fastapi import APIRouter, Header, HTTPException
+from fastapi.responses import PlainTextResponse
+
+from SPTOVZ import database
+from SPTOVZ.routers import session
+from SPTOVZ.utils import jobs
+from SPTOVZ.utils.auth import hash_pool_stats, principal_cache
+from SPTOVZ.utils.emspt_engine import scoring_config_stats
+from SPTOVZ.utils.metrics import Gauge, register_collector, render_metrics
+from SPTOVZ.utils.test_catalog import current_catalog_index
+
+router = APIRouter(tags=["Metrics"])
+
+# Если задан — /metrics только с заголовком Authorization: Bearer <METRICS_TOKEN>
+METRICS_TOKEN = os.getenv("METRICS_TOKEN")
+
+
+def _numeric(prefix: str, help: str, snapshot: Dict[str, Any], labels: Optional[Dict[str, Any]] = None) -> Iterable[Gauge]:
+    """Числовые поля snapshot() → отдельные gauge prefix_<поле>."""
+    for key, value in snapshot.items():
+        if isinstance(value, bool):
+            value = int(value)
+        if isinstance(value, (int, float)):
+            yield f"{prefix}_{key}", f"{help}: {key}", [(labels or {}, value)]
+
+
+def _collect() -> Iterable[Gauge]:
+    engines = {"sync": database.engine}
+    if database.async_engine is not None:
+        engines["async"] = database.async_engine
+    for name, bind in engines.items():
+        yield from _numeric("sptovz_db_pool", "Пул соединений", database.pool_status(bind), {"engine": name})
+
+    yield from _numeric("sptovz_hash_pool", "Пул bcrypt", hash_pool_stats())
+    yield from _numeric("sptovz_principal_cache", "Кэш старых токенов", principal_cache.snapshot())
+    yield from _numeric("sptovz_emspt_configs", "Конфигурации ЕМ СПТ", scoring_config_stats())
+
+    index = current_catalog_index()
+    if index is not None:
+        yield "sptovz_catalog_version", "Версия индекса каталога тестов", [({}, index.version)]
+        yield "sptovz_catalog_tests", "Тестов в индексе каталога", [({}, len(index.by_code))]
+
+    writer = session.submit_writer.snapshot()
+    if writer["batches"] or writer["running"]:
+        yield from _numeric("sptovz_group_commit", "Групповая фиксация submit-answers", writer)
+
+    if jobs.worker is not None:
+        snap = jobs.worker.snapshot()
+        yield "sptovz_jobs_running", "Выполняемые задачи воркера", [({}, snap["running"])]
+        yield "sptovz_jobs_concurrency", "Потоков воркера задач", [({}, snap["concurrency"])]
+        yield "sptovz_jobs_finished", "Завершённые воркером задачи", [
+            ({"status": status}, count) for status, count in snap["finished"].items()
+        ]
+
+
+register_collector(_collect)
+
+
+@router.get("/metrics", response_class=PlainTextResponse, include_in_schema=False)
+def metrics(authorization: Optional[str] = Header(None)):
+    if METRICS_TOKEN and authorization != f"Bearer {METRICS_TOKEN}":
+        raise HTTPException(status_code=401, detail="Нужен токен метрик")
+    return PlainTextResponse(render_metrics(), media_type="text/plain; version=0.0.4; charset=utf-8")
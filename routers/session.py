@@ -1,30 +1,43 @@
 from __future__ import annotations
+import asyncio
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+from dataclasses import dataclass
 from datetime import datetime
 from uuid import uuid4
-from typing import Any, Dict
+from typing import Any, Dict, Optional
 from fastapi.responses import HTMLResponse
 from fastapi.templating import Jinja2Templates
 from fastapi import Request
 from fastapi import APIRouter, Depends, HTTPException
+from sqlalchemy import select, update
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
-from datetime import datetime
-from SPTOVZ.database import get_db
+from SPTOVZ.database import READ_TX, get_async_db, get_async_write_db, get_db, get_write_db
 from SPTOVZ.models.class_group import Key, Class
-from SPTOVZ.models.session import TestSession
-from SPTOVZ.models.testbank import TestContent
-from SPTOVZ.schemas.session import StartTestRequest, StartTestResponse
+from SPTOVZ.models.session import TestSession, decode_result, encode_result, pack_answers, result_columns
+from SPTOVZ.schemas.session import (
+    AnswerItem, AnswersPatch, SavedAnswers, StartTestRequest, StartTestResponse,
+    SubmitAnswersRequest, TestBundleRef,
+)
+from SPTOVZ.utils.answer_store import append_batch, clear_answers, load_answers
+from SPTOVZ.utils.test_catalog import CatalogEntry, catalog_index
 from SPTOVZ.utils.test_selector import select_test
+from SPTOVZ.utils.test_bundles import bundle_for
 from SPTOVZ.utils.emspt_engine import compute_emspt, Profile
+from SPTOVZ.utils.group_commit import GROUP_COMMIT, GROUP_COMMIT_TIMEOUT_S, GroupCommitWriter
+from SPTOVZ.utils.stats_rollup import Bucket, record_finished
 
 templates = Jinja2Templates(directory="SPTOVZ/templates")
 
 router = APIRouter(prefix="/session", tags=["Session"])
+# Те же эндпоинты поверх AsyncSession (DB_ASYNC=1): логика общая,
+# синхронный код выполняется через AsyncSession.run_sync без потоков пула
+async_router = APIRouter(prefix="/session", tags=["Session"])
 
 def _norm(s: str) -> str:
     return (s or "").strip().lower()
 
-@router.post("/start-test", response_model=StartTestResponse)
-def start_test(payload: StartTestRequest, db: Session = Depends(get_db)) -> StartTestResponse:
+def _start_test(db: Session, payload: StartTestRequest) -> StartTestResponse:
     key: Key | None = db.query(Key).filter(Key.code == payload.code).first()
     if not key:
         raise HTTPException(status_code=404, detail="Неверный код доступа")
@@ -46,7 +59,7 @@ def start_test(payload: StartTestRequest, db: Session = Depends(get_db)) -> Star
     impairment = _norm(payload.diagnosis)           # hearing|vision|motor
 
     try:
-        passport, content = select_test(db, institution=institution, impairment=impairment)
+        entry = select_test(db, institution=institution, impairment=impairment)
     except ValueError as e:
         raise HTTPException(status_code=404, detail=str(e))
 
@@ -57,7 +70,7 @@ def start_test(payload: StartTestRequest, db: Session = Depends(get_db)) -> Star
         gender=_norm(payload.gender), # ✅ исправлено
         diagnosis=impairment,
         form_type=key.form_type,
-        test_name=passport.id,        # meta.code
+        test_name=entry.code,         # meta.code
         started_at=datetime.utcnow(),
         answers=None,
         result=None,
@@ -68,92 +81,300 @@ def start_test(payload: StartTestRequest, db: Session = Depends(get_db)) -> Star
     db.commit()
     db.refresh(session)
 
+    # Вопросы не встраиваем: клиент берёт их по ссылке из кэша браузера/прокси
+    bundle = bundle_for(entry)
     return StartTestResponse(
         session_id=session.id,
-        test_name=passport.title,
-        form_type=key.form_type,
-        questions=content.questions,
+        bundle=TestBundleRef(code=bundle.code, version=bundle.version, url=bundle.url, etag=bundle.etag),
     )
 
 
-@router.post("/submit-answers")
-def submit_answers(payload: Dict[str, Any], db: Session = Depends(get_db)):
-    session_id = payload.get("session_id")
-    answers_raw = payload.get("answers")
-    if not session_id or not answers_raw:
-        raise HTTPException(status_code=400, detail="session_id и answers обязательны")
-
-    session = db.get(TestSession, session_id)
-    if not session:
-        raise HTTPException(status_code=404, detail="Сессия не найдена")
+def _check_question_ids(entry: CatalogEntry, answers: Dict[int, int]) -> None:
+    unknown = set(answers) - entry.question_ids
+    if entry.question_ids and unknown:
+        raise HTTPException(status_code=400, detail=f"Вопросов нет в тесте: {sorted(unknown)[:10]}")
 
-    # --- Преобразуем ответы ---
-    answers_map = {int(a["id"]): int(a["value"]) for a in answers_raw}
 
-    session.answers = answers_map
-    db.commit()
+@dataclass(frozen=True)
+class PreparedSubmission:
+    """Проверенная и посчитанная отправка: всё, что нужно для записи."""
+    session_id: str
+    key_id: Optional[str]
+    answers: Dict[int, int]
+    result: Dict[str, Any]
+    columns: Dict[str, Any]      # упакованные ответы и столбцы результата TestSession
+    finished_at: datetime
+    bucket: Optional[Bucket]     # корзина stats_rollup; None — класс без учреждения
 
-    content = db.query(TestContent).filter_by(id=session.test_name).first()
-    if not content:
-        raise HTTPException(status_code=500, detail=f"Контент теста '{session.test_name}' не найден")
 
-    profile = Profile(
-        form=session.form_type,
-        impairment=session.diagnosis,
-        gender=session.gender,
-    )
+def _prepare_submission(db: Session, payload: SubmitAnswersRequest) -> PreparedSubmission:
+    """
+    Чтение сессии вместе с классом ключа, проверка по каталогу в памяти
+    и расчёт. Ответы — автосохранённые порции, дополненные присланными
+    (присланные важнее). Ничего не пишет; транзакция чтения открывается
+    как DEFERRED и закрывается здесь же, чтобы не держать блокировку записи SQLite.
+    """
+    session_id = payload.session_id
+    answers_map = {a.id: a.value for a in payload.answers}
 
-    computed = compute_emspt(
-        answers_map=answers_map,
-        profile=profile,
+    db.connection(execution_options=READ_TX)
+    try:
+        row = db.execute(
+            select(
+                TestSession.key_id, TestSession.form_type, TestSession.diagnosis, TestSession.gender,
+                TestSession.test_name, TestSession.finished_at, Key.class_id, Class.institution_id,
+            )
+            .outerjoin(Key, Key.id == TestSession.key_id)
+            .outerjoin(Class, Class.id == Key.class_id)
+            .where(TestSession.id == session_id)
+        ).first()
+        # Содержимое теста — из индекса каталога в памяти, без запроса к test_contents
+        entry = catalog_index(db).by_code.get(row.test_name) if row else None
+        # Порции автосохранения читаем, только если присланы не все ответы
+        if row and row.finished_at is None and (not answers_map or (entry and set(answers_map) < entry.question_ids)):
+            stored, _ = load_answers(db, session_id)
+            answers_map = {**stored, **answers_map}
+    finally:
+        db.rollback()
+    if not row:
+        raise HTTPException(status_code=404, detail="Сессия не найдена")
+    if row.finished_at is not None:
+        raise HTTPException(status_code=409, detail="Ответы по этой сессии уже приняты")
+    if entry is None:
+        raise HTTPException(status_code=500, detail=f"Контент теста '{row.test_name}' не найден")
+    if not answers_map:
+        raise HTTPException(status_code=400, detail="Нет ни присланных, ни сохранённых ответов")
+    _check_question_ids(entry, answers_map)
+
+    profile = Profile(form=row.form_type, impairment=row.diagnosis, gender=row.gender)
+    computed = compute_emspt(answers_map=answers_map, profile=profile)
+    finished_at = datetime.utcnow()
+    bucket = (
+        (row.institution_id, row.class_id, row.form_type, row.diagnosis or "", row.gender or "", finished_at.date())
+        if row.institution_id else None
+    )
+    return PreparedSubmission(
+        session_id=session_id,
+        key_id=row.key_id,
+        answers=answers_map,
+        result=computed,
+        columns={
+            "answers_packed": pack_answers(answers_map, size=max(entry.question_ids, default=0)),
+            **encode_result(computed, row.form_type),
+        },
+        finished_at=finished_at,
+        bucket=bucket,
     )
 
-    session.result = computed
 
-    key = db.query(Key).filter(Key.id == session.key_id).first()
-    if key:
-        key.used = True
+def _write_submission(db: Session, sub: PreparedSubmission) -> None:
+    """
+    Запись отправки без COMMIT: UPDATE сессии с RETURNING, UPDATE ключа,
+    дельта статистики и удаление порций автосохранения. Обе записи условные (finished_at IS NULL, used не true):
+    из двух одновременных отправок проходит одна, вторая получает 409.
+    Вызывающий откатывает транзакцию (или точку сохранения) при исключении.
+    """
+    updated = db.execute(
+        update(TestSession)
+        .where(TestSession.id == sub.session_id, TestSession.finished_at.is_(None))
+        .values(finished_at=sub.finished_at, **sub.columns)
+        .returning(TestSession.id)
+        .execution_options(synchronize_session=False)
+    ).first()
+    if updated is None:
+        raise HTTPException(status_code=409, detail="Ответы по этой сессии уже приняты")
+
+    if sub.key_id is not None:
+        key_marked = db.execute(
+            update(Key)
+            .where(Key.id == sub.key_id, Key.used.is_not(True))
+            .values(used=True)
+            .returning(Key.id)
+            .execution_options(synchronize_session=False)
+        ).first()
+        if key_marked is None:
+            # ключ уже израсходован другой сессией
+            raise HTTPException(status_code=409, detail="Этот код уже использован")
+
+    # Агрегаты статистики — в той же транзакции
+    if sub.bucket is not None:
+        record_finished(db, sub.bucket, sub.columns["irp_interval"], sub.columns["kveripo_interval"])
+    # Порции удаляются всегда: при полной отправке они не читались,
+    # но могли остаться от PATCH во время теста
+    clear_answers(db, sub.session_id)
+
+
+# Режим group commit (SUBMIT_GROUP_COMMIT=1): записи нескольких отправок — один COMMIT
+submit_writer = GroupCommitWriter(_write_submission, name="submit-writer")
 
-    session.finished_at = datetime.utcnow()
-    db.commit()
 
+def _submission_response(sub: PreparedSubmission) -> Dict[str, Any]:
     return {
-        "session_id": session.id,
+        "session_id": sub.session_id,
         "saved": True,
-        "questions": len(answers_map),
+        "questions": len(sub.answers),
         "computed": True,
-        "result": computed,
+        "result": sub.result,
     }
 
-import json
 
-@router.get("/result/{session_id}", response_class=HTMLResponse)
-def get_test_result(request: Request, session_id: str, db: Session = Depends(get_db)):
-    session = db.get(TestSession, session_id)
-    if not session:
+def _submit_answers(db: Session, payload: SubmitAnswersRequest) -> Dict[str, Any]:
+    """Отправка ответов одной транзакцией: чтение, расчёт, условные записи, один COMMIT."""
+    sub = _prepare_submission(db, payload)
+    try:
+        _write_submission(db, sub)
+    except BaseException:
+        db.rollback()
+        raise
+    db.commit()
+    return _submission_response(sub)
+
+
+def _commit_timeout(future: Future) -> HTTPException:
+    """
+    503 по истечении GROUP_COMMIT_TIMEOUT_S. Запись, которую писатель ещё не взял,
+    отменяется — повтор безопасен; взятая может ещё зафиксироваться, и тогда
+    повтор получит 409 за принятые ответы — об этом говорит detail.
+    """
+    if future.cancel():
+        detail = "Ответы не записаны: сервер перегружен, повторите отправку через несколько секунд"
+    else:
+        detail = "Ответы ещё записываются и, возможно, будут приняты: проверьте результат перед повтором"
+    return HTTPException(status_code=503, detail=detail, headers={"Retry-After": "2"})
+
+
+def _submit_grouped(db: Session, payload: SubmitAnswersRequest) -> Dict[str, Any]:
+    sub = _prepare_submission(db, payload)
+    # 200 — только после COMMIT пачки, в которую попала запись
+    future = submit_writer.submit(sub)
+    try:
+        future.result(timeout=GROUP_COMMIT_TIMEOUT_S)
+    except FutureTimeoutError:
+        raise _commit_timeout(future) from None
+    return _submission_response(sub)
+
+
+def _save_answers(db: Session, session_id: str, patch: AnswersPatch) -> Dict[str, Any]:
+    """Автосохранение порции ответов: проверка сессии и одна вставка."""
+    row = db.execute(
+        select(TestSession.test_name, TestSession.finished_at).where(TestSession.id == session_id)
+    ).first()
+    if not row:
         raise HTTPException(status_code=404, detail="Сессия не найдена")
-    if not session.result:
-        raise HTTPException(status_code=400, detail="Результаты ещё не рассчитаны")
+    if row.finished_at is not None:
+        raise HTTPException(status_code=409, detail="Ответы по этой сессии уже приняты")
+    answers = {a.id: a.value for a in patch.answers}
+    entry = catalog_index(db).by_code.get(row.test_name)
+    if entry is not None:
+        _check_question_ids(entry, answers)
+    inserted = append_batch(db, session_id, patch.seq, answers)
+    db.commit()
+    return {"session_id": session_id, "seq": patch.seq, "saved": len(answers), "duplicate": not inserted}
+
+
+def _saved_answers(db: Session, session_id: str) -> SavedAnswers:
+    """Сохранённые ответы — чтобы продолжить тест после перезагрузки страницы."""
+    try:
+        finished_at = db.execute(
+            select(TestSession.finished_at).where(TestSession.id == session_id)
+        ).first()
+        if finished_at is None:
+            raise HTTPException(status_code=404, detail="Сессия не найдена")
+        answers, next_seq = load_answers(db, session_id)
+    finally:
+        db.rollback()
+    return SavedAnswers(
+        session_id=session_id,
+        finished=finished_at[0] is not None,
+        answers=[AnswerItem(id=qid, value=value) for qid, value in sorted(answers.items())],
+        next_seq=next_seq,
+    )
 
-    # 🔧 Распаковываем JSON, если это строка
-    result = session.result
-    if isinstance(result, str):
-        result = json.loads(result)
+
+def _result_context(db: Session, session_id: str) -> Dict[str, Any]:
+    row = db.execute(select(*result_columns()).where(TestSession.id == session_id)).first()
+    if not row:
+        raise HTTPException(status_code=404, detail="Сессия не найдена")
+    result = decode_result(*row)
+    if not result:
+        raise HTTPException(status_code=400, detail="Результаты ещё не рассчитаны")
 
     sten_data = result.get("sten", {})
     profile = result.get("profile", {})
 
-    return templates.TemplateResponse(
-        "result_page.html",
-        {
-            "request": request,
-            "session_id": session_id,
-            "sten_data": sten_data,
-            "profile": profile,
-            "irp": result.get("irp"),
-            "irp_interval": result.get("irp_interval"),
-            "kveripo": result.get("kveripo"),
-            "kveripo_interval": result.get("kveripo_interval"),
-        },
-    )
+    return {
+        "session_id": session_id,
+        "sten_data": sten_data,
+        "profile": profile,
+        "irp": result.get("irp"),
+        "irp_interval": result.get("irp_interval"),
+        "kveripo": result.get("kveripo"),
+        "kveripo_interval": result.get("kveripo_interval"),
+    }
+
+
+# --------------------- Синхронные эндпоинты ---------------------
+
+@router.post("/start-test", response_model=StartTestResponse)
+def start_test(payload: StartTestRequest, db: Session = Depends(get_write_db)) -> StartTestResponse:
+    return _start_test(db, payload)
+
+
+@router.post("/submit-answers")
+def submit_answers(payload: SubmitAnswersRequest, db: Session = Depends(get_write_db)):
+    if GROUP_COMMIT:
+        return _submit_grouped(db, payload)
+    return _submit_answers(db, payload)
+
+
+@router.patch("/{session_id}/answers")
+def save_answers(session_id: str, patch: AnswersPatch, db: Session = Depends(get_write_db)):
+    return _save_answers(db, session_id, patch)
+
+
+@router.get("/{session_id}/answers", response_model=SavedAnswers)
+def get_saved_answers(session_id: str, db: Session = Depends(get_db)) -> SavedAnswers:
+    return _saved_answers(db, session_id)
+
+
+@router.get("/result/{session_id}", response_class=HTMLResponse)
+def get_test_result(request: Request, session_id: str, db: Session = Depends(get_db)):
+    context = _result_context(db, session_id)
+    return templates.TemplateResponse("result_page.html", {"request": request, **context})
+
+
+# --------------------- Асинхронные эндпоинты ---------------------
+
+@async_router.post("/start-test", response_model=StartTestResponse)
+async def start_test_async(payload: StartTestRequest, db: AsyncSession = Depends(get_async_write_db)) -> StartTestResponse:
+    return await db.run_sync(_start_test, payload)
+
+
+@async_router.post("/submit-answers")
+async def submit_answers_async(payload: SubmitAnswersRequest, db: AsyncSession = Depends(get_async_write_db)):
+    if GROUP_COMMIT:
+        sub = await db.run_sync(_prepare_submission, payload)
+        future = submit_writer.submit(sub)
+        try:
+            # shield: по таймауту wait_for не отменяет Future сам — это решает _commit_timeout
+            await asyncio.wait_for(asyncio.shield(asyncio.wrap_future(future)), GROUP_COMMIT_TIMEOUT_S)
+        except asyncio.TimeoutError:
+            raise _commit_timeout(future) from None
+        return _submission_response(sub)
+    return await db.run_sync(_submit_answers, payload)
+
+
+@async_router.patch("/{session_id}/answers")
+async def save_answers_async(session_id: str, patch: AnswersPatch, db: AsyncSession = Depends(get_async_write_db)):
+    return await db.run_sync(_save_answers, session_id, patch)
+
+
+@async_router.get("/{session_id}/answers", response_model=SavedAnswers)
+async def get_saved_answers_async(session_id: str, db: AsyncSession = Depends(get_async_db)) -> SavedAnswers:
+    return await db.run_sync(_saved_answers, session_id)
+
 
+@async_router.get("/result/{session_id}", response_class=HTMLResponse)
+async def get_test_result_async(request: Request, session_id: str, db: AsyncSession = Depends(get_async_db)):
+    context = await db.run_sync(_result_context, session_id)
+    return templates.TemplateResponse("result_page.html", {"request": request, **context})
@@ -1,12 +1,20 @@
 # SPTOVZ/routers/stats.py
+from datetime import date
+from typing import Optional
+
 from fastapi import APIRouter, Depends, HTTPException
-from sqlalchemy import func, select
+from fastapi.responses import StreamingResponse
+from sqlalchemy import func
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
-import json
 
-from SPTOVZ.database import get_db
+from SPTOVZ.database import ReadSessionLocal, get_db, get_async_db
 from SPTOVZ.routers.auth import get_current_user
-from SPTOVZ.models import User, Key, TestSession
+from SPTOVZ.utils.auth import Principal, get_current_user_async
+from SPTOVZ.models import StatsRollup
+from SPTOVZ.utils.emspt_engine import normalize_level
+from SPTOVZ.utils.stats_rollup import COUNTER_COLUMNS, IRP_COLUMNS, KVERIPO_COLUMNS
+from SPTOVZ.utils.session_export import MEDIA_TYPES, ExportFilter, available_formats, stream_export
 
 # Попытка импортировать модель класса (Class / SchoolClass)
 SchoolClassModel = None
@@ -20,6 +28,7 @@ except Exception:
 
 
 router = APIRouter(prefix="/stats", tags=["Stats"])
+async_router = APIRouter(prefix="/stats", tags=["Stats"])
 
 # ------------------------------------------------------------
 # Константы уровней
@@ -39,21 +48,9 @@ def normalize(rows, levels):
     total = 0
 
     for lvl, cnt in rows:
-        if not lvl:
-            continue
-        lvl = str(lvl).strip().lower()
-
-        # Унификация формулировок
-        if "высочай" in lvl:
-            lvl = "высокий"
-        elif "высок" in lvl or "выше" in lvl:
-            lvl = "высокий"
-        elif "сред" in lvl or "норм" in lvl:
-            lvl = "средний"
-        elif "низ" in lvl or "ниже" in lvl:
-            lvl = "низкий"
-        else:
-            # неизвестные значения пропускаем
+        lvl = normalize_level(lvl)
+        if lvl is None:
+            # пустые и неизвестные значения пропускаем
             continue
 
         try:
@@ -69,46 +66,31 @@ def normalize(rows, levels):
     return {lvl: round(counts[lvl] * 100.0 / total, 2) for lvl in levels}
 
 
-def keys_subquery_for_institution(db: Session, institution_id: int):
-    """
-    Возвращает подзапрос с id ключей, принадлежащих учреждению.
-    Поддерживает:
-      1) Key.institution_id
-      2) Key.class_id -> Class.institution_id
-    """
-    if hasattr(Key, "institution_id"):
-        return db.query(Key.id).filter(Key.institution_id == institution_id).subquery()
-
-    if (
-        SchoolClassModel is not None
-        and hasattr(Key, "class_id")
-        and hasattr(SchoolClassModel, "institution_id")
-    ):
-        return (
-            db.query(Key.id)
-            .join(SchoolClassModel, Key.class_id == SchoolClassModel.id)
-            .filter(SchoolClassModel.institution_id == institution_id)
-            .subquery()
-        )
+def _rollup_sums():
+    """SUM(...) по счётчикам stats_rollup в порядке COUNTER_COLUMNS."""
+    return [func.coalesce(func.sum(getattr(StatsRollup, col)), 0) for col in COUNTER_COLUMNS]
 
-    raise HTTPException(
-        status_code=500,
-        detail=(
-            "Не удалось определить связь Key с учреждением. "
-            "Добавьте на Key поле institution_id ИЛИ используйте связь "
-            "Key.class_id → Class.institution_id."
+
+def _stats_payload(sums) -> dict:
+    """Ответ /stats/* по строке сумм из _rollup_sums()."""
+    c = dict(zip(COUNTER_COLUMNS, (int(v or 0) for v in sums)))
+    return {
+        "total": c["keys_total"],
+        "completed": c["completed"],
+        "remaining": max(c["keys_total"] - c["completed"], 0),
+        "irp_distribution": normalize(
+            [(lvl, c[col]) for lvl, col in IRP_COLUMNS.items()], IRP_LEVELS
         ),
-    )
+        "kveripo_distribution": normalize(
+            [(lvl, c[col]) for lvl, col in KVERIPO_COLUMNS.items()], KVERIPO_LEVELS
+        ),
+    }
 
 
 # ------------------------------------------------------------
-# Основной эндпоинт
+# Запросы (читают только агрегаты stats_rollup)
 # ------------------------------------------------------------
-@router.get("/summary")
-def get_summary(
-    db: Session = Depends(get_db),
-    user: User = Depends(get_current_user),
-):
+def _summary(db: Session, user: Principal) -> dict:
     """
     Возвращает статистику по учреждению текущего пользователя:
     - всего ключей
@@ -127,64 +109,170 @@ def get_summary(
             "kveripo_distribution": {k: 0 for k in KVERIPO_LEVELS},
         }
 
-    # --- Ключи учреждения ---
-    keys_sq = keys_subquery_for_institution(db, inst_id)
+    row = (
+        db.query(*_rollup_sums())
+        .filter(StatsRollup.institution_id == inst_id)
+        .one()
+    )
 
-    # --- Количество ключей и сессий ---
-    total_keys = db.query(func.count()).select_from(keys_sq).scalar() or 0
+    # --- Название учреждения ---
+    institution_label = user.institution_name or f"ID {inst_id}"
 
-    completed = (
-        db.query(func.count(TestSession.id))
-        .filter(TestSession.finished_at.isnot(None))
-        .filter(TestSession.key_id.in_(select(keys_sq.c.id)))
-        .scalar()
-        or 0
-    )
-    remaining = max(total_keys - completed, 0)
+    # --- Итоговый ответ ---
+    return {"institution": institution_label, **_stats_payload(row)}
+
+
+def _class_stats(db: Session, user: Principal) -> list:
+    """Статистика по каждому классу учреждения (по агрегатам stats_rollup)."""
+    inst_id = getattr(user, "institution_id", None)
+    if inst_id is None:
+        return []
 
-    # --- Извлекаем результаты и считаем уровни ---
-    sess_results = (
-        db.query(TestSession.result)
-        .filter(TestSession.finished_at.isnot(None))
-        .filter(TestSession.key_id.in_(select(keys_sq.c.id)))
+    rows = (
+        db.query(SchoolClassModel.id, SchoolClassModel.name, *_rollup_sums())
+        .outerjoin(StatsRollup, StatsRollup.class_id == SchoolClassModel.id)
+        .filter(SchoolClassModel.institution_id == inst_id)
+        .group_by(SchoolClassModel.id, SchoolClassModel.name)
+        .order_by(SchoolClassModel.name)
         .all()
     )
+    return [
+        {"class_id": class_id, "class_name": name, **_stats_payload(sums)}
+        for class_id, name, *sums in rows
+    ]
 
-    irp_rows = []
-    kveripo_rows = []
 
-    for (res,) in sess_results:
-        obj = None
-        if isinstance(res, dict):
-            obj = res
-        else:
-            try:
-                obj = json.loads(res) if isinstance(res, str) else None
-            except Exception:
-                obj = None
+def _period_stats(
+    db: Session,
+    user: Principal,
+    date_from: Optional[date] = None,
+    date_to: Optional[date] = None,
+    class_id: Optional[str] = None,
+) -> list:
+    """Статистика учреждения по дням (ключи — по дню выдачи, сессии — по дню завершения)."""
+    inst_id = getattr(user, "institution_id", None)
+    if inst_id is None:
+        return []
 
-        if not obj:
-            continue
+    q = db.query(StatsRollup.day, *_rollup_sums()).filter(StatsRollup.institution_id == inst_id)
+    if date_from is not None:
+        q = q.filter(StatsRollup.day >= date_from)
+    if date_to is not None:
+        q = q.filter(StatsRollup.day <= date_to)
+    if class_id is not None:
+        q = q.filter(StatsRollup.class_id == class_id)
 
-        irp_lvl = str(obj.get("irp_interval", "")).strip().lower()
-        kver_lvl = str(obj.get("kveripo_interval", "")).strip().lower()
+    rows = q.group_by(StatsRollup.day).order_by(StatsRollup.day).all()
+    return [{"day": day.isoformat(), **_stats_payload(sums)} for day, *sums in rows]
 
-        if irp_lvl:
-            irp_rows.append((irp_lvl, 1))
-        if kver_lvl:
-            kveripo_rows.append((kver_lvl, 1))
 
-    # --- Название учреждения ---
-    institution_label = f"ID {inst_id}"
-    if hasattr(user, "institution") and getattr(user, "institution") is not None:
-        institution_label = getattr(user.institution, "name", institution_label)
+@router.get("/summary")
+def get_summary(
+    db: Session = Depends(get_db),
+    user: Principal = Depends(get_current_user),
+):
+    return _summary(db, user)
 
-    # --- Итоговый ответ ---
-    return {
-        "institution": institution_label,
-        "total": int(total_keys),
-        "completed": int(completed),
-        "remaining": int(remaining),
-        "irp_distribution": normalize(irp_rows, IRP_LEVELS),
-        "kveripo_distribution": normalize(kveripo_rows, KVERIPO_LEVELS),
-    }
+
+@router.get("/classes")
+def get_class_stats(
+    db: Session = Depends(get_db),
+    user: Principal = Depends(get_current_user),
+):
+    return _class_stats(db, user)
+
+
+@router.get("/periods")
+def get_period_stats(
+    date_from: Optional[date] = None,
+    date_to: Optional[date] = None,
+    class_id: Optional[str] = None,
+    db: Session = Depends(get_db),
+    user: Principal = Depends(get_current_user),
+):
+    return _period_stats(db, user, date_from, date_to, class_id)
+
+
+# ------------------------------------------------------------
+# Выгрузка сессий (потоком, своя сессия БД на время ответа)
+# ------------------------------------------------------------
+def _export_sessions(
+    user: Principal,
+    format: str,
+    date_from: Optional[date],
+    date_to: Optional[date],
+    class_id: Optional[str],
+) -> StreamingResponse:
+    """Завершённые сессии учреждения пользователя — CSV, Parquet или Arrow."""
+    inst_id = getattr(user, "institution_id", None)
+    if inst_id is None:
+        raise HTTPException(status_code=403, detail="Пользователь не привязан к учреждению")
+    if format not in available_formats():
+        raise HTTPException(
+            status_code=400,
+            detail=f"Формат {format} недоступен, доступны: {', '.join(available_formats())}",
+        )
+    flt = ExportFilter(institution_id=inst_id, class_id=class_id, date_from=date_from, date_to=date_to)
+
+    def body():
+        with ReadSessionLocal() as db:
+            yield from stream_export(db, flt, format)
+
+    return StreamingResponse(
+        body(),
+        media_type=MEDIA_TYPES[format],
+        headers={"Content-Disposition": f'attachment; filename="sessions.{format}"'},
+    )
+
+
+@router.get("/export/sessions")
+def export_sessions(
+    format: str = "csv",
+    date_from: Optional[date] = None,
+    date_to: Optional[date] = None,
+    class_id: Optional[str] = None,
+    user: Principal = Depends(get_current_user),
+):
+    return _export_sessions(user, format, date_from, date_to, class_id)
+
+
+# ------------------------------------------------------------
+# Асинхронный режим (DB_ASYNC=1): те же запросы через AsyncSession
+# ------------------------------------------------------------
+@async_router.get("/summary")
+async def get_summary_async(
+    db: AsyncSession = Depends(get_async_db),
+    user: Principal = Depends(get_current_user_async),
+):
+    return await db.run_sync(_summary, user)
+
+
+@async_router.get("/classes")
+async def get_class_stats_async(
+    db: AsyncSession = Depends(get_async_db),
+    user: Principal = Depends(get_current_user_async),
+):
+    return await db.run_sync(_class_stats, user)
+
+
+@async_router.get("/periods")
+async def get_period_stats_async(
+    date_from: Optional[date] = None,
+    date_to: Optional[date] = None,
+    class_id: Optional[str] = None,
+    db: AsyncSession = Depends(get_async_db),
+    user: Principal = Depends(get_current_user_async),
+):
+    return await db.run_sync(_period_stats, user, date_from, date_to, class_id)
+
+
+@async_router.get("/export/sessions")
+async def export_sessions_async(
+    format: str = "csv",
+    date_from: Optional[date] = None,
+    date_to: Optional[date] = None,
+    class_id: Optional[str] = None,
+    user: Principal = Depends(get_current_user_async),
+):
+    # Тело читается синхронным генератором — Starlette гоняет его в пуле потоков
+    return _export_sessions(user, format, date_from, date_to, class_id)
@@ -1,5 +1,5 @@
 from pydantic import BaseModel, Field
-from typing import Any, List, Literal
+from typing import List, Literal
 
 class StartTestRequest(BaseModel):
     code: str
@@ -7,16 +7,33 @@ class StartTestRequest(BaseModel):
     gender: Literal["male", "female"]
     diagnosis: Literal["hearing", "vision", "motor"]
 
+class TestBundleRef(BaseModel):
+    """Ссылка на неизменяемый пакет вопросов (GET url)."""
+    code: str
+    version: int
+    url: str
+    etag: str
+
 class StartTestResponse(BaseModel):
     session_id: str
-    test_name: str
-    form_type: str
-    questions: List[dict] = []
+    bundle: TestBundleRef
 
 class AnswerItem(BaseModel):
-    question_id: str
+    id: int = Field(ge=1, le=65535, description="id вопроса из пакета (с 1)")
     value: int = Field(ge=1, le=10, description="Оценка 1..10")
 
 class SubmitAnswersRequest(BaseModel):
     session_id: str
-    answers: List[Any]
\ No newline at end of file
+    # Можно прислать только то, что не ушло автосохранением: остальное берётся из него
+    answers: List[AnswerItem] = Field(default_factory=list, max_length=1000)
+
+class AnswersPatch(BaseModel):
+    """Порция автосохранения; повтор с тем же seq игнорируется."""
+    seq: int = Field(ge=0)
+    answers: List[AnswerItem] = Field(min_length=1, max_length=200)
+
+class SavedAnswers(BaseModel):
+    session_id: str
+    finished: bool
+    answers: List[AnswerItem]
+    next_seq: int
\ No newline at end of file
@@ -0,0 +1,41 @@
+"""
+Проверка подписанных токенов: любой испорченный токен — TokenError
+(для API — 401), а не необработанное исключение и 500.
+
+    python -m pytest SPTOVZ/tests -q
+"""
+import json
+
+import pytest
+
+from SPTOVZ.utils.tokens import TokenError, _b64, _keys, _sign, decode_token, issue_token
+
+
+def _signed(header, payload) -> str:
+    """Токен с произвольными header/payload, подписанный настоящим ключом."""
+    signing_input = f"{_b64(json.dumps(header).encode())}.{_b64(json.dumps(payload).encode())}".encode("ascii")
+    return f"{signing_input.decode('ascii')}.{_b64(_sign(signing_input, _keys[0][1]))}"
+
+
+def test_valid_token_roundtrip():
+    token, claims = issue_token({"sub": "u1"})
+    assert decode_token(token) == claims
+
+
+@pytest.mark.parametrize("header_b64", ["W10", "MQ", "bnVsbA", "InN0ciI"])  # [], 1, null, "str"
+def test_non_object_header(header_b64):
+    with pytest.raises(TokenError, match="malformed token"):
+        decode_token(f"{header_b64}.e30.AAAA")
+
+
+@pytest.mark.parametrize("payload", [[], 1, None, "str", {"exp": 9e12, "iat": "0"}])
+def test_non_object_payload(payload):
+    header = {"alg": "HS256", "typ": "JWT", "kid": _keys[0][0]}
+    with pytest.raises(TokenError, match="malformed payload"):
+        decode_token(_signed(header, payload))
+
+
+@pytest.mark.parametrize("token", ["", "a.b", "a.b.c.d", "!!.e30.AAAA", "e30.e30.AAAA"])
+def test_garbage_rejected(token):
+    with pytest.raises(TokenError):
+        decode_token(token)
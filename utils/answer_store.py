@@ -0,0 +1,57 @@
+"""
+Автосохранение ответов во время теста (таблица answer_batches).
+
+Клиент шлёт небольшие порции PATCH /session/{id}/answers: каждая порция —
+одна новая строка, существующие не меняются, повтор порции с тем же seq
+игнорируется (ON CONFLICT DO NOTHING). Ответы в порции упакованы парами
+(id вопроса: uint16, ответ: uint8) — 3 байта на ответ вместо JSON.
+
+Текущие ответы сессии — порции по порядку seq, поздние перекрывают ранние.
+submit-answers собирает их, считает результат и удаляет порции.
+"""
+from __future__ import annotations
+import struct
+from typing import Dict, Tuple
+
+from sqlalchemy import delete, select
+from sqlalchemy.orm import Session
+
+from SPTOVZ.database import dialect_insert
+from SPTOVZ.models.session import AnswerBatch
+
+_PAIR = struct.Struct("<HB")
+
+
+def pack_batch(answers: Dict[int, int]) -> bytes:
+    return b"".join(_PAIR.pack(qid, value) for qid, value in sorted(answers.items()))
+
+
+def unpack_batch(data: bytes) -> Dict[int, int]:
+    return {qid: value for qid, value in _PAIR.iter_unpack(data)}
+
+
+def append_batch(db: Session, session_id: str, seq: int, answers: Dict[int, int]) -> bool:
+    """Добавляет порцию (без commit). False — порция с таким seq уже была."""
+    stmt = dialect_insert(db, AnswerBatch.__table__).values(
+        session_id=session_id, seq=seq, data=pack_batch(answers),
+    ).on_conflict_do_nothing(index_elements=["session_id", "seq"])
+    return db.execute(stmt).rowcount == 1
+
+
+def load_answers(db: Session, session_id: str) -> Tuple[Dict[int, int], int]:
+    """Сохранённые ответы сессии и следующий свободный seq."""
+    answers: Dict[int, int] = {}
+    next_seq = 0
+    rows = db.execute(
+        select(AnswerBatch.seq, AnswerBatch.data)
+        .where(AnswerBatch.session_id == session_id)
+        .order_by(AnswerBatch.seq)
+    )
+    for seq, data in rows:
+        answers.update(unpack_batch(data))
+        next_seq = seq + 1
+    return answers, next_seq
+
+
+def clear_answers(db: Session, session_id: str) -> None:
+    db.execute(delete(AnswerBatch).where(AnswerBatch.session_id == session_id))
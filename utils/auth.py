@@ -1,12 +1,36 @@
+import asyncio
+import multiprocessing
+import os
+import secrets
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Executor, ProcessPoolExecutor
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, Optional, Tuple
+
 from fastapi import Depends, HTTPException, status
+from fastapi.concurrency import run_in_threadpool
 from fastapi.security import OAuth2PasswordBearer
+from sqlalchemy import delete, select
 from sqlalchemy.orm import Session
 from passlib.context import CryptContext
 
-from SPTOVZ.database import get_db
-from SPTOVZ.models.user import User
+from SPTOVZ.database import SessionLocal, WriteSessionLocal, dialect_insert
+from SPTOVZ.models.institution import Institution
+from SPTOVZ.models.user import RevokedToken, User
+from SPTOVZ.utils.tokens import LEEWAY_S, TokenError, decode_token, issue_token, revocations
+
+# Стоимость bcrypt (2^rounds итераций). Влияет только на новые хэши;
+# старые с меньшей стоимостью перехэшируются при входе (verify_and_update)
+BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS") or 12)
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+pwd_context = CryptContext(
+    schemes=["bcrypt"],
+    deprecated="auto",
+    bcrypt__rounds=BCRYPT_ROUNDS,
+    bcrypt__min_rounds=int(os.getenv("BCRYPT_MIN_ROUNDS") or 4),
+)
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="/token")
 
 def get_password_hash(password: str) -> str:
@@ -15,8 +39,312 @@ def get_password_hash(password: str) -> str:
 def verify_password(plain_password: str, password_hash: str) -> bool:
     return pwd_context.verify(plain_password, password_hash)
 
-def get_current_user(db: Session = Depends(get_db), token: str = Depends(oauth2_scheme)) -> User:
-    user = db.get(User, token)
-    if not user:
-        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid token")
-    return user
+def is_password_hash(value: str) -> bool:
+    """True, если в поле лежит хэш, распознаваемый pwd_context (а не «сырой» пароль)."""
+    try:
+        return pwd_context.identify(value or "") is not None
+    except ValueError:
+        return False
+
+def verify_and_update(plain_password: str, password_hash: str) -> Tuple[bool, Optional[str]]:
+    """
+    Проверка пароля при входе. Возвращает (верен ли, новый хэш или None).
+    Новый хэш — для устаревших схем/параметров и для старых записей,
+    где пароль хранился без хэша: его заменяют при первом успешном входе.
+    """
+    if not is_password_hash(password_hash):
+        if secrets.compare_digest((plain_password or "").encode(), (password_hash or "").encode()):
+            return True, get_password_hash(plain_password)
+        return False, None
+    return pwd_context.verify_and_update(plain_password, password_hash)
+
+
+# --------------------- Пул для bcrypt ---------------------
+
+class HashPool:
+    """
+    Отдельный ограниченный пул процессов для bcrypt: вход сотен учителей
+    не занимает потоки FastAPI и не мешает остальным запросам. Если в очереди
+    уже max_pending задач, новые сразу получают 503 (Retry-After).
+    workers=0 — считаем в пуле потоков (для отладки и тестов).
+    Процессы запускаются через spawn: пул создаётся из потока запроса, а fork
+    многопоточного процесса копирует занятые блокировки и соединения с БД.
+    """
+
+    def __init__(self, workers: int, max_pending: int) -> None:
+        self.workers = workers
+        self.max_pending = max_pending
+        self._executor: Optional[Executor] = None
+        self._lock = threading.Lock()
+        self.pending = 0
+        self.pending_max_seen = 0
+        self.submitted = 0
+        self.rejected = 0
+        self.busy_s = 0.0
+
+    def _get_executor(self) -> Executor:
+        if self._executor is None:
+            with self._lock:
+                if self._executor is None:
+                    self._executor = ProcessPoolExecutor(
+                        max_workers=self.workers, mp_context=multiprocessing.get_context("spawn"),
+                    )
+        return self._executor
+
+    async def run(self, fn: Callable[..., Any], *args: Any) -> Any:
+        with self._lock:
+            if self.pending >= self.max_pending:
+                self.rejected += 1
+                raise HTTPException(
+                    status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                    detail="Сервер перегружен, повторите вход через несколько секунд",
+                    headers={"Retry-After": "2"},
+                )
+            self.pending += 1
+            self.submitted += 1
+            self.pending_max_seen = max(self.pending_max_seen, self.pending)
+        started = time.perf_counter()
+        try:
+            if self.workers <= 0:
+                return await run_in_threadpool(fn, *args)
+            return await asyncio.get_running_loop().run_in_executor(self._get_executor(), fn, *args)
+        finally:
+            with self._lock:
+                self.pending -= 1
+                self.busy_s += time.perf_counter() - started
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "workers": self.workers,
+                "rounds": BCRYPT_ROUNDS,
+                "queue_depth": self.pending,
+                "queue_depth_max": self.pending_max_seen,
+                "max_pending": self.max_pending,
+                "submitted": self.submitted,
+                "rejected": self.rejected,
+                "busy_s": round(self.busy_s, 3),
+            }
+
+    def shutdown(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown(cancel_futures=True)
+            self._executor = None
+
+
+hash_pool = HashPool(
+    workers=int(os.getenv("HASH_WORKERS") or 2),
+    max_pending=int(os.getenv("HASH_MAX_PENDING") or 64),
+)
+
+
+async def get_password_hash_async(password: str) -> str:
+    return await hash_pool.run(get_password_hash, password)
+
+async def verify_and_update_async(plain_password: str, password_hash: str) -> Tuple[bool, Optional[str]]:
+    return await hash_pool.run(verify_and_update, plain_password, password_hash)
+
+def hash_pool_stats() -> Dict[str, Any]:
+    return hash_pool.snapshot()
+
+
+# --------------------- Текущий пользователь ---------------------
+
+@dataclass(frozen=True)
+class Principal:
+    """Аутентифицированный пользователь: то, что нужно эндпоинтам, без ORM-сессии."""
+    id: str
+    email: str
+    institution_id: Optional[str]
+    institution_name: Optional[str]
+    education_type: Optional[str]
+
+
+class PrincipalCache:
+    """Кэш token → Principal с коротким TTL для старых токенов (без подписи)."""
+
+    def __init__(self, ttl_s: float, max_size: int) -> None:
+        self.ttl_s = ttl_s
+        self.max_size = max_size
+        self._items: "OrderedDict[str, Tuple[float, Principal]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, token: str) -> Optional[Principal]:
+        if self.ttl_s <= 0:
+            return None
+        with self._lock:
+            item = self._items.get(token)
+            if item is None or item[0] < time.monotonic():
+                self.misses += 1
+                return None
+            self.hits += 1
+            return item[1]
+
+    def put(self, token: str, principal: Principal) -> None:
+        if self.ttl_s <= 0:
+            return
+        with self._lock:
+            self._items[token] = (time.monotonic() + self.ttl_s, principal)
+            self._items.move_to_end(token)
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+
+    def invalidate(self, user_id: Optional[str] = None) -> None:
+        with self._lock:
+            if user_id is None:
+                self._items.clear()
+            else:
+                for token in [t for t, (_, p) in self._items.items() if p.id == user_id]:
+                    del self._items[token]
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            return {"size": len(self._items), "hits": self.hits, "misses": self.misses, "ttl_s": self.ttl_s}
+
+
+principal_cache = PrincipalCache(
+    ttl_s=float(os.getenv("AUTH_CACHE_TTL_S") or 30),
+    max_size=int(os.getenv("AUTH_CACHE_MAX") or 10000),
+)
+
+
+def _principal(user: User, institution: Optional[Institution]) -> Principal:
+    return Principal(
+        id=user.id,
+        email=user.email,
+        institution_id=user.institution_id,
+        institution_name=institution.name if institution else None,
+        education_type=institution.education_type if institution else None,
+    )
+
+def _invalid_token() -> HTTPException:
+    return HTTPException(
+        status_code=status.HTTP_401_UNAUTHORIZED,
+        detail="Invalid token",
+        headers={"WWW-Authenticate": "Bearer"},
+    )
+
+
+# --------------------- Токены ---------------------
+
+# Старые токены (токен = id пользователя) принимаются только при AUTH_LEGACY_TOKENS=1
+# и проверяются по БД (с кэшем principal_cache) — на время перехода клиентов
+LEGACY_TOKENS = os.getenv("AUTH_LEGACY_TOKENS", "0") == "1"
+
+def create_access_token(principal: Principal) -> Tuple[str, Dict[str, Any]]:
+    return issue_token({
+        "sub": principal.id,
+        "email": principal.email,
+        "inst": principal.institution_id,
+        "inst_name": principal.institution_name,
+        "edu": principal.education_type,
+    })
+
+def login_principal(db: Session, user: User) -> Principal:
+    institution = db.get(Institution, user.institution_id) if user.institution_id else None
+    return _principal(user, institution)
+
+def _principal_from_claims(claims: Dict[str, Any]) -> Principal:
+    return Principal(
+        id=claims["sub"],
+        email=claims.get("email") or "",
+        institution_id=claims.get("inst"),
+        institution_name=claims.get("inst_name"),
+        education_type=claims.get("edu"),
+    )
+
+def _legacy_principal(token: str) -> Optional[Principal]:
+    principal = principal_cache.get(token)
+    if principal is not None:
+        return principal
+    with SessionLocal() as db:
+        user = db.get(User, token)
+        if not user:
+            return None
+        principal = login_principal(db, user)
+    principal_cache.put(token, principal)
+    return principal
+
+# --------------------- Отзыв токенов ---------------------
+
+# Как часто процесс подтягивает из revoked_tokens отзывы, сделанные другими воркерами
+REVOCATION_SYNC_S = float(os.getenv("AUTH_REVOCATION_SYNC_S") or 5)
+_revocations_lock = threading.Lock()
+_revocations_synced_at = float("-inf")
+
+
+def sync_revocations() -> None:
+    """
+    Дополняет список отзывов в памяти неистёкшими строками revoked_tokens.
+    Не чаще раза в REVOCATION_SYNC_S, в остальное время запросов нет; пока один
+    вызов читает, остальные не ждут (в async-режиме проверка токена идёт на
+    потоке event loop). Читается весь неистёкший список, а не только новые id:
+    строк — число выходов за срок жизни токена.
+    """
+    global _revocations_synced_at
+    if time.monotonic() - _revocations_synced_at < REVOCATION_SYNC_S:
+        return
+    if not _revocations_lock.acquire(blocking=False):
+        return
+    try:
+        with SessionLocal() as db:
+            rows = db.execute(
+                select(RevokedToken.jti, RevokedToken.expires_at)
+                .where(RevokedToken.expires_at >= time.time() - LEEWAY_S)
+            ).all()
+        for jti, expires_at in rows:
+            revocations.revoke(jti, expires_at)
+        _revocations_synced_at = time.monotonic()
+    finally:
+        _revocations_lock.release()
+
+
+def authenticate(token: str) -> Principal:
+    """
+    Principal по токену; подписанный токен проверяется без запросов к БД
+    (кроме редкой сверки отзывов в sync_revocations).
+    """
+    sync_revocations()
+    try:
+        return _principal_from_claims(decode_token(token))
+    except (TokenError, KeyError):
+        if LEGACY_TOKENS and token and "." not in token:
+            principal = _legacy_principal(token)
+            if principal is not None:
+                return principal
+        raise _invalid_token()
+
+def revoke_token(token: str) -> None:
+    """
+    Logout: токен перестаёт приниматься сразу в этом процессе и в течение
+    REVOCATION_SYNC_S — в остальных воркерах (через revoked_tokens).
+    """
+    try:
+        claims = decode_token(token)
+    except TokenError:
+        return
+    jti, expires_at = claims.get("jti"), claims["exp"]
+    if not jti:
+        return
+    revocations.revoke(jti, expires_at)
+    with WriteSessionLocal() as db:
+        table = RevokedToken.__table__
+        db.execute(
+            dialect_insert(db, table).values(jti=jti, expires_at=expires_at)
+            .on_conflict_do_nothing(index_elements=["jti"])
+        )
+        # истёкшие отзывы больше ничего не блокируют
+        db.execute(delete(RevokedToken).where(RevokedToken.expires_at < time.time() - LEEWAY_S))
+        db.commit()
+
+
+def get_current_user(token: str = Depends(oauth2_scheme)) -> Principal:
+    return authenticate(token)
+
+
+async def get_current_user_async(token: str = Depends(oauth2_scheme)) -> Principal:
+    if "." in (token or "") or not LEGACY_TOKENS:
+        return authenticate(token)
+    return await run_in_threadpool(authenticate, token)
@@ -0,0 +1,289 @@
+from __future__ import annotations
+from dataclasses import dataclass
+from typing import Any, Dict, Iterable, List, Mapping, Sequence, Tuple, Union
+import threading
+
+import numpy as np
+
+from SPTOVZ.utils.emspt_engine import (
+    Profile,
+    ScoringConfig,
+    get_scoring_config,
+    _sten_level,
+)
+
+# --------------------- Матричное представление ---------------------
+
+
+@dataclass(frozen=True)
+class BatchTables:
+    """
+    Массивы NumPy, построенные из ScoringConfig:
+    incidence — матрица «вопрос × шкала» (Q×S) из 0/1,
+    остальное — номера столбцов шкал и границы стэнов.
+    """
+    config: ScoringConfig
+    incidence: np.ndarray
+    lie_col: int                    # -1 — шкалы ЛЖ нет среди ключей
+    risk_cols: Tuple[int, ...]      # -1 — шкалы нет среди ключей (даёт 0.0)
+    protect_cols: Tuple[int, ...]
+    sten: Tuple[Any, ...]           # на шкалу: (lows, highs, stens, fallback) | StenScale | None
+
+
+_tables: Dict[Tuple[str, str, str], BatchTables] = {}
+_tables_lock = threading.Lock()
+
+
+def _build_tables(cfg: ScoringConfig) -> BatchTables:
+    col = {name: i for i, name in enumerate(cfg.scale_names)}
+    incidence = np.zeros((cfg.n_questions, len(cfg.scale_names)), dtype=np.int64)
+    for j, q_ids in enumerate(cfg.scale_items):
+        for q in q_ids:
+            incidence[int(q) - 1, j] += 1
+
+    sten: List[Any] = []
+    for name in cfg.scale_names:
+        table = cfg.sten.get(name)
+        if table is None:
+            sten.append(None)
+        elif table.ordered:
+            sten.append((
+                np.asarray(table.highs, dtype=np.float64),
+                np.asarray(table.lows, dtype=np.float64),
+                np.asarray(table.stens + (table.fallback,), dtype=np.int64),
+                table.fallback,
+            ))
+        else:
+            # немонотонная таблица — считаем поэлементно, как в скалярном пути
+            sten.append(table)
+
+    return BatchTables(
+        config=cfg,
+        incidence=incidence,
+        lie_col=col.get(cfg.lie_scale, -1),
+        risk_cols=tuple(col.get(s, -1) for s in cfg.risk_scales),
+        protect_cols=tuple(col.get(s, -1) for s in cfg.protect_scales),
+        sten=tuple(sten),
+    )
+
+
+def get_batch_tables(profile: Profile) -> BatchTables:
+    """Матрицы профиля; пересобираются вместе с ScoringConfig."""
+    cfg = get_scoring_config(profile)
+    key = profile.cache_key()
+    tables = _tables.get(key)
+    if tables is None or tables.config is not cfg:
+        with _tables_lock:
+            tables = _tables.get(key)
+            if tables is None or tables.config is not cfg:
+                tables = _build_tables(cfg)
+                _tables[key] = tables
+    return tables
+
+
+def answers_to_matrix(answers_maps: Iterable[Mapping[Any, int]], n_questions: int) -> np.ndarray:
+    """
+    Переводит список answers_map ({номер вопроса: балл}, ключи int или str)
+    в матрицу N×n_questions; отсутствующие ответы — 0.
+    """
+    row_idx: List[int] = []
+    col_idx: List[int] = []
+    vals: List[int] = []
+    n = 0
+    for i, answers in enumerate(answers_maps):
+        n = i + 1
+        row_idx.extend([i] * len(answers))
+        col_idx.extend(map(int, answers.keys()))
+        vals.extend(answers.values())
+    matrix = np.zeros((n, n_questions), dtype=np.int64)
+    if vals:
+        rows = np.asarray(row_idx, dtype=np.int64)
+        cols = np.asarray(col_idx, dtype=np.int64)
+        keep = (cols >= 1) & (cols <= n_questions)
+        matrix[rows[keep], cols[keep] - 1] = np.asarray(vals, dtype=np.int64)[keep]
+    return matrix
+
+
+def packed_to_matrix(packed: Iterable[bytes], n_questions: int) -> np.ndarray:
+    """
+    То же для упакованных ответов TestSession.answers_packed (байт на вопрос,
+    вопрос N — байт N-1): строки копируются в матрицу без разбора словарей.
+    """
+    rows = list(packed)
+    matrix = np.zeros((len(rows), n_questions), dtype=np.int64)
+    for i, data in enumerate(rows):
+        if data:
+            answers = np.frombuffer(data, dtype=np.uint8)[:n_questions]
+            matrix[i, :len(answers)] = answers
+    return matrix
+
+
+# --------------------- Векторные шаги расчёта ---------------------
+
+
+def _round2(values: np.ndarray) -> np.ndarray:
+    """round(x, 2) по правилам Python: np.round округляет иначе на границах."""
+    return np.array([round(x, 2) for x in values.tolist()], dtype=np.float64)
+
+
+def _column(values: np.ndarray, col: int) -> np.ndarray:
+    return values[:, col] if col >= 0 else np.zeros(values.shape[0], dtype=np.float64)
+
+
+def _to_sten(table: Any, values: np.ndarray) -> np.ndarray:
+    if table is None:
+        return np.zeros(values.shape[0], dtype=np.int64)
+    if isinstance(table, tuple):
+        highs, lows, stens, fallback = table
+        idx = np.searchsorted(highs, values, side="left")
+        hit = idx < len(highs)
+        hit[hit] = lows[idx[hit]] <= values[hit]
+        return np.where(hit, stens[idx], fallback)
+    return np.array([table.lookup(v) for v in values.tolist()], dtype=np.int64)
+
+
+def _band_labels(cfg: ScoringConfig, values: np.ndarray) -> List[str]:
+    bands = cfg.irp_bands
+    if bands is None:
+        return ["—"] * values.shape[0]
+    labels = np.full(values.shape[0], "средний", dtype=object)
+    matched = np.zeros(values.shape[0], dtype=bool)
+    for label, lo, hi in bands.ranges:
+        hit = ~matched & (values >= lo) & (values <= hi)
+        labels[hit] = label
+        matched |= hit
+    if bands.lowest is not None:
+        labels[~matched & (values < bands.lowest)] = "низкий"
+        labels[~matched & (values > bands.highest)] = "высокий"
+    return labels.tolist()
+
+
+def _score_group(tables: BatchTables, answers: np.ndarray) -> List[Dict[str, Any]]:
+    cfg = tables.config
+    n = answers.shape[0]
+    names = cfg.scale_names
+
+    # ---------- 1️⃣ Сырые баллы: одно матричное умножение ----------
+    raw = answers @ tables.incidence
+
+    # ---------- 2️⃣ Коррекция по шкале ЛЖ ----------
+    lie_raw = raw[:, tables.lie_col] if tables.lie_col >= 0 else np.zeros(n, dtype=np.int64)
+    if cfg.lie_coeff > 0:
+        applied = lie_raw >= cfg.lie_threshold
+    else:
+        applied = np.zeros(n, dtype=bool)
+
+    values = raw.astype(np.float64)
+    if applied.any():
+        other = [j for j in range(len(names)) if j != tables.lie_col]
+        block = raw[np.ix_(applied, other)]
+        # различных сырых сумм немного — округляем каждую один раз
+        uniq, inverse = np.unique(block, return_inverse=True)
+        factor = 1 - cfg.lie_coeff
+        corrected = np.array([round(int(u) * factor, 2) for u in uniq], dtype=np.float64)
+        values[np.ix_(applied, other)] = corrected[inverse].reshape(block.shape)
+
+    # ---------- 3️⃣ IRP и KVERIPO ----------
+    # складываем столбцы в том же порядке, что и скалярный путь
+    sum_risk = np.zeros(n, dtype=np.float64)
+    for j in tables.risk_cols:
+        sum_risk = sum_risk + _column(values, j)
+    sum_prot = np.zeros(n, dtype=np.float64)
+    for j in tables.protect_cols:
+        sum_prot = sum_prot + _column(values, j)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        kveripo = np.where(sum_prot > 0, _round2(sum_risk / sum_prot), 999.0)
+        total_rf = sum_risk + sum_prot
+        irp = np.where(total_rf > 0, _round2((sum_risk / total_rf) * 100.0), 0.0)
+
+    # ---------- 4️⃣ Интервалы ----------
+    irp_interval = _band_labels(cfg, irp)
+    if cfg.kveripo_max is None:
+        kveripo_interval = ["—"] * n
+    else:
+        kveripo_interval = np.where(kveripo <= cfg.kveripo_max, "низкий", "высокий").tolist()
+
+    # ---------- 5️⃣ Стэны: searchsorted по границам ----------
+    stens = np.column_stack([_to_sten(t, values[:, j]) for j, t in enumerate(tables.sten)])
+
+    # ---------- 6️⃣ Сборка результатов ----------
+    profile = cfg.profile.__dict__
+    interpretations = cfg.interpretations
+    raw_rows = raw.tolist()
+    value_rows = values.tolist()
+    sten_rows = stens.tolist()
+    applied_rows = applied.tolist()
+    lie_rows = lie_raw.tolist()
+    irp_rows = irp.tolist()
+    kveripo_rows = kveripo.tolist()
+
+    results: List[Dict[str, Any]] = []
+    for i in range(n):
+        if applied_rows[i]:
+            row = value_rows[i]
+            if tables.lie_col >= 0:
+                row[tables.lie_col] = raw_rows[i][tables.lie_col]
+        else:
+            row = raw_rows[i]
+        sten_row = sten_rows[i]
+        interp = {}
+        for name, sten_value in zip(names, sten_row):
+            if not sten_value or name not in interpretations:
+                continue
+            level = _sten_level(sten_value)
+            interp[name] = {"sten": sten_value, "level": level, "text": interpretations[name][level]}
+        results.append({
+            "scales": dict(zip(names, row)),
+            "lie_raw": lie_rows[i] if tables.lie_col >= 0 else 0,
+            "lie_applied": applied_rows[i],
+            "irp": irp_rows[i],
+            "irp_interval": irp_interval[i],
+            "kveripo": kveripo_rows[i],
+            "kveripo_interval": kveripo_interval[i],
+            "sten": dict(zip(names, sten_row)),
+            "interpretations": interp,
+            "profile": dict(profile),
+        })
+    return results
+
+
+# --------------------- Публичный API ---------------------
+
+
+def compute_emspt_batch(
+    answers_matrix: Union[np.ndarray, Sequence[Sequence[int]]],
+    profiles: Union[Profile, Sequence[Profile]],
+) -> List[Dict[str, Any]]:
+    """
+    Пакетный расчёт ЕМ СПТ-ОВЗ.
+
+    answers_matrix — N×Q: строка i, столбец q-1 — балл за вопрос q (0 — нет ответа);
+    profiles — профиль на каждую строку (или один на все).
+    Строки группируются по профилю, сырые баллы группы считаются одним
+    умножением на матрицу ключей Q×S. Результат поэлементно совпадает с
+    compute_emspt для тех же ответов, порядок строк сохраняется.
+    """
+    answers = np.asarray(answers_matrix, dtype=np.int64)
+    if answers.ndim != 2:
+        raise ValueError("answers_matrix должен быть двумерным (N×Q)")
+    n = answers.shape[0]
+    if isinstance(profiles, Profile):
+        profiles = [profiles] * n
+    if len(profiles) != n:
+        raise ValueError(f"profiles: ожидалось {n} профилей, получено {len(profiles)}")
+
+    groups: Dict[Tuple[str, str, str], List[int]] = {}
+    for i, profile in enumerate(profiles):
+        groups.setdefault(profile.cache_key(), []).append(i)
+
+    results: List[Dict[str, Any]] = [None] * n  # type: ignore[list-item]
+    for key, rows in groups.items():
+        tables = get_batch_tables(Profile(*key))
+        q = tables.incidence.shape[0]
+        block = answers[rows, :q]
+        if block.shape[1] < q:
+            block = np.pad(block, ((0, 0), (0, q - block.shape[1])))
+        for i, result in zip(rows, _score_group(tables, block)):
+            results[i] = result
+    return results
@@ -1,14 +1,25 @@
 from __future__ import annotations
 from pathlib import Path
-from typing import Dict, Any
-from dataclasses import dataclass
+from typing import Dict, Any, List, Optional, Tuple
+from dataclasses import dataclass, field, replace
+from bisect import bisect_left
+import threading
+import time
 import yaml
 
+from SPTOVZ.utils.metrics import span, timed
+
 # --------------------- Константы ---------------------
 
 BASE_DIR = Path(__file__).resolve().parent.parent
 CONFIG_ROOT = BASE_DIR / "config" / "emspt"
 
+BAND_LABELS = ("низкий", "средний", "высокий")
+NO_INTERPRETATION = "(описание не задано)"
+
+# Версия структуры ScoringConfig: снимки с другой версией не используются
+CONFIG_FORMAT = 1
+
 
 # --------------------- Профиль ---------------------
 
@@ -19,20 +30,60 @@ class Profile:
     impairment: str  # "hearing" | "vision" | "motor"
     gender: str      # "male" | "female"
 
+    def cache_key(self) -> Tuple[str, str, str]:
+        return (self.form, self.impairment, self.gender)
+
 
 # --------------------- Загрузка YAML ---------------------
 
+# Разобранные YAML-файлы: путь -> (mtime_ns, данные).
+# norms.yaml / lie_correction.yaml общие для всех профилей — парсим один раз.
+_yaml_cache: Dict[Path, Tuple[int, Any]] = {}
+
+
+def _mtime(path: Path) -> Optional[int]:
+    try:
+        return path.stat().st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+
 def _load_yaml(path: Path) -> Dict[str, Any]:
-    if not path.exists():
+    mtime = _mtime(path)
+    if mtime is None:
         raise FileNotFoundError(f"YAML not found: {path}")
+    cached = _yaml_cache.get(path)
+    if cached and cached[0] == mtime:
+        return cached[1]
     with open(path, "r", encoding="utf-8") as f:
-        return yaml.safe_load(f)
+        data = yaml.safe_load(f)
+    _yaml_cache[path] = (mtime, data)
+    _stats["yaml_parses"] += 1
+    return data
+
+
+def _keys_path(profile: Profile) -> Path:
+    return CONFIG_ROOT / ("keys_A.yaml" if profile.form == "A" else "keys_BC.yaml")
+
+
+def _sten_path(profile: Profile) -> Path:
+    return CONFIG_ROOT / "sten_tables" / profile.form / profile.impairment / f"{profile.gender}.yaml"
+
+
+def _source_paths(profile: Profile) -> Tuple[Path, ...]:
+    """Все файлы, от которых зависит конфигурация профиля."""
+    return (
+        _keys_path(profile),
+        CONFIG_ROOT / "lie_correction.yaml",
+        CONFIG_ROOT / "norms.yaml",
+        _sten_path(profile),
+        CONFIG_ROOT / "interpretations.yaml",
+    )
 
 
 def _load_keys(profile: Profile) -> Dict[str, Any]:
     """Загружает ключи шкал по форме."""
-    path = CONFIG_ROOT / ("keys_A.yaml" if profile.form == "A" else "keys_BC.yaml")
-    return _load_yaml(path)
+    return _load_yaml(_keys_path(profile))
 
 
 def _load_lie_correction() -> Dict[str, Any]:
@@ -50,8 +101,7 @@ def _load_norms(profile: Profile) -> Dict[str, Any]:
 
 
 def _load_sten_table(profile: Profile) -> Dict[str, Any]:
-    path = CONFIG_ROOT / "sten_tables" / profile.form / profile.impairment / f"{profile.gender}.yaml"
-    return _load_yaml(path)
+    return _load_yaml(_sten_path(profile))
 
 
 def _load_interpretations() -> Dict[str, Any]:
@@ -60,8 +110,315 @@ def _load_interpretations() -> Dict[str, Any]:
     return _load_yaml(path) if path.exists() else {}
 
 
+def _interpretation(data: Dict[str, Any], scale: str, level: str) -> str:
+    return (data.get(scale, {}) or {}).get(level, "") or NO_INTERPRETATION
+
+
+# --------------------- Скомпилированная конфигурация ---------------------
+
+@dataclass(frozen=True)
+class StenScale:
+    """
+    Таблица стэнов одной шкалы в виде отсортированных границ.
+    lows/highs — границы интервалов, stens — номер стэна для интервала,
+    fallback — стэн для значения вне всех интервалов (10 или 0).
+    Если границы не монотонны, ordered=False и поиск идёт перебором.
+    """
+    lows: Tuple[float, ...]
+    highs: Tuple[float, ...]
+    stens: Tuple[int, ...]
+    fallback: int
+    ordered: bool
+
+    def lookup(self, value: float) -> int:
+        if self.ordered:
+            i = bisect_left(self.highs, value)
+            if i < len(self.highs) and self.lows[i] <= value:
+                return self.stens[i]
+            return self.fallback
+        for low, high, sten in zip(self.lows, self.highs, self.stens):
+            if low <= value <= high:
+                return sten
+        return self.fallback
+
+
+@dataclass(frozen=True)
+class Bands:
+    """Диапазоны уровней IRP ('низкий'|'средний'|'высокий') из norms.yaml."""
+    ranges: Tuple[Tuple[str, float, float], ...]
+    lowest: Optional[float]   # None — границы не удалось определить
+    highest: Optional[float]
+
+    def label(self, value: float) -> str:
+        for label, lo, hi in self.ranges:
+            if lo <= value <= hi:
+                return label
+        if self.lowest is not None:
+            if value < self.lowest:
+                return "низкий"
+            if value > self.highest:
+                return "высокий"
+        return "средний"
+
+
+@dataclass(frozen=True)
+class ScoringConfig:
+    """
+    Всё, что нужно для расчёта ЕМ СПТ одного профиля (форма, нозология, пол),
+    собранное из YAML один раз: ключи шкал в виде массивов номеров вопросов,
+    параметры коррекции по ЛЖ, нормы, таблицы стэнов и тексты интерпретаций.
+    """
+    profile: Profile
+    scale_names: Tuple[str, ...]
+    scale_items: Tuple[Tuple[int, ...], ...]
+    risk_scales: Tuple[str, ...]
+    protect_scales: Tuple[str, ...]
+    lie_scale: str
+    lie_threshold: float
+    lie_coeff: float
+    irp_bands: Optional[Bands]        # None — нормы не заданы ("—")
+    kveripo_max: Optional[float]      # None — порог не задан ("—")
+    sten: Dict[str, StenScale]
+    interpretations: Dict[str, Dict[str, str]]  # шкала -> low|mid|high -> текст
+    n_questions: int
+    sources: Tuple[Tuple[Path, Optional[int]], ...] = field(compare=False)
+
+    def is_stale(self) -> bool:
+        return any(_mtime(path) != mtime for path, mtime in self.sources)
+
+    def to_sten(self, scale: str, value: float) -> int:
+        table = self.sten.get(scale)
+        return table.lookup(value) if table else 0
+
+
+def _compile_sten_scale(intervals: Any) -> Optional[StenScale]:
+    if not isinstance(intervals, list):
+        return None
+    lows: List[float] = []
+    highs: List[float] = []
+    stens: List[int] = []
+    for i, rng in enumerate(intervals, start=1):
+        if isinstance(rng, list) and len(rng) == 2:
+            lows.append(rng[0])
+            highs.append(rng[1])
+            stens.append(i)
+    # если выше последнего интервала — присваиваем 10
+    fallback = 10 if intervals and isinstance(intervals[-1], list) else 0
+    ordered = lows == sorted(lows) and highs == sorted(highs)
+    return StenScale(tuple(lows), tuple(highs), tuple(stens), fallback, ordered)
+
+
+def _compile_bands(bands: Any) -> Optional[Bands]:
+    if not bands:
+        return None
+    ranges = []
+    # перебираем по ключам, чтобы не зависеть от порядка в yaml
+    for label in BAND_LABELS:
+        rng = bands.get(label)
+        if isinstance(rng, (list, tuple)) and len(rng) == 2:
+            ranges.append((label, rng[0], rng[1]))
+    try:
+        lowest = min(v[0] for v in bands.values())
+        highest = max(v[1] for v in bands.values())
+    except Exception:
+        lowest = highest = None
+    return Bands(tuple(ranges), lowest, highest)
+
+
+def _build_config(profile: Profile) -> ScoringConfig:
+    sources = tuple((path, _mtime(path)) for path in _source_paths(profile))
+
+    keys_data = _load_keys(profile)
+    lie_cfg = _load_lie_correction()
+    norms = _load_norms(profile)
+    sten_table = _load_sten_table(profile) or {}
+    interpretations_data = _load_interpretations() or {}
+
+    keys = keys_data["keys"]
+    scale_names = tuple(keys.keys())
+    scale_items = tuple(tuple(q_ids) for q_ids in keys.values())
+
+    # В norms.yaml:
+    #   IRP_bands: {низкий:[min,max], средний:[min,max], высокий:[min,max]}
+    #   KVERIPO_max: float  (порог "в норме")
+    kveripo_max = norms.get("KVERIPO_max", None)
+
+    sten: Dict[str, StenScale] = {}
+    for scale, intervals in sten_table.items():
+        compiled = _compile_sten_scale(intervals)
+        if compiled:
+            sten[scale] = compiled
+
+    interpretations = {
+        scale: {level: _interpretation(interpretations_data, scale, level) for level in ("low", "mid", "high")}
+        for scale in scale_names
+    }
+
+    return ScoringConfig(
+        profile=Profile(*profile.cache_key()),
+        scale_names=scale_names,
+        scale_items=scale_items,
+        risk_scales=tuple(keys_data["risk_scales"]),
+        protect_scales=tuple(keys_data["protect_scales"]),
+        lie_scale=keys_data["lie_scale"],
+        lie_threshold=(lie_cfg.get("threshold") or {}).get(profile.form, 999),
+        lie_coeff=(
+            (lie_cfg.get("coeff") or {})
+            .get(profile.form, {})
+            .get(profile.impairment, {})
+            .get(profile.gender, 0.0)
+        ),
+        irp_bands=_compile_bands(norms.get("IRP_bands", {})),
+        kveripo_max=float(kveripo_max) if kveripo_max is not None else None,
+        sten=sten,
+        interpretations=interpretations,
+        n_questions=max((max(q_ids) for q_ids in scale_items if q_ids), default=0),
+        sources=sources,
+    )
+
+
+# --------------------- Кэш конфигураций ---------------------
+
+_configs: Dict[Tuple[str, str, str], ScoringConfig] = {}
+_configs_lock = threading.Lock()
+_stats: Dict[str, Any] = {
+    "hits": 0,
+    "builds": 0,
+    "invalidations": 0,
+    "yaml_parses": 0,
+    "last_build_ms": 0.0,
+    "snapshot_configs": 0,
+}
+
+
+def get_scoring_config(profile: Profile) -> ScoringConfig:
+    """
+    Возвращает скомпилированную конфигурацию профиля из кэша процесса.
+    Пересобирает её, если изменился mtime любого исходного YAML.
+    """
+    key = profile.cache_key()
+    config = _configs.get(key)
+    if config is not None and not config.is_stale():
+        _stats["hits"] += 1
+        return config
+
+    with _configs_lock:
+        config = _configs.get(key)
+        if config is not None and not config.is_stale():
+            _stats["hits"] += 1
+            return config
+        if config is not None:
+            _stats["invalidations"] += 1
+        started = time.perf_counter()
+        with span("emspt_config_build"):
+            config = _build_config(profile)
+        _configs[key] = config
+        _stats["builds"] += 1
+        _stats["last_build_ms"] = round((time.perf_counter() - started) * 1000.0, 3)
+        return config
+
+
+def available_profiles() -> List[Profile]:
+    """Все профили, для которых есть таблица стэнов."""
+    root = CONFIG_ROOT / "sten_tables"
+    return [
+        Profile(form=p.parent.parent.name, impairment=p.parent.name, gender=p.stem)
+        for p in sorted(root.glob("*/*/*.yaml"))
+    ]
+
+
+def warm_scoring_configs() -> int:
+    """Собирает конфигурации всех профилей заранее (при старте приложения)."""
+    profiles = available_profiles()
+    for profile in profiles:
+        get_scoring_config(profile)
+    return len(profiles)
+
+
+def reload_scoring_configs() -> None:
+    """Сбрасывает кэш: следующий запрос перечитает YAML с диска."""
+    with _configs_lock:
+        _configs.clear()
+        _yaml_cache.clear()
+
+
+def load_snapshot_configs() -> int:
+    """
+    Берёт скомпилированные конфигурации из бинарного снимка (utils/snapshot.py),
+    если он есть и собран из тех же YAML. Иначе ничего не делает —
+    конфигурации соберутся из YAML при первом обращении.
+    """
+    from SPTOVZ.utils.snapshot import read_snapshot, sources_fresh
+
+    payload = read_snapshot()
+    if not payload or payload.get("config_format") != CONFIG_FORMAT:
+        return 0
+    if not sources_fresh(payload["config_sources"], CONFIG_ROOT):
+        return 0
+    with _configs_lock:
+        for key, config in payload["configs"].items():
+            # mtime текущих файлов: дальше is_stale() отслеживает правки как обычно
+            sources = tuple((path, _mtime(path)) for path in _source_paths(config.profile))
+            _configs[key] = replace(config, sources=sources)
+        _stats["snapshot_configs"] = len(payload["configs"])
+    return len(payload["configs"])
+
+
+def form_scale_names(form: str) -> Tuple[str, ...]:
+    """Шкалы формы в порядке keys_*.yaml (не требует таблиц стэнов)."""
+    return tuple(_load_keys(Profile(form=form, impairment="", gender=""))["keys"])
+
+
+def form_lie_scale(form: str) -> str:
+    """Шкала лжи формы (её сырой балл не корректируется)."""
+    return _load_keys(Profile(form=form, impairment="", gender=""))["lie_scale"]
+
+
+def interpretation_text(scale: str, level: str) -> str:
+    """Текст интерпретации шкалы для уровня 'low' | 'mid' | 'high' из interpretations.yaml."""
+    return _interpretation(_load_interpretations() or {}, scale, level)
+
+
+def scoring_config_stats() -> Dict[str, Any]:
+    return {
+        **_stats,
+        "entries": len(_configs),
+        "profiles": sorted("/".join(key) for key in _configs),
+    }
+
+
+# --------------------- Уровни ---------------------
+
+def normalize_level(value: Any) -> Optional[str]:
+    """
+    Приводит формулировку уровня к 'низкий' | 'средний' | 'высокий'.
+    Для '—', пустых и неизвестных значений возвращает None.
+    """
+    lvl = str(value or "").strip().lower()
+    if not lvl:
+        return None
+    if "высочай" in lvl:
+        return "высокий"
+    if "высок" in lvl or "выше" in lvl:
+        return "высокий"
+    if "сред" in lvl or "норм" in lvl:
+        return "средний"
+    if "низ" in lvl or "ниже" in lvl:
+        return "низкий"
+    return None
+
+
 # --------------------- Основная функция расчёта ---------------------
 
+def _sten_level(sten_value: int) -> str:
+    if 1 <= sten_value <= 3:
+        return "low"
+    if 4 <= sten_value <= 7:
+        return "mid"
+    return "high"
+
+
+@timed("compute_emspt")
 def compute_emspt(answers_map: Dict[str, int], profile: Profile) -> Dict[str, Any]:
     """
     Полный расчёт ЕМ СПТ-ОВЗ:
@@ -71,42 +428,29 @@ def compute_emspt(answers_map: Dict[str, int], profile: Profile) -> Dict[str, An
     - определяет интервалы по norms.yaml
     - переводит в стэны
     """
-    keys_data = _load_keys(profile)
-    lie_cfg = _load_lie_correction()
-    norms = _load_norms(profile)
-    sten_table = _load_sten_table(profile)
-
-    risk_scales = keys_data["risk_scales"]
-    protect_scales = keys_data["protect_scales"]
-    lie_scale = keys_data["lie_scale"]
-    keys = keys_data["keys"]
+    cfg = get_scoring_config(profile)
+    lie_scale = cfg.lie_scale
 
     # ---------- 1️⃣ Сырые баллы по шкалам ----------
     scales: Dict[str, float] = {}
-    for scale_name, question_ids in keys.items():
+    for scale_name, question_ids in zip(cfg.scale_names, cfg.scale_items):
         total = sum(answers_map.get(q, answers_map.get(str(q), 0)) for q in question_ids)
         scales[scale_name] = round(total, 2)
 
     # ---------- 2️⃣ Коррекция по шкале ЛЖ ----------
     lie_raw = scales.get(lie_scale, 0)
-    threshold = (lie_cfg.get("threshold") or {}).get(profile.form, 999)
-    coeff_value = (
-        (lie_cfg.get("coeff") or {})
-        .get(profile.form, {})
-        .get(profile.impairment, {})
-        .get(profile.gender, 0.0)
-    )
+    coeff_value = cfg.lie_coeff
 
     lie_applied = False
-    if lie_raw >= threshold and coeff_value > 0:
+    if lie_raw >= cfg.lie_threshold and coeff_value > 0:
         lie_applied = True
         for k in list(scales.keys()):
             if k != lie_scale:
                 scales[k] = round(scales[k] * (1 - coeff_value), 2)
 
     # ---------- 3️⃣ Индексы IRP и KVERIPO (строго по методичке) ----------
-    sum_risk = sum(scales.get(s, 0.0) for s in risk_scales)
-    sum_prot = sum(scales.get(s, 0.0) for s in protect_scales)
+    sum_risk = sum(scales.get(s, 0.0) for s in cfg.risk_scales)
+    sum_prot = sum(scales.get(s, 0.0) for s in cfg.protect_scales)
 
     # KVERIPO = ΣФР / ΣФЗ  (если ΣФЗ = 0 → очень высокая уязвимость)
     if sum_prot > 0:
@@ -119,68 +463,30 @@ def compute_emspt(answers_map: Dict[str, int], profile: Profile) -> Dict[str, An
     irp = round((sum_risk / total_rf) * 100.0, 2) if total_rf > 0 else 0.0
 
     # ---------- 4️⃣ Интервалы из norms.yaml ----------
-    # В norms.yaml:
-    #   IRP_bands: {низкий:[min,max], средний:[min,max], высокий:[min,max]}
-    #   KVERIPO_max: float  (порог "в норме")
-    irp_bands = norms.get("IRP_bands", {})
-    kveripo_max = norms.get("KVERIPO_max", None)
+    irp_interval = cfg.irp_bands.label(irp) if cfg.irp_bands else "—"
 
-    def _band_label(value: float, bands: dict) -> str:
-        """Возвращает 'низкий'|'средний'|'высокий' по диапазонам; безопасно для пустых норм."""
-        if not bands:
-            return "—"
-        # перебираем по ключам, чтобы не зависеть от порядка в yaml
-        for label in ("низкий", "средний", "высокий"):
-            rng = bands.get(label)
-            if isinstance(rng, (list, tuple)) and len(rng) == 2:
-                lo, hi = rng
-                if lo <= value <= hi:
-                    return label
-        # если не попали ни в один диапазон
-        try:
-            mins = [v[0] for v in bands.values()]
-            maxs = [v[1] for v in bands.values()]
-            if value < min(mins):
-                return "низкий"
-            if value > max(maxs):
-                return "высокий"
-        except Exception:
-            pass
-        return "средний"
-
-    irp_interval = _band_label(irp, irp_bands)
-
-    if kveripo_max is None:
+    if cfg.kveripo_max is None:
         # если порог не задан — помечаем неизвестно
         kveripo_interval = "—"
     else:
         # по методичке: ≤ порога — уязвимость низкая (норма), > порога — высокая
-        kveripo_interval = "низкий" if kveripo <= float(kveripo_max) else "высокий"
+        kveripo_interval = "низкий" if kveripo <= cfg.kveripo_max else "высокий"
 
     # ---------- 5️⃣ Перевод в стэны ----------
     sten_result = {}
     for scale, raw_value in scales.items():
-        sten_result[scale] = _convert_to_sten(sten_table, scale, raw_value)
+        sten_result[scale] = cfg.to_sten(scale, raw_value)
 
     # ---------- 6️⃣ Интерпретации ----------
-    interpretations_data = _load_interpretations()
     interpretations_result = {}
-    active_scales = set(keys.keys())
-
     for scale, sten_value in sten_result.items():
-        if scale not in active_scales or not sten_value:
+        if scale not in cfg.interpretations or not sten_value:
             continue
-        if 1 <= sten_value <= 3:
-            level = "low"
-        elif 4 <= sten_value <= 7:
-            level = "mid"
-        else:
-            level = "high"
-        text = interpretations_data.get(scale, {}).get(level, "")
+        level = _sten_level(sten_value)
         interpretations_result[scale] = {
             "sten": sten_value,
             "level": level,
-            "text": text or "(описание не задано)"
+            "text": cfg.interpretations[scale][level],
         }
 
     # ---------- 7️⃣ Возврат результата ----------
@@ -198,33 +504,5 @@ def compute_emspt(answers_map: Dict[str, int], profile: Profile) -> Dict[str, An
     }
 
 
-# --------------------- Перевод в стэны ---------------------
-
-def _convert_to_sten(sten_table: Dict[str, Any], scale: str, value: float) -> int:
-    """
-    Перевод "сырых" баллов в стэны.
-    Формат:
-      PPZ:
-        - [1,9]
-        - [10,15]
-        ...
-    Возвращает номер интервала (1–10), в который попадает значение.
-    """
-    if not sten_table or scale not in sten_table:
-        return 0
-
-    intervals = sten_table[scale]
-    if not isinstance(intervals, list):
-        return 0
-
-    for i, rng in enumerate(intervals, start=1):
-        if isinstance(rng, list) and len(rng) == 2:
-            low, high = rng
-            if low <= value <= high:
-                return i
-
-    # если выше последнего интервала — присваиваем 10
-    if intervals and isinstance(intervals[-1], list):
-        return 10
-
-    return 0
+# Снимок подхватываем при импорте: первый расчёт не разбирает YAML
+load_snapshot_configs()
@@ -0,0 +1,164 @@
+"""
+Групповая фиксация записей (group commit) для пиковых волн submit-answers.
+
+Когда класс заканчивает тест одновременно, каждый submit-answers делает
+свой COMMIT, и на SQLite писатели выстраиваются в очередь за блокировкой,
+а пропускная способность упирается в число fsync в секунду. В этом режиме
+запрос сам читает и считает результат, а запись отдаёт единственному
+потоку-писателю. Тот копит записи до GROUP_COMMIT_MAX штук или
+GROUP_COMMIT_MS миллисекунд, применяет их в одной транзакции (каждую —
+в своей точке сохранения: отказ одной записи не откатывает соседние) и
+делает один COMMIT.
+
+Запрос получает ответ только после этого COMMIT: если процесс упадёт
+раньше, ни один клиент не увидит 200 за незаписанный результат. Запрос,
+не дождавшийся COMMIT, может отменить Future: запись, которую писатель
+ещё не взял, тогда пропускается.
+
+    SUBMIT_GROUP_COMMIT=1  GROUP_COMMIT_MS=5  GROUP_COMMIT_MAX=64
+"""
+from __future__ import annotations
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from sqlalchemy.orm import Session
+
+from SPTOVZ.database import WriteSessionLocal
+
+GROUP_COMMIT = os.getenv("SUBMIT_GROUP_COMMIT", "0") == "1"
+GROUP_COMMIT_MS = float(os.getenv("GROUP_COMMIT_MS") or 5)
+GROUP_COMMIT_MAX = int(os.getenv("GROUP_COMMIT_MAX") or 64)
+# Сколько запрос ждёт фиксации; дольше — 503 (запись, уже взятая писателем, может ещё пройти)
+GROUP_COMMIT_TIMEOUT_S = float(os.getenv("GROUP_COMMIT_TIMEOUT_S") or 30)
+
+
+class GroupCommitWriter:
+    """
+    Один поток-писатель. apply(db, item) выполняет запись одного элемента
+    (без commit) или бросает исключение — оно уходит в Future этого элемента.
+    """
+
+    def __init__(
+        self,
+        apply: Callable[[Session, Any], Any],
+        max_delay_ms: float = GROUP_COMMIT_MS,
+        max_batch: int = GROUP_COMMIT_MAX,
+        session_factory: Callable[[], Session] = WriteSessionLocal,
+        name: str = "group-commit",
+    ) -> None:
+        self.apply = apply
+        self.max_delay_s = max_delay_ms / 1000.0
+        self.max_batch = max(max_batch, 1)
+        self.session_factory = session_factory
+        self.name = name
+        self._queue: "queue.Queue[Tuple[Any, Future]]" = queue.Queue()
+        self._thread: Optional[threading.Thread] = None
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+        self.batches = 0
+        self.items = 0
+        self.failed_batches = 0
+        self.max_seen = 0
+        self.flush_s = 0.0
+
+    # --------------------- Жизненный цикл ---------------------
+
+    def start(self) -> "GroupCommitWriter":
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._stop.clear()
+                self._thread = threading.Thread(target=self._loop, name=self.name, daemon=True)
+                self._thread.start()
+        return self
+
+    def stop(self, timeout: float = 10.0) -> None:
+        """Останавливает писателя, дописав то, что уже в очереди."""
+        with self._lock:
+            thread, self._thread = self._thread, None
+        if thread is None:
+            return
+        self._stop.set()
+        thread.join(timeout)
+
+    def submit(self, item: Any) -> Future:
+        """Ставит запись в очередь; Future завершится после COMMIT её пачки."""
+        if self._thread is None:
+            self.start()
+        future: Future = Future()
+        self._queue.put((item, future))
+        return future
+
+    # --------------------- Писатель ---------------------
+
+    def _collect(self) -> List[Tuple[Any, Future]]:
+        try:
+            batch = [self._queue.get(timeout=0.2)]
+        except queue.Empty:
+            return []
+        deadline = time.monotonic() + self.max_delay_s
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _loop(self) -> None:
+        while not (self._stop.is_set() and self._queue.empty()):
+            batch = self._collect()
+            if batch:
+                self._flush(batch)
+
+    def _flush(self, batch: List[Tuple[Any, Future]]) -> None:
+        # отменённые (не дождавшиеся запросы) не пишем; остальные больше нельзя отменить
+        batch = [(item, future) for item, future in batch if future.set_running_or_notify_cancel()]
+        if not batch:
+            return
+        started = time.perf_counter()
+        outcomes: List[Tuple[bool, Any]] = []
+        try:
+            with self.session_factory() as db:
+                for item, _ in batch:
+                    try:
+                        with db.begin_nested():
+                            outcomes.append((True, self.apply(db, item)))
+                    except Exception as exc:
+                        outcomes.append((False, exc))
+                db.commit()
+        except Exception as exc:
+            # COMMIT (или сама транзакция) не удался — не подтверждаем никого
+            with self._lock:
+                self.failed_batches += 1
+            for _, future in batch:
+                future.set_exception(exc)
+            return
+        with self._lock:
+            self.batches += 1
+            self.items += len(batch)
+            self.max_seen = max(self.max_seen, len(batch))
+            self.flush_s += time.perf_counter() - started
+        for (ok, value), (_, future) in zip(outcomes, batch):
+            if ok:
+                future.set_result(value)
+            else:
+                future.set_exception(value)
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "running": self._thread is not None,
+                "queued": self._queue.qsize(),
+                "batches": self.batches,
+                "items": self.items,
+                "failed_batches": self.failed_batches,
+                "batch_max_seen": self.max_seen,
+                "batch_avg": round(self.items / self.batches, 2) if self.batches else 0.0,
+                "flush_avg_ms": round(self.flush_s / self.batches * 1000, 3) if self.batches else 0.0,
+            }
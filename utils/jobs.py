@@ -0,0 +1,423 @@
+"""
+Фоновые задачи без внешнего брокера: очередь — таблица jobs (SQLite/PostgreSQL).
+
+Тяжёлые операции (выгрузки, пересчёт, PDF, импорт каталога) регистрируются
+декоратором @job_handler(kind) рядом со своим кодом и ставятся в очередь
+enqueue(). Воркер забирает задачу одним UPDATE ... RETURNING
+(в PostgreSQL — с FOR UPDATE SKIP LOCKED), пишет прогресс и heartbeat,
+при ошибке повторяет с экспоненциальной отсрочкой, отмена — кооперативная:
+обработчик видит её при следующем ctx.progress().
+
+Воркер работает в процессе приложения (JOBS_WORKER=inprocess, по умолчанию)
+или отдельно — тогда в приложении JOBS_WORKER=off, а тяжёлая работа
+не конкурирует с запросами учеников:
+
+    python -m SPTOVZ.utils.jobs worker --concurrency 2
+    python -m SPTOVZ.utils.jobs enqueue rescore --params '{"workers": 4}'
+    python -m SPTOVZ.utils.jobs list --status running
+    python -m SPTOVZ.utils.jobs cancel <job_id>
+"""
+from __future__ import annotations
+import argparse
+import importlib
+import json
+import os
+import socket
+import threading
+import time
+import traceback
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional, Tuple
+from uuid import uuid4
+
+from sqlalchemy import select, update
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import Session
+
+from SPTOVZ.database import SessionLocal, WriteSessionLocal
+from SPTOVZ.models.job import Job
+
+EXPORT_DIR = Path(os.getenv("EXPORT_DIR") or Path(__file__).resolve().parents[1] / "exports")
+JOBS_WORKER = os.getenv("JOBS_WORKER", "inprocess")
+JOBS_CONCURRENCY = int(os.getenv("JOBS_CONCURRENCY") or 1)
+POLL_S = float(os.getenv("JOBS_POLL_S") or 2.0)
+HEARTBEAT_S = 10.0
+# running без heartbeat дольше STALE_S — воркер умер, задача возвращается в очередь
+STALE_S = float(os.getenv("JOBS_STALE_S") or 120.0)
+RETRY_BASE_S = float(os.getenv("JOBS_RETRY_BASE_S") or 5.0)
+PROGRESS_EVERY_S = 0.5
+
+# Модули с обработчиками: импортируются воркером при старте
+HANDLER_MODULES = (
+    "SPTOVZ.utils.key_codes",
+    "SPTOVZ.utils.pdf_generator",
+    "SPTOVZ.utils.rescore",
+    "SPTOVZ.utils.session_export",
+    "SPTOVZ.utils.test_loader",
+)
+
+
+class JobCancelled(Exception):
+    pass
+
+
+# --------------------- Реестр обработчиков ---------------------
+
+@dataclass(frozen=True)
+class JobHandler:
+    kind: str
+    fn: Callable[..., Optional[Dict[str, Any]]]
+    max_attempts: int
+
+
+HANDLERS: Dict[str, JobHandler] = {}
+
+
+def job_handler(kind: str, max_attempts: int = 3):
+    """Регистрирует fn(ctx, **params) -> dict | None как обработчик задач kind."""
+    def decorator(fn):
+        HANDLERS[kind] = JobHandler(kind, fn, max_attempts)
+        return fn
+    return decorator
+
+
+def load_handlers() -> Dict[str, JobHandler]:
+    for module in HANDLER_MODULES:
+        importlib.import_module(module)
+    return HANDLERS
+
+
+# --------------------- Контекст выполнения ---------------------
+
+@dataclass
+class JobContext:
+    """То, что получает обработчик: параметры, прогресс, проверка отмены, файлы."""
+    job_id: str
+    kind: str
+    attempt: int
+    done: int = 0
+    total: Optional[int] = None
+    _last_write: float = field(default=0.0, repr=False)
+
+    def output_path(self, ext: str) -> Path:
+        EXPORT_DIR.mkdir(parents=True, exist_ok=True)
+        return EXPORT_DIR / f"{self.kind}_{self.job_id}.{ext}"
+
+    def progress(self, done: int, total: Optional[int] = None, message: Optional[str] = None, force: bool = False) -> None:
+        """
+        Сохраняет прогресс (не чаще PROGRESS_EVERY_S) и бросает JobCancelled,
+        если задачу отменили. Вызывать между порциями работы, после commit.
+        """
+        self.done = done
+        if total is not None:
+            self.total = total
+        now = time.monotonic()
+        if not force and now - self._last_write < PROGRESS_EVERY_S:
+            return
+        self._last_write = now
+        values: Dict[str, Any] = {"progress": done, "heartbeat_at": datetime.utcnow()}
+        if self.total is not None:
+            values["total"] = self.total
+        if message is not None:
+            values["message"] = message[:500]
+        with WriteSessionLocal() as db:
+            cancel = db.execute(
+                update(Job).where(Job.id == self.job_id).values(**values).returning(Job.cancel_requested)
+            ).scalar()
+            db.commit()
+        if cancel:
+            raise JobCancelled()
+
+
+# --------------------- Очередь ---------------------
+
+_wakeup = threading.Event()
+
+
+def enqueue(
+    db: Session,
+    kind: str,
+    params: Optional[Dict[str, Any]] = None,
+    owner_id: Optional[str] = None,
+    total: Optional[int] = None,
+    max_attempts: Optional[int] = None,
+) -> Job:
+    """Ставит задачу в очередь (commit) и будит воркер этого процесса."""
+    handler = load_handlers().get(kind)
+    if handler is None:
+        raise ValueError(f"Неизвестный тип задачи: {kind}")
+    job = Job(
+        id=uuid4().hex,
+        kind=kind,
+        status="queued",
+        owner_id=owner_id,
+        params=params or {},
+        total=total,
+        max_attempts=max_attempts or handler.max_attempts,
+    )
+    db.add(job)
+    db.commit()
+    _wakeup.set()
+    return job
+
+
+def job_status(job: Job) -> Dict[str, Any]:
+    return {
+        "job_id": job.id,
+        "kind": job.kind,
+        "status": job.status,
+        "progress": job.progress,
+        "total": job.total,
+        "message": job.message,
+        "attempts": job.attempts,
+        "max_attempts": job.max_attempts,
+        "cancel_requested": job.cancel_requested,
+        "error": job.error,
+        "result": job.result,
+        "created_at": job.created_at.isoformat() if job.created_at else None,
+        "started_at": job.started_at.isoformat() if job.started_at else None,
+        "finished_at": job.finished_at.isoformat() if job.finished_at else None,
+    }
+
+
+def job_file(job: Job) -> Optional[Path]:
+    """Файл результата готовой задачи (если обработчик его создал)."""
+    name = (job.result or {}).get("file") if job.status == "done" else None
+    return EXPORT_DIR / name if name else None
+
+
+def cancel_job(db: Session, job: Job) -> Job:
+    """Ожидающая задача отменяется сразу, выполняющаяся — на ближайшем ctx.progress()."""
+    if job.status == "queued":
+        job.status = "cancelled"
+        job.finished_at = datetime.utcnow()
+    elif job.status == "running":
+        job.cancel_requested = True
+    db.commit()
+    return job
+
+
+def claim_next(db: Session, worker_id: str) -> Optional[Tuple[str, str, Dict[str, Any], int]]:
+    """Атомарно забирает самую раннюю готовую задачу: (id, kind, params, attempt)."""
+    now = datetime.utcnow()
+    candidate = (
+        select(Job.id)
+        .where(Job.status == "queued", Job.run_after <= now)
+        .order_by(Job.run_after, Job.created_at)
+        .limit(1)
+        .with_for_update(skip_locked=True)
+        .scalar_subquery()
+    )
+    row = db.execute(
+        update(Job)
+        .where(Job.id == candidate, Job.status == "queued")
+        .values(status="running", worker_id=worker_id, started_at=now, heartbeat_at=now,
+                attempts=Job.attempts + 1, error=None)
+        .returning(Job.id, Job.kind, Job.params, Job.attempts)
+        .execution_options(synchronize_session=False)
+    ).first()
+    db.commit()
+    return tuple(row) if row else None
+
+
+def requeue_stale(db: Session) -> int:
+    """Возвращает в очередь задачи, воркер которых перестал слать heartbeat."""
+    stale = datetime.utcnow() - timedelta(seconds=STALE_S)
+    base = update(Job).where(Job.status == "running", Job.heartbeat_at < stale)
+    failed = db.execute(
+        base.where(Job.attempts >= Job.max_attempts)
+        .values(status="error", error="воркер перестал отвечать", finished_at=datetime.utcnow())
+        .execution_options(synchronize_session=False)
+    ).rowcount
+    requeued = db.execute(
+        base.values(status="queued", worker_id=None, run_after=datetime.utcnow())
+        .execution_options(synchronize_session=False)
+    ).rowcount
+    db.commit()
+    return failed + requeued
+
+
+def _update_claimed(job_id: str, claimed_by: str, **values: Any) -> None:
+    """UPDATE задачи, пока она числится за этим воркером (после requeue_stale — уже нет)."""
+    with WriteSessionLocal() as db:
+        db.execute(
+            update(Job)
+            .where(Job.id == job_id, Job.worker_id == claimed_by, Job.status == "running")
+            .values(**values)
+            .execution_options(synchronize_session=False)
+        )
+        db.commit()
+
+
+def run_job(job_id: str, kind: str, params: Dict[str, Any], attempt: int, worker_id: str) -> str:
+    """Выполняет забранную задачу и записывает итог. Возвращает новый статус."""
+    handler = load_handlers().get(kind)
+    ctx = JobContext(job_id=job_id, kind=kind, attempt=attempt)
+    stop_beat = threading.Event()
+
+    def _beat() -> None:
+        # heartbeat для долгих шагов без ctx.progress (импорт, рендер класса)
+        while not stop_beat.wait(HEARTBEAT_S):
+            try:
+                _update_claimed(job_id, worker_id, heartbeat_at=datetime.utcnow())
+            except OperationalError:
+                pass
+
+    beat = threading.Thread(target=_beat, name=f"job-beat-{job_id[:8]}", daemon=True)
+    beat.start()
+    try:
+        if handler is None:
+            raise RuntimeError(f"Нет обработчика для задач {kind}")
+        result = handler.fn(ctx, **params) or {}
+        # в JSON-столбец — только сериализуемое (пути, даты → строки)
+        result = json.loads(json.dumps(result, ensure_ascii=False, default=str))
+        _update_claimed(job_id, worker_id, status="done", result=result, progress=ctx.total or ctx.done,
+                finished_at=datetime.utcnow())
+        return "done"
+    except JobCancelled:
+        _update_claimed(job_id, worker_id, status="cancelled", finished_at=datetime.utcnow())
+        return "cancelled"
+    except Exception as e:
+        error = f"{type(e).__name__}: {e}"
+        max_attempts = handler.max_attempts if handler else 1
+        with SessionLocal() as db:
+            max_attempts = db.scalar(select(Job.max_attempts).where(Job.id == job_id)) or max_attempts
+        if attempt < max_attempts:
+            delay = RETRY_BASE_S * (2 ** (attempt - 1))
+            _update_claimed(job_id, worker_id, status="queued", error=error, worker_id=None,
+                    run_after=datetime.utcnow() + timedelta(seconds=delay))
+            return "queued"
+        traceback.print_exc()
+        _update_claimed(job_id, worker_id, status="error", error=error, finished_at=datetime.utcnow())
+        return "error"
+    finally:
+        stop_beat.set()
+
+
+# --------------------- Воркер ---------------------
+
+class JobWorker:
+    """concurrency потоков, каждый забирает и выполняет задачи по одной."""
+
+    def __init__(self, concurrency: int = JOBS_CONCURRENCY, poll_s: float = POLL_S) -> None:
+        self.concurrency = max(concurrency, 1)
+        self.poll_s = poll_s
+        self._stop = threading.Event()
+        self._threads: List[threading.Thread] = []
+        self._lock = threading.Lock()
+        self.running = 0
+        self.finished: Dict[str, int] = {}
+        self._prefix = f"{socket.gethostname()}:{os.getpid()}"
+
+    def start(self) -> "JobWorker":
+        load_handlers()
+        for i in range(self.concurrency):
+            t = threading.Thread(target=self._loop, args=(f"{self._prefix}:{i}",), name=f"job-worker-{i}", daemon=True)
+            t.start()
+            self._threads.append(t)
+        return self
+
+    def stop(self, timeout: float = 5.0) -> None:
+        self._stop.set()
+        _wakeup.set()
+        for t in self._threads:
+            t.join(timeout)
+        self._threads.clear()
+
+    def _loop(self, worker_id: str) -> None:
+        last_stale_check = 0.0
+        while not self._stop.is_set():
+            try:
+                with WriteSessionLocal() as db:
+                    if time.monotonic() - last_stale_check > STALE_S / 4:
+                        requeue_stale(db)
+                        last_stale_check = time.monotonic()
+                    claimed = claim_next(db, worker_id)
+            except OperationalError:
+                claimed = None
+            if claimed is None:
+                _wakeup.wait(self.poll_s)
+                _wakeup.clear()
+                continue
+            with self._lock:
+                self.running += 1
+            try:
+                status = run_job(*claimed, worker_id=worker_id)
+            finally:
+                with self._lock:
+                    self.running -= 1
+            with self._lock:
+                self.finished[status] = self.finished.get(status, 0) + 1
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            return {"concurrency": self.concurrency, "running": self.running, "finished": dict(self.finished)}
+
+
+worker: Optional[JobWorker] = None
+
+
+def start_inprocess_worker() -> Optional[JobWorker]:
+    """Запуск воркера в процессе приложения (если JOBS_WORKER=inprocess)."""
+    global worker
+    if JOBS_WORKER != "inprocess" or worker is not None:
+        return worker
+    worker = JobWorker().start()
+    return worker
+
+
+def stop_inprocess_worker() -> None:
+    global worker
+    if worker is not None:
+        worker.stop()
+        worker = None
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Фоновые задачи")
+    sub = parser.add_subparsers(dest="command", required=True)
+    p_worker = sub.add_parser("worker", help="запустить воркер")
+    p_worker.add_argument("--concurrency", type=int, default=JOBS_CONCURRENCY)
+    p_enqueue = sub.add_parser("enqueue", help="поставить задачу в очередь")
+    p_enqueue.add_argument("kind")
+    p_enqueue.add_argument("--params", default="{}", help="параметры обработчика (JSON)")
+    p_list = sub.add_parser("list", help="последние задачи")
+    p_list.add_argument("--status")
+    p_list.add_argument("--limit", type=int, default=20)
+    p_cancel = sub.add_parser("cancel", help="отменить задачу")
+    p_cancel.add_argument("job_id")
+    args = parser.parse_args()
+
+    if args.command == "worker":
+        w = JobWorker(concurrency=args.concurrency).start()
+        print(f"[*] Воркер запущен: {w.concurrency} потоков, обработчики: {', '.join(sorted(HANDLERS))}")
+        try:
+            while True:
+                time.sleep(3600)
+        except KeyboardInterrupt:
+            w.stop()
+    else:
+        with WriteSessionLocal() as db:
+            if args.command == "enqueue":
+                job = enqueue(db, args.kind, json.loads(args.params))
+                print(job.id)
+            elif args.command == "list":
+                q = select(Job).order_by(Job.created_at.desc()).limit(args.limit)
+                if args.status:
+                    q = q.where(Job.status == args.status)
+                for job in db.scalars(q):
+                    print(json.dumps(job_status(job), ensure_ascii=False))
+            else:
+                job = db.get(Job, args.job_id)
+                if job is None:
+                    raise SystemExit("Задача не найдена")
+                print(json.dumps(job_status(cancel_job(db, job)), ensure_ascii=False))
+
+
+if __name__ == "__main__":
+    # Запуск через -m грузит этот файл как __main__, а обработчики регистрируются
+    # в SPTOVZ.utils.jobs — работаем с реестром пакетного модуля
+    from SPTOVZ.utils.jobs import main as _main
+    _main()
@@ -0,0 +1,151 @@
+"""
+Пакетная выдача кодов доступа (Key).
+
+Коды — CODE_LENGTH символов из алфавита без похожих 0/O, 1/I
+(32^8 ≈ 10^12 вариантов). Уникальность проверяется одним IN-запросом
+на пачку кандидатов, повторно генерируются только совпавшие; вставка —
+многострочным INSERT. Конкурентная вставка того же кода ловится
+по IntegrityError внутри SAVEPOINT и повторяется.
+
+Большие партии генерируются фоновой задачей keys_export (utils/jobs.py)
+порциями и выгружаются в CSV.
+"""
+from __future__ import annotations
+import csv
+import secrets
+from datetime import datetime
+from typing import Any, Dict, List, Set
+from uuid import uuid4
+
+from sqlalchemy import insert, select
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+
+from SPTOVZ.database import WriteSessionLocal
+from SPTOVZ.models.class_group import Class, Key
+from SPTOVZ.utils.jobs import JobContext, job_handler
+from SPTOVZ.utils.stats_rollup import record_keys_generated
+
+CODE_ALPHABET = "23456789ABCDEFGHJKLMNPQRSTUVWXYZ"
+CODE_LENGTH = 8
+
+# Параметров в одном запросе: у SQLite лимит 32766 на запрос
+IN_CHUNK = 5000
+INSERT_CHUNK = 1000
+MAX_ATTEMPTS = 5
+
+# Синхронно (в ответе запроса) — до MAX_SYNC_KEYS, больше — через выгрузку
+MAX_SYNC_KEYS = 5000
+MAX_EXPORT_KEYS = 200_000
+EXPORT_CHUNK = 5000
+
+
+def _random_code(length: int = CODE_LENGTH) -> str:
+    return "".join(secrets.choice(CODE_ALPHABET) for _ in range(length))
+
+
+def _existing_codes(db: Session, codes: List[str]) -> Set[str]:
+    taken: Set[str] = set()
+    for i in range(0, len(codes), IN_CHUNK):
+        chunk = codes[i:i + IN_CHUNK]
+        taken.update(db.scalars(select(Key.code).where(Key.code.in_(chunk))))
+    return taken
+
+
+def unique_codes(db: Session, count: int, length: int = CODE_LENGTH) -> List[str]:
+    """
+    Возвращает count кодов, которых нет в БД. Кандидаты проверяются
+    одним запросом; при совпадениях перегенерируются только совпавшие.
+    """
+    codes: Set[str] = set()
+    for _ in range(MAX_ATTEMPTS):
+        need = count - len(codes)
+        if need <= 0:
+            break
+        candidates: Set[str] = set()
+        while len(candidates) < need:
+            code = _random_code(length)
+            if code not in codes:
+                candidates.add(code)
+        candidates -= _existing_codes(db, sorted(candidates))
+        codes |= candidates
+    if len(codes) < count:
+        raise RuntimeError("Не удалось подобрать уникальные коды, увеличьте CODE_LENGTH")
+    return list(codes)
+
+
+def issue_keys(
+    db: Session,
+    cls: Class,
+    education_type: str,
+    form_type: str,
+    count: int,
+    when: datetime | None = None,
+) -> List[str]:
+    """
+    Создаёт count ключей класса и учитывает их в stats_rollup.
+    Не коммитит: фиксация — на вызывающей стороне.
+    """
+    now = when or datetime.utcnow()
+    for attempt in range(MAX_ATTEMPTS):
+        codes = unique_codes(db, count)
+        rows: List[Dict] = [
+            {
+                "id": str(uuid4()),
+                "code": code,
+                "used": False,
+                "class_id": cls.id,
+                "education_type": education_type,
+                "form_type": form_type,
+                "created_at": now,
+            }
+            for code in codes
+        ]
+        try:
+            with db.begin_nested():
+                for i in range(0, len(rows), INSERT_CHUNK):
+                    db.execute(insert(Key).values(rows[i:i + INSERT_CHUNK]))
+        except IntegrityError:
+            # код заняли параллельно между проверкой и вставкой — пробуем снова
+            if attempt == MAX_ATTEMPTS - 1:
+                raise
+            continue
+        record_keys_generated(db, cls, form_type, count, when=now)
+        return codes
+    return []
+
+
+# --------------------- Фоновая выгрузка больших партий ---------------------
+
+# Повтор после сбоя выдал бы ключи второй раз — задача не повторяется
+@job_handler("keys_export", max_attempts=1)
+def export_keys_job(ctx: JobContext, class_id: str, education_type: str, form_type: str, count: int) -> Dict[str, Any]:
+    """
+    Генерирует ключи порциями по EXPORT_CHUNK (каждая — своя транзакция)
+    и дописывает их в CSV. Файл появляется под итоговым именем только целиком.
+    """
+    target = ctx.output_path("csv")
+    part = target.with_suffix(".part")
+    done = 0
+    try:
+        with WriteSessionLocal() as db, part.open("w", encoding="utf-8", newline="") as f:
+            cls = db.get(Class, class_id)
+            if cls is None:
+                raise RuntimeError("Класс не найден")
+            # после commit обращение к cls.name открыло бы новую транзакцию
+            class_name = cls.name
+            writer = csv.writer(f)
+            writer.writerow(["code", "class_name", "form", "education_type"])
+            while done < count:
+                n = min(EXPORT_CHUNK, count - done)
+                codes = issue_keys(db, cls, education_type, form_type, n)
+                db.commit()
+                writer.writerows([code, class_name, form_type, education_type] for code in codes)
+                done += n
+                ctx.progress(done, count)
+    except BaseException:
+        # отмена или ошибка: выданные ключи остаются, неполный файл — нет
+        part.unlink(missing_ok=True)
+        raise
+    part.replace(target)
+    return {"file": target.name, "media_type": "text/csv", "count": done}
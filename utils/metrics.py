@@ -0,0 +1,322 @@
+"""
+Инструментирование горячих путей и текстовый формат Prometheus для /metrics.
+
+- MetricsMiddleware (ASGI): задержка по шаблону маршрута
+  (/session/result/{session_id}, а не конкретный id), методу и статусу;
+- хуки SQLAlchemy на всех Engine (в т.ч. sync_engine у AsyncEngine):
+  число запросов и время в БД — общие гистограммы и разбивка по запросу;
+- span("name") / @timed("name"): участки кода (compute_emspt, сборка
+  конфигурации ЕМ СПТ из YAML, select_test, import_all, JSON-ответ);
+- медленные запросы: METRICS_SLOW_MS > 0 — строка в лог SPTOVZ.slow
+  с разбивкой «БД / спаны / остальное».
+
+Разбивка по запросу живёт в contextvar: его видят и потоки пула
+(run_in_threadpool копирует контекст), и run_sync у AsyncSession.
+Значения — в памяти процесса; при нескольких воркерах uvicorn
+Prometheus опрашивает каждый процесс.
+"""
+from __future__ import annotations
+import functools
+import logging
+import os
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from fastapi.responses import JSONResponse
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Session
+
+METRICS_ENABLED = os.getenv("METRICS", "1") != "0"
+SLOW_MS = float(os.getenv("METRICS_SLOW_MS") or 0)
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+COUNT_BUCKETS = (1, 2, 3, 5, 8, 13, 21, 34, 55, 89)
+
+slow_log = logging.getLogger("SPTOVZ.slow")
+
+
+# --------------------- Метрики ---------------------
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names: Tuple[str, ...], values: Tuple[Any, ...], extra: str = "") -> str:
+    parts = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def _number(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    def __init__(self, name: str, help: str, labelnames: Tuple[str, ...] = ()) -> None:
+        self.name, self.help, self.labelnames = name, help, labelnames
+        self._values: Dict[Tuple[Any, ...], float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *labels: Any, amount: float = 1) -> None:
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def render(self) -> Iterator[str]:
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} counter"
+        with self._lock:
+            items = list(self._values.items())
+        for labels, value in items:
+            yield f"{self.name}{_labels(self.labelnames, labels)} {_number(value)}"
+
+
+class Histogram:
+    """Гистограмма с фиксированными корзинами (le — включительно, как в Prometheus)."""
+
+    def __init__(self, name: str, help: str, labelnames: Tuple[str, ...] = (),
+                 buckets: Tuple[float, ...] = LATENCY_BUCKETS) -> None:
+        self.name, self.help, self.labelnames = name, help, labelnames
+        self.buckets = tuple(buckets)
+        # labels -> [счётчики корзин..., +Inf], сумма
+        self._series: Dict[Tuple[Any, ...], Tuple[List[int], List[float]]] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, *labels: Any) -> None:
+        idx = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = ([0] * (len(self.buckets) + 1), [0.0])
+            series[0][idx] += 1
+            series[1][0] += value
+
+    def render(self) -> Iterator[str]:
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} histogram"
+        with self._lock:
+            items = [(labels, list(counts), total[0]) for labels, (counts, total) in self._series.items()]
+        for labels, counts, total in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = 'le="' + _number(float(bound)) + '"'
+                yield f"{self.name}_bucket{_labels(self.labelnames, labels, le)} {cumulative}"
+            yield f"{self.name}_sum{_labels(self.labelnames, labels)} {_number(total)}"
+            yield f"{self.name}_count{_labels(self.labelnames, labels)} {cumulative}"
+
+
+http_duration = Histogram(
+    "sptovz_http_request_duration_seconds", "Время обработки HTTP-запроса",
+    ("method", "route", "status"),
+)
+http_db_queries = Histogram(
+    "sptovz_http_request_db_queries", "Запросов к БД за один HTTP-запрос",
+    ("route",), COUNT_BUCKETS,
+)
+http_db_time = Histogram(
+    "sptovz_http_request_db_seconds", "Время в БД за один HTTP-запрос", ("route",),
+)
+db_query_time = Histogram("sptovz_db_query_seconds", "Время одного SQL-запроса", ("op",))
+span_time = Histogram("sptovz_span_seconds", "Время участка кода", ("span",))
+slow_requests = Counter("sptovz_http_slow_requests_total", "Запросы дольше METRICS_SLOW_MS", ("route",))
+
+METRICS: List[Any] = [http_duration, http_db_queries, http_db_time, db_query_time, span_time, slow_requests]
+
+# Сборщики мгновенных значений (пулы, кэши, воркер задач) — регистрирует routers/metrics.py
+Gauge = Tuple[str, str, Iterable[Tuple[Dict[str, Any], float]]]
+_collectors: List[Callable[[], Iterable[Gauge]]] = []
+
+
+def register_collector(collect: Callable[[], Iterable[Gauge]]) -> None:
+    _collectors.append(collect)
+
+
+def render_metrics() -> str:
+    lines: List[str] = []
+    for metric in METRICS:
+        lines.extend(metric.render())
+    # один gauge может прийти несколькими порциями (например, пул sync и async)
+    gauges: Dict[str, Tuple[str, List[Tuple[Dict[str, Any], float]]]] = {}
+    for collect in _collectors:
+        for name, help, samples in collect():
+            gauges.setdefault(name, (help, []))[1].extend(samples)
+    for name, (help, samples) in gauges.items():
+        lines.append(f"# HELP {name} {help}")
+        lines.append(f"# TYPE {name} gauge")
+        for labels, value in samples:
+            names = tuple(labels)
+            lines.append(f"{name}{_labels(names, tuple(labels[n] for n in names))} {_number(value)}")
+    return "\n".join(lines) + "\n"
+
+
+# --------------------- Разбивка по запросу ---------------------
+
+@dataclass
+class RequestStats:
+    queries: int = 0
+    db_s: float = 0.0
+    spans: Dict[str, float] = field(default_factory=dict)
+
+
+_current: ContextVar[Optional[RequestStats]] = ContextVar("sptovz_request_stats", default=None)
+
+
+def current_stats() -> Optional[RequestStats]:
+    return _current.get()
+
+
+@contextmanager
+def span(name: str) -> Iterator[None]:
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - started
+        span_time.observe(elapsed, name)
+        stats = _current.get()
+        if stats is not None:
+            stats.spans[name] = stats.spans.get(name, 0.0) + elapsed
+
+
+def timed(name: str) -> Callable[[Callable[..., Any]], Callable[..., Any]]:
+    """Декоратор: вызов функции — спан name."""
+    def decorate(fn: Callable[..., Any]) -> Callable[..., Any]:
+        @functools.wraps(fn)
+        def wrapper(*args: Any, **kwargs: Any) -> Any:
+            with span(name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+# --------------------- SQLAlchemy ---------------------
+
+def _statement_op(statement: str) -> str:
+    op = statement.lstrip()[:6].upper()
+    return op if op in ("SELECT", "INSERT", "UPDATE", "DELETE") else "OTHER"
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("sptovz_query_started", []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    started = conn.info.get("sptovz_query_started")
+    if not started:
+        return
+    elapsed = time.perf_counter() - started.pop()
+    db_query_time.observe(elapsed, _statement_op(statement))
+    stats = _current.get()
+    if stats is not None:
+        stats.queries += 1
+        stats.db_s += elapsed
+
+
+def _handle_error(context):
+    started = context.connection.info.get("sptovz_query_started") if context.connection is not None else None
+    if started:
+        started.pop()
+
+
+def _before_commit(session):
+    stats = _current.get()
+    session.info["sptovz_commit_started"] = (time.perf_counter(), stats.db_s if stats is not None else 0.0)
+
+
+def _after_commit(session):
+    # flush внутри commit уже учтён как запросы к БД; остаток — сам COMMIT (fsync)
+    started = session.info.pop("sptovz_commit_started", None)
+    if started is None:
+        return
+    stats = _current.get()
+    elapsed = time.perf_counter() - started[0]
+    if stats is not None:
+        elapsed = max(0.0, elapsed - (stats.db_s - started[1]))
+        stats.spans["db_commit"] = stats.spans.get("db_commit", 0.0) + elapsed
+    span_time.observe(elapsed, "db_commit")
+
+
+def _after_rollback(session):
+    session.info.pop("sptovz_commit_started", None)
+
+
+if METRICS_ENABLED:
+    # На классах Engine/Session: ловит и объекты, созданные позже (бенчмарки, CLI),
+    # и AsyncSession (события идут от её sync_session)
+    event.listen(Engine, "before_cursor_execute", _before_cursor_execute)
+    event.listen(Engine, "after_cursor_execute", _after_cursor_execute)
+    event.listen(Engine, "handle_error", _handle_error)
+    event.listen(Session, "before_commit", _before_commit)
+    event.listen(Session, "after_commit", _after_commit)
+    event.listen(Session, "after_rollback", _after_rollback)
+
+
+# --------------------- ASGI ---------------------
+
+class TimedJSONResponse(JSONResponse):
+    """JSONResponse, сериализация которого — спан json_render."""
+
+    def render(self, content: Any) -> bytes:
+        with span("json_render"):
+            return super().render(content)
+
+
+def _route_name(scope: Dict[str, Any]) -> str:
+    # FastAPI кладёт совпавший маршрут в scope["route"] во время роутинга
+    route = scope.get("route")
+    return getattr(route, "path", None) or "unmatched"
+
+
+def _log_slow(method: str, route: str, status: int, elapsed: float, stats: RequestStats) -> None:
+    spans_s = sum(stats.spans.values())
+    parts = [f"БД {stats.queries} запр. / {stats.db_s * 1000:.1f} мс"]
+    parts += [f"{name} {value * 1000:.1f} мс" for name, value in sorted(stats.spans.items(), key=lambda kv: -kv[1])]
+    parts.append(f"прочее {max(0.0, elapsed - stats.db_s - spans_s) * 1000:.1f} мс")
+    slow_log.warning("медленный запрос %s %s %s %.1f мс: %s", method, route, status, elapsed * 1000, ", ".join(parts))
+
+
+class MetricsMiddleware:
+    """
+    Чистый ASGI-middleware (без BaseHTTPMiddleware: не буферизует ответ
+    и не ломает StreamingResponse). Время — до последнего байта ответа.
+    """
+
+    def __init__(self, app) -> None:
+        self.app = app
+
+    async def __call__(self, scope, receive, send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        stats = RequestStats()
+        token = _current.set(stats)
+        status = 500
+        started = time.perf_counter()
+
+        async def _send(message) -> None:
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, _send)
+        finally:
+            elapsed = time.perf_counter() - started
+            _current.reset(token)
+            route = _route_name(scope)
+            http_duration.observe(elapsed, scope["method"], route, status)
+            http_db_queries.observe(stats.queries, route)
+            http_db_time.observe(stats.db_s, route)
+            if SLOW_MS and elapsed * 1000 >= SLOW_MS:
+                slow_requests.inc(route)
+                _log_slow(scope["method"], route, status, elapsed, stats)
@@ -0,0 +1,289 @@
+"""
+Лёгкие миграции схемы поверх Base.metadata.create_all.
+
+create_all создаёт только отсутствующие таблицы, поэтому новые столбцы
+и индексы существующих таблиц добавляются здесь: upgrade_schema сверяет
+модели с БД и выполняет ALTER TABLE ADD COLUMN / CREATE INDEX.
+Добавлять так можно только nullable-столбцы (или со server_default).
+
+Заполнение новых столбцов для старых строк — отдельными командами:
+
+    python -m SPTOVZ.utils.migrations                # только схема
+    python -m SPTOVZ.utils.migrations --backfill     # схема + заполнение + stats_rollup
+    python -m SPTOVZ.utils.migrations --drop-legacy  # сверка и удаление JSON-столбцов сессий
+    python -m SPTOVZ.utils.migrations --vacuum       # + VACUUM (SQLite) после удаления
+
+JSON-столбцы answers/result сессий при старте приложения только
+переписываются в упакованные (pack_legacy_sessions): новый код их не
+читает, но и не удаляет. Удаление — явно, через --drop-legacy: сначала
+сверка всех строк, при любом расхождении столбцы остаются.
+"""
+from __future__ import annotations
+import argparse
+import json
+from typing import Any, Callable, Dict, Iterator, List, Optional, Union
+
+from sqlalchemy import JSON, column, func, inspect, or_, select, table, update
+from sqlalchemy.engine import Connection, Engine
+from sqlalchemy.orm import Session
+from sqlalchemy.schema import CreateIndex
+
+from SPTOVZ.database import WRITE_TX, Base
+from SPTOVZ import models  # noqa: F401  (регистрирует все таблицы в metadata)
+from SPTOVZ.models.class_group import Key
+from SPTOVZ.models.session import (
+    RESULT_COLUMNS,
+    TestSession,
+    decode_result,
+    encode_result,
+    pack_answers,
+    unpack_answers,
+)
+from SPTOVZ.utils.stats_rollup import reconcile
+from SPTOVZ.utils.test_catalog import catalog_index
+
+
+# --------------------- Схема ---------------------
+
+def upgrade_schema(engine: Engine) -> List[str]:
+    """
+    Добавляет недостающие столбцы и индексы существующих таблиц.
+    Возвращает список выполненных изменений (пустой — схема актуальна).
+    """
+    applied: List[str] = []
+    with engine.begin() as conn:
+        insp = inspect(conn)
+        existing_tables = set(insp.get_table_names())
+        for table in Base.metadata.sorted_tables:
+            if table.name not in existing_tables:
+                continue
+            columns = {c["name"] for c in insp.get_columns(table.name)}
+            for column in table.columns:
+                if column.name in columns:
+                    continue
+                col_type = column.type.compile(dialect=conn.dialect)
+                ddl = f'ALTER TABLE {table.name} ADD COLUMN {column.name} {col_type}'
+                if column.server_default is not None:
+                    ddl += f" DEFAULT {column.server_default.arg}"
+                conn.exec_driver_sql(ddl)
+                applied.append(f"{table.name}.{column.name}")
+
+            indexes = {ix["name"] for ix in insp.get_indexes(table.name)}
+            for index in table.indexes:
+                if index.name not in indexes:
+                    conn.execute(CreateIndex(index))
+                    applied.append(f"index {index.name}")
+    return applied
+
+
+# --------------------- Заполнение данных ---------------------
+
+# JSON-столбцы test_sessions до упакованного хранения ответов и результатов
+LEGACY_SESSION_COLUMNS = ("answers", "result")
+# Сколько строк с расхождениями выводить в отчёт --drop-legacy
+MISMATCH_REPORT_LIMIT = 20
+
+
+def _legacy_session_columns(conn: Connection) -> List[str]:
+    columns = {c["name"] for c in inspect(conn).get_columns(TestSession.__tablename__)}
+    return [name for name in LEGACY_SESSION_COLUMNS if name in columns]
+
+
+def _legacy_sessions_table(legacy: List[str]):
+    """test_sessions с JSON-столбцами, которых больше нет в модели."""
+    stored = TestSession.__table__.c
+    return table(
+        TestSession.__tablename__,
+        *(column(name, stored[name].type) for name in ("id", "test_name", "answers_packed", *RESULT_COLUMNS)),
+        *(column(name, JSON) for name in legacy),
+    )
+
+
+def _iter_chunks(db: Union[Session, Connection], sessions, chunk_size: int, *where) -> Iterator[List[Any]]:
+    """Строки по id порциями (keyset): без OFFSET и без всей таблицы в памяти."""
+    last_id = ""
+    while True:
+        rows = db.execute(
+            select(sessions).where(sessions.c.id > last_id, *where).order_by(sessions.c.id).limit(chunk_size)
+        ).mappings().all()
+        if not rows:
+            return
+        yield rows
+        last_id = rows[-1]["id"]
+
+
+def _as_dict(value: Any) -> Optional[Dict[str, Any]]:
+    if isinstance(value, str):
+        try:
+            value = json.loads(value)
+        except ValueError:
+            return None
+    return value if isinstance(value, dict) else None
+
+
+def pack_legacy_sessions(engine: Engine, chunk_size: int = 1000, report: Callable[[str], None] = print) -> int:
+    """
+    Заполняет упакованные столбцы (answers_packed, scales_raw/scales_sten,
+    lie_raw и индексные) по JSON-столбцам answers/result у сессий, где они
+    ещё пусты. Уже упакованное не трогается (в т.ч. результаты после rescore),
+    JSON-столбцы остаются — удаляет их только drop_legacy_columns после сверки.
+    Строки, которые не удалось упаковать, выводятся в отчёт. Нет JSON-столбцов —
+    ничего не делает.
+    """
+    with engine.connect() as conn:
+        legacy = _legacy_session_columns(conn)
+    if not legacy:
+        return 0
+    sessions = _legacy_sessions_table(legacy)
+    pending = or_(sessions.c.answers_packed.is_(None), sessions.c.scales_sten.is_(None))
+    total = failed = 0
+    with Session(engine.execution_options(**WRITE_TX)) as db:
+        # длина массива ответов — число вопросов теста по паспорту
+        sizes = {code: max(entry.question_ids, default=0) for code, entry in catalog_index(db).by_code.items()}
+        db.rollback()
+        for rows in _iter_chunks(db, sessions, chunk_size, pending):
+            updates: List[Dict[str, Any]] = []
+            for row in rows:
+                values: Dict[str, Any] = {}
+                try:
+                    answers = _as_dict(row.get("answers"))
+                    if answers and row["answers_packed"] is None:
+                        values["answers_packed"] = pack_answers(answers, size=sizes.get(row["test_name"], 0))
+                    result = _as_dict(row.get("result"))
+                    if result and row["scales_sten"] is None:
+                        values.update(encode_result(result, row["form_type"]))
+                except (ValueError, TypeError, KeyError) as e:
+                    failed += 1
+                    report(f"    ! {row['id']}: {type(e).__name__}: {e}")
+                    continue
+                if values:
+                    updates.append({"id": row["id"], **values})
+            if updates:
+                db.execute(update(TestSession), updates)
+            # порция фиксируется сразу: блокировка записи не держится на всю таблицу
+            db.commit()
+            total += len(updates)
+        if total:
+            report(f"[*] Сессий упаковано: {total}")
+    if failed:
+        report(f"[!] Не упаковано {failed} сессий")
+    return total
+
+
+def verify_legacy_sessions(
+    conn: Connection,
+    legacy: List[str],
+    chunk_size: int = 1000,
+    report: Callable[[str], None] = print,
+) -> int:
+    """
+    Сверка упакованных столбцов с JSON-столбцами по всем строкам: ответы
+    (ключи JSON — строки) должны совпасть с unpack_answers(answers_packed),
+    результат — с decode_result(...), как его увидит приложение. Возвращает
+    число расхождений; первые MISMATCH_REPORT_LIMIT выводятся в отчёт.
+    """
+    sessions = _legacy_sessions_table(legacy)
+    mismatched = checked = 0
+    for rows in _iter_chunks(conn, sessions, chunk_size):
+        for row in rows:
+            problems = []
+            answers = _as_dict(row.get("answers"))
+            if answers:
+                try:
+                    expected = {int(qid): value for qid, value in answers.items()}
+                except (TypeError, ValueError):
+                    expected = answers
+                if unpack_answers(row["answers_packed"]) != expected:
+                    problems.append("answers")
+            result = _as_dict(row.get("result"))
+            if result and decode_result(*(row[name] for name in RESULT_COLUMNS)) != result:
+                problems.append("result")
+            checked += 1
+            if problems:
+                mismatched += 1
+                if mismatched <= MISMATCH_REPORT_LIMIT:
+                    report(f"    ! {row['id']}: не совпадает {', '.join(problems)}")
+    report(f"[*] Сверено сессий: {checked}, расхождений: {mismatched}")
+    return mismatched
+
+
+def drop_legacy_columns(engine: Engine, chunk_size: int = 1000, report: Callable[[str], None] = print) -> bool:
+    """
+    Удаляет JSON-столбцы answers/result (необратимо), только если сверка
+    verify_legacy_sessions прошла без расхождений. Сверка и DROP — в одной
+    транзакции с блокировкой записи: между ними строки не изменятся.
+    Результаты, пересчитанные rescore после упаковки, законно расходятся
+    с JSON — удалять столбцы стоит до пересчёта. False — отказ из-за расхождений.
+    """
+    with engine.execution_options(**WRITE_TX).begin() as conn:
+        legacy = _legacy_session_columns(conn)
+        if not legacy:
+            report("[*] JSON-столбцов сессий нет — удалять нечего")
+            return True
+        if verify_legacy_sessions(conn, legacy, chunk_size, report):
+            report(f"[!] Есть расхождения: столбцы {', '.join(legacy)} не удалены")
+            return False
+        for name in legacy:
+            conn.exec_driver_sql(f"ALTER TABLE {TestSession.__tablename__} DROP COLUMN {name}")
+            report(f"[-] {TestSession.__tablename__}.{name}")
+    return True
+
+
+def vacuum(engine: Engine) -> bool:
+    """VACUUM для SQLite: после удаления столбцов файл сам не уменьшается."""
+    if engine.dialect.name != "sqlite":
+        return False
+    raw = engine.raw_connection()
+    try:
+        # isolation_level=None (см. database._setup_sqlite) — VACUUM вне транзакции
+        raw.cursor().execute("VACUUM")
+    finally:
+        raw.close()
+    return True
+
+
+def backfill_key_dates(db: Session) -> int:
+    """
+    Проставляет created_at ключам, выданным до появления столбца:
+    время первого старта теста по ключу, иначе — текущее. Выполняется и при
+    старте приложения: без даты ключ не попадает в stats_rollup.
+    """
+    first_start = (
+        select(func.min(TestSession.started_at))
+        .where(TestSession.key_id == Key.id)
+        .scalar_subquery()
+    )
+    result = db.execute(
+        update(Key)
+        .where(Key.created_at.is_(None))
+        .values(created_at=func.coalesce(first_start, func.current_timestamp()))
+        .execution_options(synchronize_session=False)
+    )
+    db.commit()
+    return result.rowcount
+
+
+if __name__ == "__main__":
+    from SPTOVZ.database import WriteSessionLocal, engine
+
+    parser = argparse.ArgumentParser(description="Миграции схемы СПТ ОВЗ")
+    parser.add_argument("--backfill", action="store_true", help="заполнить новые столбцы у старых строк")
+    parser.add_argument(
+        "--drop-legacy", action="store_true",
+        help="сверить упакованные сессии с JSON и удалить JSON-столбцы (необратимо)",
+    )
+    parser.add_argument("--vacuum", action="store_true", help="сжать файл SQLite после удаления столбцов")
+    args = parser.parse_args()
+
+    Base.metadata.create_all(bind=engine)
+    for change in upgrade_schema(engine):
+        print(f"[+] {change}")
+    pack_legacy_sessions(engine)
+    if args.drop_legacy and not drop_legacy_columns(engine):
+        raise SystemExit(1)
+    if args.vacuum and vacuum(engine):
+        print("[*] VACUUM выполнен")
+    if args.backfill:
+        with WriteSessionLocal() as db:
+            print(f"[*] created_at проставлен ключам: {backfill_key_dates(db)}")
+            reconcile(db, fix=True)
@@ -0,0 +1,474 @@
+"""
+PDF-отчёты по сохранённым результатам TestSession: индивидуальный отчёт
+ученика и сводный отчёт класса.
+
+Индивидуальные отчёты рендерятся в пуле процессов (один на сборку,
+контекст spawn — воркер задач многопоточный) и кэшируются на диске
+по (session_id, хэш данных отчёта): при повторной сборке отчёта класса
+заново рендерятся только изменившиеся сессии (например, после rescore).
+Сводная страница класса дешёвая и собирается каждый раз.
+
+Итог — один PDF (сводка класса, затем ученики; нужен pypdf) или zip
+с отдельными файлами. Из приложения сборка идёт фоновой задачей pdf_report
+(utils/jobs.py).
+
+    python -m SPTOVZ.utils.pdf_generator --class <id> -o class.pdf
+    python -m SPTOVZ.utils.pdf_generator --institution <id> --format zip -o reports.zip
+
+Шрифт с кириллицей — PDF_FONT (путь к TTF), иначе DejaVuSans из системы.
+"""
+from __future__ import annotations
+import argparse
+import hashlib
+import io
+import json
+import multiprocessing
+import os
+import re
+import time
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+from xml.sax.saxutils import escape
+
+from sqlalchemy import select
+from sqlalchemy.orm import Session
+
+from SPTOVZ.models.class_group import Class, Key
+from SPTOVZ.models.institution import Institution
+from SPTOVZ.models.session import TestSession, decode_result, result_columns
+from SPTOVZ.utils.jobs import EXPORT_DIR, JobContext, job_handler
+
+try:  # reportlab/pypdf необязательны: без них отчёты недоступны (503)
+    from reportlab.lib import colors
+    from reportlab.lib.pagesizes import A4
+    from reportlab.lib.styles import ParagraphStyle
+    from reportlab.lib.units import mm
+    from reportlab.pdfbase import pdfmetrics
+    from reportlab.pdfbase.ttfonts import TTFont
+    from reportlab.platypus import Paragraph, SimpleDocTemplate, Spacer, Table, TableStyle
+except ImportError:  # pragma: no cover
+    pdfmetrics = None
+try:
+    from pypdf import PdfWriter
+except ImportError:  # pragma: no cover
+    PdfWriter = None
+
+# Версия вёрстки входит в хэш кэша: правка шаблона сбрасывает кэш
+RENDER_VERSION = 1
+PDF_WORKERS = int(os.getenv("PDF_WORKERS") or 2)
+CACHE_DIR = Path(os.getenv("PDF_CACHE_DIR") or EXPORT_DIR / "pdf_cache")
+FONT_CANDIDATES = (
+    os.getenv("PDF_FONT") or "",
+    "/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf",
+    "/usr/share/fonts/TTF/DejaVuSans.ttf",
+    "/Library/Fonts/Arial Unicode.ttf",
+    "C:/Windows/Fonts/arial.ttf",
+)
+FORMATS = ("pdf", "zip")
+LEVEL_LABELS = {"low": "низкий", "mid": "средний", "high": "высокий"}
+
+
+class PdfUnavailable(RuntimeError):
+    pass
+
+
+def available_formats() -> Tuple[str, ...]:
+    if pdfmetrics is None:
+        return ()
+    return FORMATS if PdfWriter is not None else ("zip",)
+
+
+# --------------------- Данные отчёта ---------------------
+
+@dataclass
+class ClassReport:
+    """Сессии одного класса в виде, пригодном для рендера (и передачи в процесс)."""
+    class_id: str
+    class_name: str
+    institution: str
+    sessions: List[Dict[str, Any]] = field(default_factory=list)
+
+
+def report_hash(payload: Dict[str, Any]) -> str:
+    """Хэш всего, что попадает в индивидуальный отчёт (результат + шапка)."""
+    raw = json.dumps([RENDER_VERSION, payload], sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()[:32]
+
+
+def _session_payload(row, class_name: str, institution: str) -> Dict[str, Any]:
+    session_id, code, age, gender, diagnosis, form, test_name, finished_at, *packed = row
+    return {
+        "session_id": session_id,
+        "code": code,
+        "class_name": class_name,
+        "institution": institution,
+        "age": age,
+        "gender": gender,
+        "diagnosis": diagnosis,
+        "form": form,
+        "test_name": test_name,
+        "finished_at": finished_at.strftime("%d.%m.%Y %H:%M") if finished_at else "",
+        "result": decode_result(*packed) or {},
+    }
+
+
+def load_class_reports(
+    db: Session,
+    class_id: Optional[str] = None,
+    institution_id: Optional[str] = None,
+) -> Iterator[ClassReport]:
+    """Классы (один или все классы учреждения) с завершёнными сессиями, по одному."""
+    classes_q = select(Class.id, Class.name, Institution.name).outerjoin(
+        Institution, Institution.id == Class.institution_id
+    )
+    if class_id is not None:
+        classes_q = classes_q.where(Class.id == class_id)
+    if institution_id is not None:
+        classes_q = classes_q.where(Class.institution_id == institution_id)
+    for cid, class_name, institution in db.execute(classes_q.order_by(Class.name, Class.id)).all():
+        rows = db.execute(
+            select(
+                TestSession.id, Key.code, TestSession.age, TestSession.gender, TestSession.diagnosis,
+                TestSession.form_type, TestSession.test_name, TestSession.finished_at, *result_columns(),
+            )
+            .join(Key, Key.id == TestSession.key_id)
+            .where(Key.class_id == cid, TestSession.finished_at.isnot(None), TestSession.scales_sten.isnot(None))
+            .order_by(Key.code)
+        ).all()
+        report = ClassReport(cid, class_name, institution or "")
+        report.sessions = [_session_payload(r, class_name, report.institution) for r in rows]
+        yield report
+
+
+# --------------------- Вёрстка ---------------------
+
+_font_name: Optional[str] = None
+
+
+def _font() -> str:
+    """Регистрирует TTF с кириллицей один раз на процесс (у Helvetica её нет)."""
+    global _font_name
+    if _font_name is None:
+        _font_name = "Helvetica"
+        for path in FONT_CANDIDATES:
+            if path and Path(path).is_file():
+                pdfmetrics.registerFont(TTFont("ReportFont", path))
+                _font_name = "ReportFont"
+                break
+    return _font_name
+
+
+def _styles() -> Dict[str, "ParagraphStyle"]:
+    font = _font()
+    return {
+        "title": ParagraphStyle("title", fontName=font, fontSize=15, leading=19, spaceAfter=4 * mm),
+        "h2": ParagraphStyle("h2", fontName=font, fontSize=11.5, leading=15, spaceBefore=3 * mm, spaceAfter=2 * mm),
+        "body": ParagraphStyle("body", fontName=font, fontSize=9.5, leading=12.5),
+        "small": ParagraphStyle("small", fontName=font, fontSize=7.5, leading=9.5, textColor=colors.grey),
+    }
+
+
+def _table(rows: List[List[Any]], widths: Optional[List[float]] = None, header: bool = True) -> "Table":
+    table = Table([[("" if v is None else str(v)) for v in row] for row in rows], colWidths=widths, repeatRows=1 if header else 0)
+    style = [
+        ("FONTNAME", (0, 0), (-1, -1), _font()),
+        ("FONTSIZE", (0, 0), (-1, -1), 9),
+        ("GRID", (0, 0), (-1, -1), 0.4, colors.HexColor("#bbbbbb")),
+        ("VALIGN", (0, 0), (-1, -1), "MIDDLE"),
+    ]
+    if header:
+        style += [
+            ("BACKGROUND", (0, 0), (-1, 0), colors.HexColor("#007bff")),
+            ("TEXTCOLOR", (0, 0), (-1, 0), colors.white),
+        ]
+    table.setStyle(TableStyle(style))
+    return table
+
+
+def _build(story: List[Any], title: str) -> bytes:
+    buf = io.BytesIO()
+    doc = SimpleDocTemplate(
+        buf, pagesize=A4, title=title,
+        leftMargin=15 * mm, rightMargin=15 * mm, topMargin=15 * mm, bottomMargin=15 * mm,
+    )
+    doc.build(story)
+    return buf.getvalue()
+
+
+def render_session_pdf(payload: Dict[str, Any]) -> bytes:
+    """Индивидуальный отчёт: шапка, ИРП/КВЕРИПО, шкалы со стэнами, интерпретации."""
+    st = _styles()
+    result = payload["result"]
+    profile = result.get("profile") or {}
+    scales = result.get("scales") or {}
+    sten = result.get("sten") or {}
+    interpretations = result.get("interpretations") or {}
+
+    story: List[Any] = [
+        Paragraph("Результаты тестирования (ЕМ СПТ)", st["title"]),
+        _table([
+            ["Учреждение", payload["institution"]],
+            ["Класс", payload["class_name"]],
+            ["Код доступа", payload["code"]],
+            ["Возраст / пол", f"{payload['age']} / {profile.get('gender') or payload['gender']}"],
+            ["Нозология", profile.get("impairment") or payload["diagnosis"]],
+            ["Форма / тест", f"{profile.get('form') or payload['form']} / {payload['test_name']}"],
+            ["Завершено", payload["finished_at"]],
+        ], widths=[45 * mm, 125 * mm], header=False),
+        Paragraph("Основные показатели", st["h2"]),
+        _table([
+            ["Показатель", "Значение", "Уровень"],
+            ["ИРП", result.get("irp"), result.get("irp_interval")],
+            ["КВЕРИПО", result.get("kveripo"), result.get("kveripo_interval")],
+            ["Шкала лжи", result.get("lie_raw"), "коррекция применена" if result.get("lie_applied") else "без коррекции"],
+        ], widths=[45 * mm, 40 * mm, 85 * mm]),
+        Paragraph("Шкалы", st["h2"]),
+        _table(
+            [["Шкала", "Сырой балл", "Стэн", "Уровень"]]
+            + [
+                [scale, scales.get(scale), sten.get(scale),
+                 LEVEL_LABELS.get((interpretations.get(scale) or {}).get("level"), "")]
+                for scale in (sten or scales)
+            ],
+            widths=[45 * mm, 40 * mm, 30 * mm, 55 * mm],
+        ),
+    ]
+    if interpretations:
+        story.append(Paragraph("Интерпретация", st["h2"]))
+        for scale, item in interpretations.items():
+            text = f"{scale} (стэн {item.get('sten')}): {item.get('text') or ''}"
+            story.append(Paragraph(escape(text), st["body"]))
+            story.append(Spacer(1, 1.5 * mm))
+    story.append(Spacer(1, 4 * mm))
+    story.append(Paragraph(f"Session ID: {payload['session_id']}", st["small"]))
+    return _build(story, f"Отчёт {payload['code']}")
+
+
+def _distribution(values: List[Optional[str]]) -> str:
+    counts: Dict[str, int] = {}
+    for v in values:
+        counts[v or "—"] = counts.get(v or "—", 0) + 1
+    return ", ".join(f"{k}: {n}" for k, n in sorted(counts.items()))
+
+
+def render_class_summary_pdf(report: ClassReport) -> bytes:
+    """Сводка класса: распределения уровней, средние стэны, таблица учеников."""
+    st = _styles()
+    results = [s["result"] for s in report.sessions]
+    story: List[Any] = [
+        Paragraph(escape(f"Сводный отчёт: класс {report.class_name}"), st["title"]),
+        Paragraph(escape(f"{report.institution} — завершённых тестирований: {len(results)}"), st["body"]),
+        Spacer(1, 2 * mm),
+        _table([
+            ["Показатель", "Распределение по уровням"],
+            ["ИРП", _distribution([r.get("irp_interval") for r in results])],
+            ["КВЕРИПО", _distribution([r.get("kveripo_interval") for r in results])],
+        ], widths=[45 * mm, 125 * mm]),
+    ]
+
+    sums: Dict[str, List[float]] = {}
+    for r in results:
+        for scale, value in (r.get("sten") or {}).items():
+            if value:
+                sums.setdefault(scale, []).append(value)
+    if sums:
+        story.append(Paragraph("Средние стэны по шкалам", st["h2"]))
+        story.append(_table(
+            [["Шкала", "Средний стэн", "Учеников"]]
+            + [[scale, round(sum(v) / len(v), 2), len(v)] for scale, v in sums.items()],
+            widths=[45 * mm, 40 * mm, 30 * mm],
+        ))
+
+    story.append(Paragraph("Ученики", st["h2"]))
+    story.append(_table(
+        [["Код", "Пол", "Возраст", "ИРП", "Уровень ИРП", "КВЕРИПО", "Уровень"]]
+        + [
+            [s["code"], s["gender"], s["age"], s["result"].get("irp"), s["result"].get("irp_interval"),
+             s["result"].get("kveripo"), s["result"].get("kveripo_interval")]
+            for s in report.sessions
+        ],
+        widths=[24 * mm, 18 * mm, 18 * mm, 22 * mm, 30 * mm, 24 * mm, 34 * mm],
+    ))
+    return _build(story, f"Класс {report.class_name}")
+
+
+# --------------------- Кэш индивидуальных отчётов ---------------------
+
+def cache_path(session_id: str, digest: str) -> Path:
+    return CACHE_DIR / f"{session_id}.{digest}.pdf"
+
+
+def _render_to_cache(payload: Dict[str, Any], path: str) -> str:
+    """Задача для пула: рендерит отчёт и атомарно кладёт его в кэш."""
+    target = Path(path)
+    tmp = target.with_suffix(f".{os.getpid()}.tmp")
+    tmp.write_bytes(render_session_pdf(payload))
+    tmp.replace(target)
+    # прежние версии отчёта этой сессии больше не нужны
+    for old in target.parent.glob(f"{payload['session_id']}.*.pdf"):
+        if old != target:
+            old.unlink(missing_ok=True)
+    return path
+
+
+class RenderPool:
+    """
+    Пул процессов на всю сборку: создаётся при первом классе, где рендерить
+    больше одного отчёта, и закрывается в конце build_report. Контекст spawn:
+    fork из многопоточного воркера задач копирует занятые блокировки и
+    соединения с БД, а запуск процесса с импортом reportlab дорог, чтобы
+    повторять его для каждого класса. Со spawn дочерний процесс импортирует
+    главный модуль родителя: скрипт, запускающий приложение с воркером задач,
+    должен держать код под if __name__ == "__main__".
+    """
+
+    def __init__(self, workers: int = PDF_WORKERS) -> None:
+        self.workers = workers
+        self._executor: Optional[ProcessPoolExecutor] = None
+
+    def map(self, fn, *iterables) -> Iterator[Any]:
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.workers, mp_context=multiprocessing.get_context("spawn"),
+            )
+        return self._executor.map(fn, *iterables, chunksize=4)
+
+    def close(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+
+    def __enter__(self) -> "RenderPool":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+
+def ensure_rendered(sessions: List[Dict[str, Any]], pool: Optional[RenderPool] = None) -> Tuple[List[Path], int]:
+    """
+    Пути к PDF всех сессий (в том же порядке) и число отрендеренных заново.
+    Отсутствующие в кэше рендерятся в пуле (без пула или workers=0 — в этом процессе).
+    """
+    CACHE_DIR.mkdir(parents=True, exist_ok=True)
+    paths = [cache_path(s["session_id"], report_hash(s)) for s in sessions]
+    missing = [(s, p) for s, p in zip(sessions, paths) if not p.exists()]
+    if pool is None or pool.workers <= 0 or len(missing) <= 1:
+        for payload, path in missing:
+            _render_to_cache(payload, str(path))
+    else:
+        list(pool.map(_render_to_cache, [s for s, _ in missing], [str(p) for _, p in missing]))
+    return paths, len(missing)
+
+
+# --------------------- Сборка ---------------------
+
+_SAFE_NAME = re.compile(r"[^\w.-]+", re.UNICODE)
+
+
+def _safe(name: str) -> str:
+    return _SAFE_NAME.sub("_", name).strip("_") or "class"
+
+
+def build_report(
+    db: Session,
+    output: Path,
+    fmt: str = "pdf",
+    class_id: Optional[str] = None,
+    institution_id: Optional[str] = None,
+    workers: int = PDF_WORKERS,
+    progress=None,
+) -> Dict[str, Any]:
+    """
+    Собирает отчёт класса/учреждения в output (PDF или zip) и возвращает счётчики.
+    Классы обрабатываются по одному; progress(done_sessions) — после каждого класса.
+    """
+    if fmt not in available_formats():
+        raise PdfUnavailable(f"Формат {fmt!r} недоступен (нужны reportlab{' и pypdf' if fmt == 'pdf' else ''})")
+    started = time.perf_counter()
+    stats = {"classes": 0, "sessions": 0, "rendered": 0, "cached": 0}
+    part = output.with_suffix(output.suffix + ".part")
+
+    merger = PdfWriter() if fmt == "pdf" else None
+    archive = zipfile.ZipFile(part, "w", compression=zipfile.ZIP_DEFLATED) if fmt == "zip" else None
+    pool = RenderPool(workers)
+    completed = False
+    try:
+        for report in load_class_reports(db, class_id=class_id, institution_id=institution_id):
+            summary = render_class_summary_pdf(report)
+            paths, rendered = ensure_rendered(report.sessions, pool)
+            stats["classes"] += 1
+            stats["sessions"] += len(paths)
+            stats["rendered"] += rendered
+            stats["cached"] += len(paths) - rendered
+            if merger is not None:
+                merger.append(io.BytesIO(summary))
+                for path in paths:
+                    merger.append(str(path))
+            else:
+                folder = f"{_safe(report.class_name)}_{report.class_id[:8]}"
+                archive.writestr(f"{folder}/00_summary.pdf", summary)
+                for payload, path in zip(report.sessions, paths):
+                    archive.write(path, f"{folder}/{_safe(payload['code'])}.pdf")
+            if progress:
+                progress(stats["sessions"])
+        if merger is not None:
+            with part.open("wb") as f:
+                merger.write(f)
+        completed = True
+    finally:
+        pool.close()
+        if archive is not None:
+            archive.close()
+        if merger is not None:
+            merger.close()
+        if not completed:
+            part.unlink(missing_ok=True)
+    part.replace(output)
+    stats["ms"] = round((time.perf_counter() - started) * 1000.0, 1)
+    return stats
+
+
+# --------------------- Фоновая сборка ---------------------
+
+@job_handler("pdf_report")
+def pdf_report_job(
+    ctx: JobContext,
+    fmt: str = "pdf",
+    class_id: Optional[str] = None,
+    institution_id: Optional[str] = None,
+) -> Dict[str, Any]:
+    """Задача pdf_report: сборка в фоне, прогресс — число сессий по готовым классам."""
+    from SPTOVZ.database import ReadSessionLocal
+
+    output = ctx.output_path(fmt)
+    with ReadSessionLocal() as db:
+        stats = build_report(
+            db, output, fmt, class_id=class_id, institution_id=institution_id,
+            progress=lambda done: ctx.progress(done),
+        )
+    media_type = "application/pdf" if fmt == "pdf" else "application/zip"
+    return {"file": output.name, "media_type": media_type, **stats}
+
+
+if __name__ == "__main__":
+    from SPTOVZ.database import ReadSessionLocal
+
+    parser = argparse.ArgumentParser(description="PDF-отчёты класса или учреждения")
+    scope = parser.add_mutually_exclusive_group(required=True)
+    scope.add_argument("--class", dest="class_id", help="id класса")
+    scope.add_argument("--institution", help="id учреждения (все классы)")
+    parser.add_argument("--format", choices=FORMATS, default="pdf")
+    parser.add_argument("--workers", type=int, default=PDF_WORKERS, help="процессов для рендера (0 — без пула)")
+    parser.add_argument("-o", "--output", required=True)
+    args = parser.parse_args()
+
+    with ReadSessionLocal() as db:
+        stats = build_report(
+            db, Path(args.output), args.format,
+            class_id=args.class_id, institution_id=args.institution, workers=args.workers,
+        )
+    print(json.dumps(stats, ensure_ascii=False))
@@ -0,0 +1,66 @@
+"""
+Разовая миграция: хэширование паролей, сохранённых без хэша.
+
+Раньше это делал main.py при каждом старте воркера, читая всю таблицу
+users. Теперь старые записи обновляются при входе (utils/auth.verify_and_update),
+а эта команда позволяет перехэшировать их заранее, порциями:
+
+    python -m SPTOVZ.utils.rehash_passwords --dry-run
+    python -m SPTOVZ.utils.rehash_passwords
+"""
+from __future__ import annotations
+import argparse
+from typing import Callable
+
+from sqlalchemy import select
+from sqlalchemy.orm import Session
+
+from SPTOVZ.models.user import User
+from SPTOVZ.utils.auth import get_password_hash, is_password_hash
+
+
+def rehash_passwords(
+    db: Session,
+    chunk_size: int = 500,
+    dry_run: bool = False,
+    report: Callable[[str], None] = print,
+) -> int:
+    """
+    Хэширует «сырые» пароли. Кандидаты отбираются в SQL (не bcrypt-префикс),
+    читаются keyset-порциями по id, каждая порция — своя транзакция.
+    """
+    updated = 0
+    last_id = ""
+    while True:
+        users = db.scalars(
+            select(User)
+            .where(~User.password_hash.startswith("$2"), User.id > last_id)
+            .order_by(User.id)
+            .limit(chunk_size)
+        ).all()
+        if not users:
+            break
+        last_id = users[-1].id
+        for u in users:
+            if is_password_hash(u.password_hash):
+                continue
+            report(f"[*] Хеширование пароля пользователя {u.email}")
+            if not dry_run:
+                u.password_hash = get_password_hash(u.password_hash)
+            updated += 1
+        if not dry_run:
+            db.commit()
+    report(f"[+] {'Требуют хеширования' if dry_run else 'Перехешировано'} паролей: {updated}")
+    return updated
+
+
+if __name__ == "__main__":
+    from SPTOVZ.database import WriteSessionLocal
+
+    parser = argparse.ArgumentParser(description="Хэширование паролей, сохранённых без хэша")
+    parser.add_argument("--chunk-size", type=int, default=500)
+    parser.add_argument("--dry-run", action="store_true", help="только посчитать, ничего не менять")
+    args = parser.parse_args()
+
+    with WriteSessionLocal() as db:
+        rehash_passwords(db, chunk_size=args.chunk_size, dry_run=args.dry_run)
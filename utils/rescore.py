@@ -0,0 +1,305 @@
+"""
+Пересчёт сохранённых результатов TestSession через движок ЕМ СПТ.
+
+Нужен после правки таблиц стэнов, norms.yaml и т.п.: завершённые сессии
+читаются порциями по первичному ключу (keyset-пагинация + yield_per),
+пересчитываются compute_emspt_batch в пуле процессов и записываются
+обратно пакетным UPDATE (executemany). Прогресс сохраняется в checkpoint,
+прерванный запуск продолжается с --resume.
+
+    python -m SPTOVZ.utils.rescore --dry-run
+    python -m SPTOVZ.utils.rescore --workers 4 --checkpoint rescore.json --resume
+"""
+from __future__ import annotations
+import argparse
+import json
+import multiprocessing
+import time
+from collections import deque
+from concurrent.futures import Executor, Future, ProcessPoolExecutor
+from dataclasses import asdict, dataclass, field
+from pathlib import Path
+from typing import Any, Callable, Deque, Dict, Iterator, List, Optional, Tuple
+
+from sqlalchemy import select, update
+from sqlalchemy.orm import Session
+
+from SPTOVZ.models.session import RESULT_COLUMNS, TestSession, decode_result, encode_result
+from SPTOVZ.utils.emspt_engine import Profile, get_scoring_config
+from SPTOVZ.utils.emspt_batch import compute_emspt_batch, packed_to_matrix
+from SPTOVZ.utils.jobs import JobContext, job_handler
+from SPTOVZ.utils.stats_rollup import reconcile
+
+# (id, form_type, diagnosis, gender, answers_packed)
+Row = Tuple[str, str, str, str, bytes]
+
+# Сохранённые столбцы результата (без профиля): с ними сравнивается пересчёт
+STORED_COLUMNS = RESULT_COLUMNS[3:]
+
+
+# --------------------- Состояние / checkpoint ---------------------
+
+@dataclass
+class RescoreState:
+    last_id: str = ""
+    processed: int = 0
+    changed: int = 0
+    written: int = 0
+    errors: int = 0
+    started_at: float = field(default_factory=time.time)
+
+    @classmethod
+    def load(cls, path: Path) -> "RescoreState":
+        return cls(**json.loads(path.read_text(encoding="utf-8")))
+
+    def save(self, path: Path) -> None:
+        tmp = path.with_suffix(path.suffix + ".tmp")
+        tmp.write_text(json.dumps(asdict(self)), encoding="utf-8")
+        tmp.replace(path)
+
+
+# --------------------- Чтение ---------------------
+
+def iter_chunks(db: Session, chunk_size: int, after_id: str = "") -> Iterator[List[Tuple[Row, Dict[str, Any]]]]:
+    """
+    Отдаёт завершённые сессии порциями [(row, сохранённые столбцы результата)], упорядоченно по id.
+    Каждая порция — отдельный запрос WHERE id > :last, поэтому память
+    ограничена chunk_size независимо от размера таблицы.
+    """
+    last_id = after_id
+    while True:
+        stmt = (
+            select(
+                TestSession.id,
+                TestSession.form_type,
+                TestSession.diagnosis,
+                TestSession.gender,
+                TestSession.answers_packed,
+                *(getattr(TestSession, name) for name in STORED_COLUMNS),
+            )
+            .where(TestSession.finished_at.isnot(None), TestSession.answers_packed.isnot(None))
+            .where(TestSession.id > last_id)
+            .order_by(TestSession.id)
+            .limit(chunk_size)
+            .execution_options(yield_per=chunk_size)
+        )
+        chunk = []
+        for sid, form, impairment, gender, answers, *stored in db.execute(stmt):
+            chunk.append(((sid, form, impairment, gender, answers), dict(zip(STORED_COLUMNS, stored))))
+        if not chunk:
+            return
+        yield chunk
+        last_id = chunk[-1][0][0]
+
+
+# --------------------- Пересчёт (в процессе пула) ---------------------
+
+def score_rows(rows: List[Row]) -> Tuple[List[Tuple[str, Dict[str, Any]]], List[Tuple[str, str]]]:
+    """Пересчитывает порцию строк. Возвращает ([(id, result)], [(id, ошибка)])."""
+    groups: Dict[Tuple[str, str, str], List[Row]] = {}
+    for row in rows:
+        groups.setdefault((row[1], row[2], row[3]), []).append(row)
+
+    scored: List[Tuple[str, Dict[str, Any]]] = []
+    errors: List[Tuple[str, str]] = []
+    for key, group in groups.items():
+        try:
+            profile = Profile(*key)
+            matrix = packed_to_matrix((r[4] for r in group), get_scoring_config(profile).n_questions)
+            results = compute_emspt_batch(matrix, profile)
+        except Exception as e:
+            errors.extend((r[0], f"{type(e).__name__}: {e}") for r in group)
+            continue
+        scored.extend((r[0], res) for r, res in zip(group, results))
+    return scored, errors
+
+
+def _diff(old: Optional[Dict[str, Any]], new: Dict[str, Any]) -> Dict[str, Any]:
+    """Краткое описание изменений для dry-run: только отличающиеся поля."""
+    old = old or {}
+    changes: Dict[str, Any] = {}
+    for field_name in ("irp", "irp_interval", "kveripo", "kveripo_interval", "lie_applied"):
+        if old.get(field_name) != new.get(field_name):
+            changes[field_name] = [old.get(field_name), new.get(field_name)]
+    for group in ("scales", "sten"):
+        old_group = old.get(group) or {}
+        for scale, value in (new.get(group) or {}).items():
+            if old_group.get(scale) != value:
+                changes[f"{group}.{scale}"] = [old_group.get(scale), value]
+    return changes
+
+
+# --------------------- Основной цикл ---------------------
+
+def rescore(
+    db: Session,
+    *,
+    chunk_size: int = 2000,
+    workers: int = 0,
+    dry_run: bool = False,
+    checkpoint: Optional[Path] = None,
+    resume: bool = False,
+    limit: Optional[int] = None,
+    report: Callable[[str], None] = print,
+    sample_diffs: int = 5,
+    progress: Optional[Callable[[RescoreState], None]] = None,
+) -> RescoreState:
+    """
+    Пересчитывает все завершённые сессии. workers=0 — в текущем процессе.
+    В dry-run ничего не пишет и не двигает checkpoint, только считает отличия.
+    progress(state) вызывается после каждой записанной порции.
+    """
+    state = RescoreState()
+    if resume and checkpoint and checkpoint.exists():
+        state = RescoreState.load(checkpoint)
+        report(f"[*] Продолжаем с id > {state.last_id!r} (обработано {state.processed})")
+
+    # spawn: пересчёт идёт и задачей rescore в многопоточном воркере (см. pdf_generator.RenderPool)
+    executor: Optional[Executor] = (
+        ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+        if workers > 0 else None
+    )
+    in_flight: Deque[Tuple[List[Tuple[Row, Dict[str, Any]]], Future]] = deque()
+    max_in_flight = max(workers, 1) * 2
+    started = time.perf_counter()
+    processed_at_start = state.processed
+    samples = 0
+
+    def _finish(chunk: List[Tuple[Row, Dict[str, Any]]], scored, errors) -> None:
+        nonlocal samples
+        stored = {row[0]: (row, columns) for row, columns in chunk}
+        updates = []
+        for sid, result in scored:
+            row, old = stored[sid]
+            # сравниваем в упакованном виде: так результат лежит в БД
+            new = encode_result(result, row[1])
+            if new == old:
+                continue
+            updates.append({"id": sid, **new})
+            if dry_run and samples < sample_diffs:
+                samples += 1
+                try:
+                    old_result = decode_result(*row[1:4], *(old[name] for name in STORED_COLUMNS))
+                except ValueError:  # шкалы в keys_*.yaml изменились — старое не разобрать
+                    old_result = None
+                report(f"    ~ {sid}: {json.dumps(_diff(old_result, result), ensure_ascii=False)}")
+        for sid, error in errors:
+            report(f"    ! {sid}: {error}")
+
+        if updates and not dry_run:
+            db.execute(update(TestSession), updates)
+            state.written += len(updates)
+        # и без изменений: транзакция чтения порции не должна жить до следующей
+        db.commit()
+
+        state.processed += len(chunk)
+        state.changed += len(updates)
+        state.errors += len(errors)
+        state.last_id = chunk[-1][0][0]
+        if checkpoint and not dry_run:
+            state.save(checkpoint)
+        if progress:
+            progress(state)
+
+        elapsed = time.perf_counter() - started
+        rate = (state.processed - processed_at_start) / elapsed if elapsed else 0.0
+        report(
+            f"[*] {state.processed} обработано, {state.changed} изменилось, "
+            f"{state.errors} ошибок — {rate:,.0f} строк/с"
+        )
+
+    def _drain(keep: int) -> None:
+        while len(in_flight) > keep:
+            chunk, future = in_flight.popleft()
+            _finish(chunk, *future.result())
+
+    try:
+        remaining = limit
+        for chunk in iter_chunks(db, chunk_size, state.last_id):
+            if remaining is not None:
+                chunk = chunk[:remaining]
+                remaining -= len(chunk)
+            rows = [row for row, _ in chunk]
+            if executor is None:
+                _finish(chunk, *score_rows(rows))
+            else:
+                in_flight.append((chunk, executor.submit(score_rows, rows)))
+                _drain(max_in_flight)
+            if remaining is not None and remaining <= 0:
+                break
+        _drain(0)
+    finally:
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
+
+    if state.written:
+        # уровни IRP/KVERIPO могли измениться — агрегаты статистики пересобираем
+        reconcile(db, fix=True, report=report)
+
+    mode = "dry-run" if dry_run else "записано"
+    report(
+        f"[+] Готово: {state.processed} сессий, изменилось {state.changed} "
+        f"({mode}: {state.written}), ошибок {state.errors}, "
+        f"{time.perf_counter() - started:.1f} с"
+    )
+    return state
+
+
+# --------------------- Фоновая задача ---------------------
+
+@job_handler("rescore")
+def rescore_job(
+    ctx: JobContext,
+    chunk_size: int = 2000,
+    workers: int = 0,
+    dry_run: bool = False,
+    limit: Optional[int] = None,
+) -> Dict[str, Any]:
+    """
+    Задача rescore. Checkpoint — по id задачи: повторная попытка после
+    сбоя продолжает с последней записанной порции.
+    """
+    from SPTOVZ.database import WriteSessionLocal
+
+    checkpoint = ctx.output_path("checkpoint.json")
+    with WriteSessionLocal() as db:
+        state = rescore(
+            db,
+            chunk_size=chunk_size,
+            workers=workers,
+            dry_run=dry_run,
+            checkpoint=checkpoint,
+            resume=ctx.attempt > 1,
+            limit=limit,
+            report=lambda msg: None,
+            progress=lambda st: ctx.progress(st.processed, message=f"изменилось {st.changed}, ошибок {st.errors}"),
+        )
+    checkpoint.unlink(missing_ok=True)
+    return asdict(state)
+
+
+if __name__ == "__main__":
+    from SPTOVZ.database import WriteSessionLocal
+
+    parser = argparse.ArgumentParser(description="Пересчёт результатов TestSession")
+    parser.add_argument("--chunk-size", type=int, default=2000)
+    parser.add_argument("--workers", type=int, default=0, help="процессов для расчёта (0 — без пула)")
+    parser.add_argument("--dry-run", action="store_true", help="только показать отличия, ничего не писать")
+    parser.add_argument("--checkpoint", type=Path, default=None)
+    parser.add_argument("--resume", action="store_true", help="продолжить с checkpoint")
+    parser.add_argument("--limit", type=int, default=None)
+    args = parser.parse_args()
+
+    db = WriteSessionLocal()
+    try:
+        rescore(
+            db,
+            chunk_size=args.chunk_size,
+            workers=args.workers,
+            dry_run=args.dry_run,
+            checkpoint=args.checkpoint,
+            resume=args.resume,
+            limit=args.limit,
+        )
+    finally:
+        db.close()
@@ -0,0 +1,311 @@
+"""
+Выгрузка завершённых сессий для исследователей: одна строка на сессию —
+профиль, сырые баллы шкал, стэны, ИРП и КВЕРИПО.
+
+Строки читаются серверным курсором (stream_results + yield_per) и
+отдаются порциями, поэтому память не растёт с числом сессий. Форматы:
+csv всегда; parquet и arrow (IPC stream) — если установлен pyarrow.
+
+    python -m SPTOVZ.utils.session_export --institution <id> --from 2025-09-01 -o sessions.csv
+    python -m SPTOVZ.utils.session_export --class <id> --format parquet -o sessions.parquet
+"""
+from __future__ import annotations
+import argparse
+import csv
+import io
+import sys
+from dataclasses import dataclass
+from datetime import date, datetime, time, timedelta
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from sqlalchemy import select
+from sqlalchemy.orm import Session
+
+from SPTOVZ.models.class_group import Class, Key
+from SPTOVZ.models.institution import Institution
+from SPTOVZ.models.session import TestSession, decode_scales, scale_layout
+from SPTOVZ.utils.emspt_engine import form_scale_names
+from SPTOVZ.utils.jobs import JobContext, job_handler
+
+try:  # pyarrow необязателен: без него доступен только CSV
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # pragma: no cover
+    pa = None
+    pq = None
+
+EXPORT_CHUNK = 2000
+FORMATS = ("csv", "parquet", "arrow")
+MEDIA_TYPES = {
+    "csv": "text/csv; charset=utf-8",
+    "parquet": "application/vnd.apache.parquet",
+    "arrow": "application/vnd.apache.arrow.stream",
+}
+
+# Столбцы до шкал: (имя, тип для arrow)
+BASE_COLUMNS: Tuple[Tuple[str, str], ...] = (
+    ("session_id", "string"),
+    ("institution_id", "string"),
+    ("institution", "string"),
+    ("class_id", "string"),
+    ("class_name", "string"),
+    ("key_code", "string"),
+    ("test_name", "string"),
+    ("form", "string"),
+    ("impairment", "string"),
+    ("gender", "string"),
+    ("age", "int"),
+    ("started_at", "timestamp"),
+    ("finished_at", "timestamp"),
+    ("irp", "float"),
+    ("irp_interval", "string"),
+    ("kveripo", "float"),
+    ("kveripo_interval", "string"),
+    ("lie_raw", "float"),
+    ("lie_applied", "bool"),
+)
+
+
+@dataclass(frozen=True)
+class ExportFilter:
+    """Что выгружать: учреждение, класс, интервал по дате завершения (включительно)."""
+    institution_id: Optional[str] = None
+    class_id: Optional[str] = None
+    date_from: Optional[date] = None
+    date_to: Optional[date] = None
+
+
+def available_formats() -> Tuple[str, ...]:
+    return FORMATS if pa is not None else ("csv",)
+
+
+def scale_names() -> Tuple[str, ...]:
+    """Объединение шкал всех форм (A, затем дополнительные шкалы B/C)."""
+    names: List[str] = []
+    for form in ("A", "B"):
+        names.extend(s for s in form_scale_names(form) if s not in names)
+    return tuple(names)
+
+
+def export_columns(scales: Tuple[str, ...]) -> List[str]:
+    return (
+        [name for name, _ in BASE_COLUMNS]
+        + [f"raw_{s}" for s in scales]
+        + [f"sten_{s}" for s in scales]
+    )
+
+
+# --------------------- Чтение ---------------------
+
+def _export_query(flt: ExportFilter):
+    q = (
+        select(
+            TestSession.id, Class.institution_id, Institution.name, Key.class_id, Class.name,
+            Key.code, TestSession.test_name, TestSession.form_type, TestSession.diagnosis,
+            TestSession.gender, TestSession.age, TestSession.started_at, TestSession.finished_at,
+            TestSession.irp, TestSession.irp_interval, TestSession.kveripo, TestSession.kveripo_interval,
+            TestSession.lie_raw, TestSession.lie_applied, TestSession.scales_raw, TestSession.scales_sten,
+        )
+        .join(Key, Key.id == TestSession.key_id)
+        .join(Class, Class.id == Key.class_id)
+        .outerjoin(Institution, Institution.id == Class.institution_id)
+        .where(TestSession.finished_at.isnot(None))
+    )
+    if flt.institution_id is not None:
+        q = q.where(Class.institution_id == flt.institution_id)
+    if flt.class_id is not None:
+        q = q.where(Key.class_id == flt.class_id)
+    if flt.date_from is not None:
+        q = q.where(TestSession.finished_at >= datetime.combine(flt.date_from, time.min))
+    if flt.date_to is not None:
+        q = q.where(TestSession.finished_at < datetime.combine(flt.date_to + timedelta(days=1), time.min))
+    return q.order_by(TestSession.finished_at, TestSession.id)
+
+
+def _export_row(row, scales: Tuple[str, ...], layouts: Dict[str, Tuple[Tuple[str, ...], str]]) -> List[Any]:
+    (session_id, institution_id, institution, class_id, class_name, code, test_name,
+     form, diagnosis, gender, age, started_at, finished_at,
+     irp, irp_interval, kveripo, kveripo_interval, lie_raw, lie_applied, scales_raw, scales_sten) = row
+    raw: Dict[str, Any] = {}
+    sten: Dict[str, int] = {}
+    if scales_sten is not None:
+        if form not in layouts:
+            layouts[form] = scale_layout(form)
+        raw, sten = decode_scales(layouts[form], scales_raw, scales_sten, lie_applied)
+        irp_interval = irp_interval or "—"
+        kveripo_interval = kveripo_interval or "—"
+    return [
+        session_id, institution_id, institution, class_id, class_name, code, test_name,
+        form, diagnosis, gender, age, started_at, finished_at,
+        irp, irp_interval, kveripo, kveripo_interval, lie_raw, lie_applied,
+        *(raw.get(s) for s in scales),
+        *(sten.get(s) for s in scales),
+    ]
+
+
+def iter_export_chunks(
+    db: Session,
+    flt: ExportFilter,
+    scales: Tuple[str, ...],
+    chunk_size: int = EXPORT_CHUNK,
+) -> Iterator[List[List[Any]]]:
+    """Порции строк выгрузки; в памяти одновременно только одна порция."""
+    result = db.execute(
+        _export_query(flt).execution_options(stream_results=True, yield_per=chunk_size)
+    )
+    # порядок шкал в упакованных массивах — один раз на форму, а не на строку
+    layouts: Dict[str, Tuple[Tuple[str, ...], str]] = {}
+    for rows in result.partitions():
+        yield [_export_row(r, scales, layouts) for r in rows]
+
+
+# --------------------- Форматы ---------------------
+
+def _csv_value(value: Any) -> Any:
+    if value is None:
+        return ""
+    if isinstance(value, datetime):
+        return value.isoformat(sep=" ")
+    if isinstance(value, bool):
+        return int(value)
+    return value
+
+
+def _stream_csv(chunks: Iterator[List[List[Any]]], columns: List[str]) -> Iterator[bytes]:
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    # BOM — чтобы Excel открыл кириллицу без мастера импорта
+    buf.write("\ufeff")
+    writer.writerow(columns)
+    for rows in chunks:
+        writer.writerows([_csv_value(v) for v in row] for row in rows)
+        yield buf.getvalue().encode("utf-8")
+        buf.seek(0)
+        buf.truncate()
+    if buf.tell():
+        yield buf.getvalue().encode("utf-8")
+
+
+def _arrow_schema(scales: Tuple[str, ...]):
+    types = {"string": pa.string(), "int": pa.int32(), "float": pa.float64(),
+             "bool": pa.bool_(), "timestamp": pa.timestamp("us")}
+    fields = [pa.field(name, types[kind]) for name, kind in BASE_COLUMNS]
+    fields += [pa.field(f"raw_{s}", pa.float64()) for s in scales]
+    fields += [pa.field(f"sten_{s}", pa.int32()) for s in scales]
+    return pa.schema(fields)
+
+
+class _ChunkSink(io.RawIOBase):
+    """Файл только на запись: записанное забирается drain() и отдаётся клиенту."""
+
+    def __init__(self) -> None:
+        self._parts: List[bytes] = []
+        self._pos = 0
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        data = bytes(data)
+        self._parts.append(data)
+        self._pos += len(data)
+        return len(data)
+
+    def tell(self) -> int:
+        return self._pos
+
+    def drain(self) -> bytes:
+        data, self._parts = b"".join(self._parts), []
+        return data
+
+
+def _stream_arrow(chunks: Iterator[List[List[Any]]], scales: Tuple[str, ...], fmt: str) -> Iterator[bytes]:
+    schema = _arrow_schema(scales)
+    sink = _ChunkSink()
+    if fmt == "parquet":
+        writer = pq.ParquetWriter(sink, schema, compression="zstd")
+        write = writer.write_table
+        to_batch = pa.Table.from_pylist
+    else:
+        writer = pa.ipc.new_stream(sink, schema)
+        write = writer.write_batch
+        to_batch = pa.RecordBatch.from_pylist
+    names = schema.names
+    with writer:
+        for rows in chunks:
+            # одна порция — одна row group / record batch
+            write(to_batch([dict(zip(names, row)) for row in rows], schema=schema))
+            yield sink.drain()
+    tail = sink.drain()
+    if tail:
+        yield tail
+
+
+def stream_export(db: Session, flt: ExportFilter, fmt: str = "csv", chunk_size: int = EXPORT_CHUNK) -> Iterator[bytes]:
+    """Байты выгрузки порциями в нужном формате."""
+    if fmt not in available_formats():
+        raise ValueError(f"Формат {fmt!r} недоступен (доступны: {', '.join(available_formats())})")
+    scales = scale_names()
+    chunks = iter_export_chunks(db, flt, scales, chunk_size)
+    if fmt == "csv":
+        return _stream_csv(chunks, export_columns(scales))
+    return _stream_arrow(chunks, scales, fmt)
+
+
+# --------------------- Фоновая задача ---------------------
+
+@job_handler("sessions_export")
+def sessions_export_job(
+    ctx: JobContext,
+    format: str = "csv",
+    institution_id: Optional[str] = None,
+    class_id: Optional[str] = None,
+    date_from: Optional[str] = None,
+    date_to: Optional[str] = None,
+) -> Dict[str, Any]:
+    """Задача sessions_export: та же выгрузка в файл (для очень больших объёмов)."""
+    from SPTOVZ.database import ReadSessionLocal
+
+    flt = ExportFilter(
+        institution_id, class_id,
+        date.fromisoformat(date_from) if date_from else None,
+        date.fromisoformat(date_to) if date_to else None,
+    )
+    target = ctx.output_path(format)
+    part = target.with_suffix(".part")
+    size = 0
+    try:
+        with ReadSessionLocal() as db, part.open("wb") as f:
+            for i, chunk in enumerate(stream_export(db, flt, format)):
+                f.write(chunk)
+                size += len(chunk)
+                ctx.progress(i + 1, message=f"порций: {i + 1}, {size} байт")
+    except BaseException:
+        part.unlink(missing_ok=True)
+        raise
+    part.replace(target)
+    return {"file": target.name, "media_type": MEDIA_TYPES[format], "bytes": size}
+
+
+if __name__ == "__main__":
+    from SPTOVZ.database import ReadSessionLocal
+
+    parser = argparse.ArgumentParser(description="Выгрузка завершённых сессий (одна строка на сессию)")
+    parser.add_argument("--institution", help="id учреждения")
+    parser.add_argument("--class", dest="class_id", help="id класса")
+    parser.add_argument("--from", dest="date_from", type=date.fromisoformat, help="дата завершения от (YYYY-MM-DD)")
+    parser.add_argument("--to", dest="date_to", type=date.fromisoformat, help="дата завершения до (включительно)")
+    parser.add_argument("--format", choices=FORMATS, default="csv")
+    parser.add_argument("--chunk-size", type=int, default=EXPORT_CHUNK)
+    parser.add_argument("-o", "--output", help="файл (по умолчанию stdout)")
+    args = parser.parse_args()
+
+    flt = ExportFilter(args.institution, args.class_id, args.date_from, args.date_to)
+    out = open(args.output, "wb") if args.output else sys.stdout.buffer
+    try:
+        with ReadSessionLocal() as db:
+            for part in stream_export(db, flt, args.format, args.chunk_size):
+                out.write(part)
+    finally:
+        if args.output:
+            out.close()
@@ -0,0 +1,180 @@
+"""
+Бинарный снимок конфигураций ЕМ СПТ и каталога тестов.
+
+Сборка (шаг деплоя) компилирует ScoringConfig всех профилей и разбирает
+все файлы tests_catalog в один файл: заголовок MAGIC + sha256 тела +
+pickle (protocol 5). При старте emspt_engine отображает файл в память
+(mmap), сверяет контрольную сумму и хэши исходных YAML и берёт
+конфигурации из снимка; test_loader берёт из него уже разобранные тесты
+по хэшу файла. Нет снимка, не сошлась сумма или изменился хоть один
+исходный YAML — работаем по-старому, через YAML.
+
+Снимок — доверенный артефакт сборки (pickle), из чужих источников не загружать.
+
+    python -m SPTOVZ.utils.snapshot build
+    python -m SPTOVZ.utils.snapshot check
+"""
+from __future__ import annotations
+import argparse
+import hashlib
+import json
+import mmap
+import os
+import pickle
+import threading
+import time
+from dataclasses import replace
+from pathlib import Path
+from typing import Any, Dict, Optional
+
+BASE_DIR = Path(__file__).resolve().parent.parent
+SNAPSHOT_PATH = Path(os.getenv("SNAPSHOT_PATH") or BASE_DIR / "build" / "catalog.snapshot")
+
+MAGIC = b"SPTSNAP\x01"
+DIGEST_SIZE = 32
+HEADER_SIZE = len(MAGIC) + DIGEST_SIZE
+
+# Меняется при несовместимом изменении содержимого снимка
+SNAPSHOT_FORMAT = 1
+
+_cache: Dict[Path, Optional[Dict[str, Any]]] = {}
+_lock = threading.Lock()
+
+
+def file_digest(path: Path) -> Optional[str]:
+    try:
+        return hashlib.sha256(path.read_bytes()).hexdigest()
+    except FileNotFoundError:
+        return None
+
+
+def source_digests(root: Path) -> Dict[str, str]:
+    """Хэши всех YAML под root: относительный путь → sha256."""
+    return {
+        p.relative_to(BASE_DIR).as_posix(): file_digest(p)
+        for p in sorted(root.rglob("*.y*ml"))
+        if p.is_file()
+    }
+
+
+def sources_fresh(recorded: Dict[str, str], root: Path) -> bool:
+    """Снимок актуален, если набор файлов и их хэши не изменились."""
+    return recorded == source_digests(root)
+
+
+# --------------------- Чтение / запись ---------------------
+
+def write_snapshot(payload: Dict[str, Any], path: Optional[Path] = None) -> Dict[str, Any]:
+    path = Path(path or SNAPSHOT_PATH)
+    body = pickle.dumps(payload, protocol=5)
+    digest = hashlib.sha256(body).digest()
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_suffix(path.suffix + ".tmp")
+    with tmp.open("wb") as f:
+        f.write(MAGIC)
+        f.write(digest)
+        f.write(body)
+    tmp.replace(path)
+    _cache.pop(path, None)
+    return {"path": str(path), "bytes": HEADER_SIZE + len(body), "sha256": digest.hex()}
+
+
+def _read(path: Path) -> Dict[str, Any]:
+    with path.open("rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        if len(mm) < HEADER_SIZE or mm[:len(MAGIC)] != MAGIC:
+            raise ValueError("не снимок или другой формат заголовка")
+        # тело читаем через memoryview без копирования; view закрываем до mmap
+        with memoryview(mm) as view, view[HEADER_SIZE:] as body:
+            if hashlib.sha256(body).digest() != mm[len(MAGIC):HEADER_SIZE]:
+                raise ValueError("контрольная сумма не совпадает")
+            payload = pickle.loads(body)
+    if payload.get("format") != SNAPSHOT_FORMAT:
+        raise ValueError(f"формат {payload.get('format')} != {SNAPSHOT_FORMAT}")
+    return payload
+
+
+def read_snapshot(path: Optional[Path] = None) -> Optional[Dict[str, Any]]:
+    """
+    Загружает и проверяет снимок (один раз на процесс). None — снимка нет
+    или он повреждён; вызывающая сторона тогда читает YAML.
+    """
+    path = Path(path or SNAPSHOT_PATH)
+    if path in _cache:
+        return _cache[path]
+    with _lock:
+        if path not in _cache:
+            try:
+                _cache[path] = _read(path)
+            except FileNotFoundError:
+                _cache[path] = None
+            except Exception as e:
+                print(f"[!] Снимок {path} не загружен: {e}")
+                _cache[path] = None
+        return _cache[path]
+
+
+# --------------------- Сборка ---------------------
+
+def build_snapshot(path: Optional[Path] = None) -> Dict[str, Any]:
+    """Компилирует конфигурации всех профилей и разбирает каталог тестов."""
+    from SPTOVZ.utils import emspt_engine
+    from SPTOVZ.utils.test_loader import CATALOG_ROOT, discover_tests, parse_test_file
+
+    started = time.perf_counter()
+    configs = {}
+    for profile in emspt_engine.available_profiles():
+        # sources (абсолютные пути и mtime) пересчитываются при загрузке
+        configs[profile.cache_key()] = replace(emspt_engine._build_config(profile), sources=())
+
+    catalog = {}
+    for p in discover_tests(CATALOG_ROOT):
+        record = parse_test_file(p)
+        catalog[record["passport"]["content_hash"]] = record
+
+    payload = {
+        "format": SNAPSHOT_FORMAT,
+        "config_format": emspt_engine.CONFIG_FORMAT,
+        "built_at": time.time(),
+        "config_sources": source_digests(emspt_engine.CONFIG_ROOT),
+        "configs": configs,
+        "catalog": catalog,
+    }
+    info = write_snapshot(payload, path)
+    info.update(
+        configs=len(configs),
+        catalog=len(catalog),
+        build_ms=round((time.perf_counter() - started) * 1000, 1),
+    )
+    return info
+
+
+def check_snapshot(path: Optional[Path] = None) -> Dict[str, Any]:
+    from SPTOVZ.utils import emspt_engine
+
+    path = Path(path or SNAPSHOT_PATH)
+    payload = read_snapshot(path)
+    if payload is None:
+        return {"path": str(path), "ok": False}
+    return {
+        "path": str(path),
+        "ok": True,
+        "built_at": payload["built_at"],
+        "configs": len(payload["configs"]),
+        "catalog": len(payload["catalog"]),
+        "configs_fresh": (
+            payload.get("config_format") == emspt_engine.CONFIG_FORMAT
+            and sources_fresh(payload["config_sources"], emspt_engine.CONFIG_ROOT)
+        ),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Бинарный снимок конфигураций ЕМ СПТ и каталога тестов")
+    parser.add_argument("command", choices=("build", "check"))
+    parser.add_argument("--path", type=Path, default=None)
+    args = parser.parse_args()
+
+    if args.command == "build":
+        print(json.dumps(build_snapshot(args.path), ensure_ascii=False))
+    else:
+        print(json.dumps(check_snapshot(args.path), ensure_ascii=False))
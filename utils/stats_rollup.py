@@ -0,0 +1,245 @@
+"""
+Инкрементальные агрегаты статистики (таблица stats_rollup).
+
+submit-answers и генерация ключей прибавляют дельты к своей корзине
+в той же транзакции; /stats/* читает только агрегаты. Пересборка
+с нуля и проверка расхождений:
+
+    python -m SPTOVZ.utils.stats_rollup            # отчёт о расхождениях
+    python -m SPTOVZ.utils.stats_rollup --fix      # пересобрать агрегаты
+"""
+from __future__ import annotations
+import argparse
+from datetime import date, datetime
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from sqlalchemy import Date, case, delete, func, select
+from sqlalchemy.orm import Session
+
+from SPTOVZ.database import dialect_insert
+from SPTOVZ.models.class_group import Class, Key
+from SPTOVZ.models.session import TestSession
+from SPTOVZ.models.stats import StatsRollup
+
+COUNTER_COLUMNS = (
+    "keys_total", "completed",
+    "irp_low", "irp_mid", "irp_high",
+    "kveripo_low", "kveripo_high",
+)
+IRP_COLUMNS = {"низкий": "irp_low", "средний": "irp_mid", "высокий": "irp_high"}
+KVERIPO_COLUMNS = {"низкий": "kveripo_low", "высокий": "kveripo_high"}
+
+# (institution_id, class_id, form_type, impairment, gender, day)
+Bucket = Tuple[str, str, str, str, str, date]
+
+
+# --------------------- Инкрементальные обновления ---------------------
+
+def bump(db: Session, bucket: Bucket, **deltas: int) -> None:
+    """Прибавляет дельты к счётчикам корзины (INSERT ... ON CONFLICT DO UPDATE)."""
+    deltas = {k: v for k, v in deltas.items() if v}
+    if not deltas:
+        return
+    institution_id, class_id, form_type, impairment, gender, day = bucket
+    values = dict(
+        institution_id=institution_id,
+        class_id=class_id,
+        form_type=form_type,
+        impairment=impairment or "",
+        gender=gender or "",
+        day=day,
+        **{col: deltas.get(col, 0) for col in COUNTER_COLUMNS},
+    )
+    table = StatsRollup.__table__
+    stmt = dialect_insert(db, table).values(**values)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=["institution_id", "class_id", "form_type", "impairment", "gender", "day"],
+        set_={col: table.c[col] + stmt.excluded[col] for col in deltas},
+    )
+    db.execute(stmt)
+
+
+def record_keys_generated(db: Session, cls: Class, form_type: str, count: int, when: Optional[datetime] = None) -> None:
+    day = (when or datetime.utcnow()).date()
+    bump(db, (cls.institution_id, cls.id, form_type, "", "", day), keys_total=count)
+
+
+def session_bucket(cls: Class, session: TestSession, finished_at: datetime) -> Bucket:
+    return (
+        cls.institution_id, cls.id, session.form_type,
+        session.diagnosis or "", session.gender or "", finished_at.date(),
+    )
+
+
+def session_deltas(irp_interval: Optional[str], kveripo_interval: Optional[str], sign: int = 1) -> Dict[str, int]:
+    deltas = {"completed": sign}
+    if irp_interval in IRP_COLUMNS:
+        deltas[IRP_COLUMNS[irp_interval]] = sign
+    if kveripo_interval in KVERIPO_COLUMNS:
+        deltas[KVERIPO_COLUMNS[kveripo_interval]] = sign
+    return deltas
+
+
+def record_finished(db: Session, bucket: Bucket, irp_interval: Optional[str], kveripo_interval: Optional[str]) -> None:
+    """Учитывает впервые завершённую сессию по уже известной корзине (без ORM-объектов)."""
+    bump(db, bucket, **session_deltas(irp_interval, kveripo_interval))
+
+
+def record_session_finished(
+    db: Session,
+    cls: Class,
+    session: TestSession,
+    previous: Optional[Tuple[Optional[datetime], Optional[str], Optional[str]]] = None,
+) -> None:
+    """
+    Учитывает завершённую сессию. previous — (finished_at, irp_interval,
+    kveripo_interval) до пересчёта: при повторной отправке старый вклад вычитается.
+    """
+    if previous and previous[0] is not None:
+        old_finished, old_irp, old_kveripo = previous
+        bump(db, session_bucket(cls, session, old_finished), **session_deltas(old_irp, old_kveripo, -1))
+    bump(
+        db,
+        session_bucket(cls, session, session.finished_at),
+        **session_deltas(session.irp_interval, session.kveripo_interval),
+    )
+
+
+# --------------------- Пересборка и сверка ---------------------
+
+def _level_sum(column, level: str):
+    return func.sum(case((column == level, 1), else_=0))
+
+
+def expected_rollups(db: Session, institution_id: Optional[str] = None) -> Dict[Bucket, Dict[str, int]]:
+    """Агрегаты, посчитанные заново по keys и test_sessions (два GROUP BY)."""
+    expected: Dict[Bucket, Dict[str, int]] = {}
+
+    def _slot(bucket: Bucket) -> Dict[str, int]:
+        return expected.setdefault(bucket, {col: 0 for col in COUNTER_COLUMNS})
+
+    key_day = func.date(Key.created_at, type_=Date)
+    keys_q = (
+        select(Class.institution_id, Key.class_id, Key.form_type, key_day, func.count(Key.id))
+        .join(Class, Class.id == Key.class_id)
+        .where(Class.institution_id.isnot(None), Key.created_at.isnot(None))
+        .group_by(Class.institution_id, Key.class_id, Key.form_type, key_day)
+    )
+    if institution_id is not None:
+        keys_q = keys_q.where(Class.institution_id == institution_id)
+    for inst, class_id, form, day, cnt in db.execute(keys_q):
+        _slot((inst, class_id, form, "", "", day))["keys_total"] += int(cnt)
+
+    impairment = func.coalesce(TestSession.diagnosis, "")
+    gender = func.coalesce(TestSession.gender, "")
+    finished_day = func.date(TestSession.finished_at, type_=Date)
+    sessions_q = (
+        select(
+            Class.institution_id, Key.class_id, TestSession.form_type, impairment, gender, finished_day,
+            func.count(TestSession.id),
+            *(_level_sum(TestSession.irp_interval, lvl) for lvl in IRP_COLUMNS),
+            *(_level_sum(TestSession.kveripo_interval, lvl) for lvl in KVERIPO_COLUMNS),
+        )
+        .join(Key, Key.id == TestSession.key_id)
+        .join(Class, Class.id == Key.class_id)
+        .where(TestSession.finished_at.isnot(None), Class.institution_id.isnot(None))
+        .group_by(Class.institution_id, Key.class_id, TestSession.form_type, impairment, gender, finished_day)
+    )
+    if institution_id is not None:
+        sessions_q = sessions_q.where(Class.institution_id == institution_id)
+    level_cols = list(IRP_COLUMNS.values()) + list(KVERIPO_COLUMNS.values())
+    for inst, class_id, form, imp, gen, day, cnt, *levels in db.execute(sessions_q):
+        slot = _slot((inst, class_id, form, imp, gen, day))
+        slot["completed"] += int(cnt)
+        for col, value in zip(level_cols, levels):
+            slot[col] += int(value or 0)
+    return expected
+
+
+def stored_rollups(db: Session, institution_id: Optional[str] = None) -> Dict[Bucket, Dict[str, int]]:
+    q = select(StatsRollup)
+    if institution_id is not None:
+        q = q.where(StatsRollup.institution_id == institution_id)
+    return {
+        (r.institution_id, r.class_id, r.form_type, r.impairment, r.gender, r.day):
+            {col: getattr(r, col) for col in COUNTER_COLUMNS}
+        for r in db.scalars(q)
+    }
+
+
+def reconcile(
+    db: Session,
+    institution_id: Optional[str] = None,
+    fix: bool = False,
+    report: Callable[[str], None] = print,
+) -> List[Dict[str, Any]]:
+    """
+    Сравнивает stats_rollup с пересчётом по исходным таблицам.
+    Возвращает список расхождений; fix=True — заменяет агрегаты пересчитанными.
+    """
+    expected = expected_rollups(db, institution_id)
+    stored = stored_rollups(db, institution_id)
+    empty = {col: 0 for col in COUNTER_COLUMNS}
+
+    drift: List[Dict[str, Any]] = []
+    for bucket in sorted(set(expected) | set(stored), key=str):
+        want = expected.get(bucket, empty)
+        have = stored.get(bucket, empty)
+        if want != have:
+            drift.append({
+                "bucket": bucket,
+                "diff": {col: have[col] - want[col] for col in COUNTER_COLUMNS if have[col] != want[col]},
+            })
+
+    for item in drift:
+        report(f"    ~ {item['bucket']}: {item['diff']}")
+    report(f"[*] Корзин: {len(expected)}, расхождений: {len(drift)}")
+
+    if fix and drift:
+        q = delete(StatsRollup)
+        if institution_id is not None:
+            q = q.where(StatsRollup.institution_id == institution_id)
+        db.execute(q)
+        rows = [
+            dict(
+                institution_id=b[0], class_id=b[1], form_type=b[2],
+                impairment=b[3], gender=b[4], day=b[5], **counters,
+            )
+            for b, counters in expected.items()
+        ]
+        if rows:
+            db.execute(StatsRollup.__table__.insert(), rows)
+        db.commit()
+        report(f"[+] Агрегаты пересобраны: {len(rows)} корзин")
+    return drift
+
+
+def ensure_rollups(db: Session, stale: bool = False, report: Callable[[str], None] = print) -> bool:
+    """
+    Пересобирает агрегаты при старте, если stats_rollup пуста, а ключи или
+    завершённые сессии уже есть (установка, обновлённая с версии без агрегатов).
+    Иначе /stats/summary показывал бы нули до ручного --fix. stale=True —
+    пересобрать и непустые (например, ключам только что проставили created_at).
+    """
+    has_rollups = db.scalar(select(StatsRollup.institution_id).limit(1)) is not None
+    has_data = (
+        db.scalar(select(Key.id).limit(1)) is not None
+        or db.scalar(select(TestSession.id).where(TestSession.finished_at.isnot(None)).limit(1)) is not None
+    )
+    db.rollback()
+    if not has_data or (has_rollups and not stale):
+        return False
+    reconcile(db, fix=True, report=report)
+    return True
+
+
+if __name__ == "__main__":
+    from SPTOVZ.database import WriteSessionLocal
+
+    parser = argparse.ArgumentParser(description="Сверка и пересборка stats_rollup")
+    parser.add_argument("--institution", default=None)
+    parser.add_argument("--fix", action="store_true", help="пересобрать агрегаты при расхождениях")
+    args = parser.parse_args()
+
+    with WriteSessionLocal() as db:
+        reconcile(db, institution_id=args.institution, fix=args.fix)
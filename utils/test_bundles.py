@@ -0,0 +1,134 @@
+"""
+Неизменяемые пакеты вопросов теста: /tests/{code}/v{version}-{digest}.
+
+Содержимое теста одинаково для всех, кто получил один паспорт, поэтому
+JSON собирается один раз и держится в памяти вместе с заранее сжатыми
+gzip/brotli-версиями. start-test отдаёт только ссылку на пакет, а сам
+пакет кэшируется браузером/прокси (ETag + Cache-Control: immutable).
+digest — хэш содержимого (тот же, что в ETag), поэтому URL меняется при
+любой правке вопросов, даже если версию в файле забыли поднять: закэшированное
+под старым URL тело никогда не выдаётся за новое.
+"""
+from __future__ import annotations
+import gzip
+import hashlib
+import json
+import threading
+from dataclasses import dataclass
+from typing import Dict, Optional, Tuple
+
+from sqlalchemy.orm import Session
+
+from SPTOVZ.utils.test_catalog import CatalogEntry, catalog_index, on_catalog_swap
+
+try:  # brotli необязателен: без него отдаём gzip
+    import brotli
+except ImportError:  # pragma: no cover
+    brotli = None
+
+CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+
+@dataclass(frozen=True)
+class TestBundle:
+    code: str
+    version: int
+    etag: str                 # сильный ETag несжатого тела, в кавычках
+    body: bytes
+    gzip_body: bytes
+    br_body: Optional[bytes]
+
+    @property
+    def digest(self) -> str:
+        return self.etag.strip('"')
+
+    @property
+    def url(self) -> str:
+        return bundle_url(self.code, self.version, self.digest)
+
+    def encoded(self, accept_encoding: str) -> Tuple[bytes, Optional[str], str]:
+        """(тело, Content-Encoding, ETag) под заголовок Accept-Encoding клиента."""
+        accepted = {part.split(";")[0].strip().lower() for part in (accept_encoding or "").split(",")}
+        if self.br_body is not None and "br" in accepted:
+            return self.br_body, "br", self._variant_etag("br")
+        if "gzip" in accepted:
+            return self.gzip_body, "gzip", self._variant_etag("gz")
+        return self.body, None, self.etag
+
+    def _variant_etag(self, suffix: str) -> str:
+        # у каждого представления свой сильный ETag
+        return f'{self.etag[:-1]}-{suffix}"'
+
+    def matches(self, if_none_match: str) -> bool:
+        if not if_none_match:
+            return False
+        if if_none_match.strip() == "*":
+            return True
+        tags = {t.strip().removeprefix("W/") for t in if_none_match.split(",")}
+        return bool(tags & {self.etag, self._variant_etag("gz"), self._variant_etag("br")})
+
+
+_bundles: Dict[Tuple[str, int], TestBundle] = {}
+_lock = threading.Lock()
+
+
+def bundle_url(code: str, version: int, digest: str) -> str:
+    return f"/tests/{code}/v{version}-{digest}"
+
+
+def _build_bundle(entry: CatalogEntry) -> TestBundle:
+    payload = {
+        "code": entry.code,
+        "version": entry.version,
+        "title": entry.title,
+        "form": entry.form,
+        "locale": entry.locale,
+        "questions": entry.questions,
+    }
+    body = json.dumps(payload, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+    return TestBundle(
+        code=entry.code,
+        version=entry.version,
+        etag=f'"{hashlib.sha256(body).hexdigest()[:32]}"',
+        body=body,
+        gzip_body=gzip.compress(body, compresslevel=9, mtime=0),
+        br_body=brotli.compress(body, quality=11) if brotli is not None else None,
+    )
+
+
+def bundle_for(entry: CatalogEntry) -> TestBundle:
+    """Пакет для записи каталога (сборка и сжатие — только при первом обращении)."""
+    key = (entry.code, entry.version)
+    bundle = _bundles.get(key)
+    if bundle is None:
+        with _lock:
+            bundle = _bundles.get(key)
+            if bundle is None:
+                bundle = _bundles[key] = _build_bundle(entry)
+    return bundle
+
+
+def get_bundle(db: Session, code: str, version: int, digest: str) -> Optional[TestBundle]:
+    """
+    Пакет по адресу; None, если такой версии нет или её содержимое уже другое.
+    Несовпадение с пакетом в памяти сначала сверяется с каталогом (catalog_index,
+    не чаще CATALOG_CHECK_INTERVAL_S): ссылку мог выдать другой воркер, уже
+    перечитавший каталог после импорта.
+    """
+    bundle = _bundles.get((code, version))
+    if bundle is not None and bundle.digest == digest:
+        return bundle
+    entry = catalog_index(db).by_code.get(code)
+    if entry is None or entry.version != version:
+        return None
+    bundle = bundle_for(entry)
+    return bundle if bundle.digest == digest else None
+
+
+def clear_bundles(_index=None) -> None:
+    """Сбрасывает пакеты в памяти (при подмене индекса каталога)."""
+    with _lock:
+        _bundles.clear()
+
+
+on_catalog_swap(clear_bundles)
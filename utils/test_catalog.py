@@ -0,0 +1,165 @@
+"""
+Индекс каталога тестов в памяти процесса.
+
+Каталог меняется только при импорте (test_loader.import_all), поэтому
+паспорта и содержимое читаются из БД один раз и раскладываются по словарям:
+(institution, impairment) → лучшая версия, code → запись. Выбор теста на
+start-test — поиск в словаре без запросов к БД.
+
+Новый индекс собирается целиком и подменяет старый одним присваиванием.
+Импорт увеличивает catalog_state.version; остальные процессы сверяют
+её не чаще раза в CATALOG_CHECK_INTERVAL_S секунд и пересобирают индекс,
+если номер отличается.
+"""
+from __future__ import annotations
+import os
+import threading
+import time
+from dataclasses import dataclass, field
+from datetime import datetime
+from typing import Any, Callable, Dict, FrozenSet, List, Optional, Tuple
+
+from sqlalchemy import select
+from sqlalchemy.orm import Session
+
+from SPTOVZ.database import dialect_insert
+from SPTOVZ.models.testbank import CatalogState, TestContent, TestPassport
+
+CATALOG_CHECK_INTERVAL_S = float(os.getenv("CATALOG_CHECK_INTERVAL_S") or 5)
+
+
+@dataclass(frozen=True)
+class CatalogEntry:
+    code: str
+    institution: str
+    impairment: str
+    version: int
+    title: str
+    form: str
+    locale: str
+    gender: str
+    questions: List[Dict[str, Any]]
+    scoring: Dict[str, Any]
+    question_ids: FrozenSet[int]
+
+
+@dataclass(frozen=True)
+class CatalogIndex:
+    version: int
+    by_pair: Dict[Tuple[str, str], CatalogEntry] = field(default_factory=dict)
+    by_code: Dict[str, CatalogEntry] = field(default_factory=dict)
+    built_at: float = field(default_factory=time.time)
+
+
+_index: Optional[CatalogIndex] = None
+_checked_at = 0.0
+_lock = threading.Lock()
+_listeners: List[Callable[[CatalogIndex], None]] = []
+
+
+def _question_ids(questions: List[Dict[str, Any]]) -> FrozenSet[int]:
+    ids = set()
+    for q in questions or []:
+        try:
+            ids.add(int(q["id"]))
+        except (KeyError, TypeError, ValueError):
+            continue
+    return frozenset(ids)
+
+
+def stored_catalog_version(db: Session) -> int:
+    return db.scalar(select(CatalogState.version).where(CatalogState.id == 1)) or 0
+
+
+def build_catalog_index(db: Session) -> CatalogIndex:
+    """Читает все паспорта с содержимым (один JOIN) и раскладывает по словарям."""
+    version = stored_catalog_version(db)
+    rows = db.execute(
+        select(TestPassport, TestContent).join(TestContent, TestContent.id == TestPassport.id)
+    ).all()
+
+    by_code: Dict[str, CatalogEntry] = {}
+    for passport, content in rows:
+        by_code[passport.id] = CatalogEntry(
+            code=passport.id,
+            institution=passport.institution,
+            impairment=passport.impairment,
+            version=passport.version,
+            title=passport.title,
+            form=passport.form,
+            locale=passport.locale,
+            gender=(passport.gender or "").lower(),
+            questions=content.questions,
+            scoring=content.scoring or {},
+            question_ids=_question_ids(content.questions),
+        )
+
+    # Правила выбора те же, что у select_test: максимальная version,
+    # при равных — запись с gender == "any"
+    by_pair: Dict[Tuple[str, str], CatalogEntry] = {}
+    for entry in sorted(by_code.values(), key=lambda e: (e.version, e.gender == "any")):
+        by_pair[(entry.institution, entry.impairment)] = entry
+    return CatalogIndex(version=version, by_pair=by_pair, by_code=by_code)
+
+
+def on_catalog_swap(callback: Callable[[CatalogIndex], None]) -> None:
+    """Подписка на подмену индекса (например, сброс кэшей, завязанных на каталог)."""
+    _listeners.append(callback)
+
+
+def _swap(index: CatalogIndex) -> CatalogIndex:
+    global _index, _checked_at
+    _index = index
+    _checked_at = time.monotonic()
+    for callback in _listeners:
+        callback(index)
+    return index
+
+
+def load_catalog_index(db: Session) -> CatalogIndex:
+    """Собирает индекс заново и подменяет текущий (старт приложения, после импорта)."""
+    with _lock:
+        return _swap(build_catalog_index(db))
+
+
+def current_catalog_index() -> Optional[CatalogIndex]:
+    """Индекс как есть, без сверки версии (для метрик)."""
+    return _index
+
+
+def catalog_index(db: Session) -> CatalogIndex:
+    """
+    Текущий индекс. Номер версии в БД проверяется не чаще раза
+    в CATALOG_CHECK_INTERVAL_S; в остальное время запросов нет.
+
+    Пока версию сверяет другой вызов, остальные не ждут его, а берут
+    текущий индекс: в async-режиме сверка идёт в run_sync на потоке
+    event loop, и ожидание блокировки остановило бы весь цикл.
+    """
+    global _checked_at
+    index = _index
+    if index is not None and time.monotonic() - _checked_at < CATALOG_CHECK_INTERVAL_S:
+        return index
+    if not _lock.acquire(blocking=index is None):
+        return index
+    try:
+        if _index is not None and time.monotonic() - _checked_at < CATALOG_CHECK_INTERVAL_S:
+            return _index
+        if _index is not None and stored_catalog_version(db) == _index.version:
+            _checked_at = time.monotonic()
+            return _index
+        return _swap(build_catalog_index(db))
+    finally:
+        _lock.release()
+
+
+def bump_catalog_version(db: Session) -> int:
+    """Увеличивает catalog_state.version (в транзакции вызывающего). Возвращает новый номер."""
+    table = CatalogState.__table__
+    stmt = dialect_insert(db, table).values(id=1, version=1, updated_at=datetime.utcnow())
+    stmt = stmt.on_conflict_do_update(
+        index_elements=["id"],
+        set_={"version": table.c.version + 1, "updated_at": stmt.excluded.updated_at},
+    )
+    db.execute(stmt)
+    return stored_catalog_version(db)
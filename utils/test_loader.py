@@ -1,27 +1,61 @@
+"""
+Импорт каталога тестов (tests_catalog/**/v*.yaml) в test_passports / test_contents.
+
+Импорт инкрементальный: у каждого паспорта хранится sha256 исходного файла,
+файлы с уже известным хэшем не разбираются. Новые и изменённые файлы
+разбираются параллельно (пул процессов, libyaml CSafeLoader, если доступен),
+а все upsert'ы применяются одной транзакцией INSERT ... ON CONFLICT.
+
+    python -m SPTOVZ.utils.test_loader                # импорт изменённых файлов
+    python -m SPTOVZ.utils.test_loader --force        # переимпорт всего каталога
+"""
 from __future__ import annotations
+import argparse
+import hashlib
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
-from typing import List, Dict, Any, Tuple
+from typing import List, Dict, Any, Optional, Tuple
 import yaml
+from sqlalchemy import select
 from sqlalchemy.orm import Session
+from SPTOVZ.database import dialect_insert
 from SPTOVZ.models.testbank import TestPassport, TestContent
+from SPTOVZ.utils.jobs import JobContext, job_handler
+from SPTOVZ.utils.metrics import timed
+from SPTOVZ.utils.snapshot import read_snapshot
+from SPTOVZ.utils.test_catalog import bump_catalog_version, load_catalog_index
 
 CATALOG_ROOT = Path(__file__).resolve().parents[1] / "tests_catalog"
 
 ALLOWED_INSTITUTIONS = {"school", "college", "university"}
 ALLOWED_IMPAIRMENTS = {"hearing", "vision", "motor"}
 
+# libyaml-загрузчик в разы быстрее чисто питоновского SafeLoader
+YAML_LOADER = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+
+# Меньше файлов разбираем в текущем процессе: запуск пула дороже разбора
+# (spawn-процесс ~1 с на импорт пакета против ~7 мс на разбор одного файла)
+PARALLEL_MIN_FILES = 200
+
 class CatalogError(Exception):
     pass
 
-def _load_yaml(path: Path) -> Dict[str, Any]:
+def _load_yaml(path: Path, data: Optional[bytes] = None) -> Dict[str, Any]:
     try:
-        with path.open("r", encoding="utf-8") as f:
-            data = yaml.safe_load(f) or {}
+        if data is None:
+            data = path.read_bytes()
+        loaded = yaml.load(data, Loader=YAML_LOADER) or {}
     except Exception as e:
         raise CatalogError(f"Ошибка чтения YAML {path}: {e}") from e
-    if not isinstance(data, dict):
+    if not isinstance(loaded, dict):
         raise CatalogError(f"Формат YAML должен быть mapping: {path}")
-    return data
+    return loaded
+
+def content_hash(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
 
 def discover_tests(root: Path | None = None) -> List[Path]:
     root = Path(root) if root else CATALOG_ROOT
@@ -58,64 +92,187 @@ def _validate_meta(meta: Dict[str, Any], path: Path) -> Tuple[str, str, str, int
 
     return institution, impairment, code, version, form
 
-def import_test_file(db: Session, path: Path) -> str:
-    data = _load_yaml(path)
-    meta = data.get("meta") or {}
-    questions = data.get("questions")
+def parse_test_file(path: Path, data: Optional[bytes] = None) -> Dict[str, Any]:
+    """
+    Разбирает и проверяет файл теста. Возвращает запись для upsert:
+    {"passport": {...}, "content": {...}}. Выполняется и в процессах пула.
+    """
+    path = Path(path)
+    if data is None:
+        data = path.read_bytes()
+    loaded = _load_yaml(path, data)
+    meta = loaded.get("meta") or {}
+    questions = loaded.get("questions")
     if questions is None or not isinstance(questions, list):
         raise CatalogError(f"{path}: отсутствует корректный раздел 'questions'")
 
     institution, impairment, code, version, form = _validate_meta(meta, path)
-    title = str(meta.get("title") or code)
-    locale = str(meta.get("locale") or "ru")
-    scoring = meta.get("scoring") or {}
-
-    # upsert
-    for model, pk in ((TestPassport, code), (TestContent, code)):
-        existed = db.get(model, pk)
-        if existed:
-            db.delete(existed)
-    db.flush()
-
-    passport = TestPassport(
-        id=code,
-        institution=institution,
-        impairment=impairment,
-        gender="any",          # <- фиксированное значение, больше не используем при выборе
-        version=version,
-        title=title,
-        locale=locale,
-        form=form,
-    )
-    content = TestContent(
-        id=code,
-        questions=questions,
-        scoring=scoring,
+    return {
+        "passport": {
+            "id": code,
+            "institution": institution,
+            "impairment": impairment,
+            "gender": "any",          # <- фиксированное значение, больше не используем при выборе
+            "version": version,
+            "title": str(meta.get("title") or code),
+            "locale": str(meta.get("locale") or "ru"),
+            "form": form,
+            "content_hash": content_hash(data),
+        },
+        "content": {
+            "id": code,
+            "questions": questions,
+            "scoring": meta.get("scoring") or {},
+        },
+    }
+
+def _parse_job(job: Tuple[str, bytes]) -> Tuple[str, Optional[Dict[str, Any]], Optional[str]]:
+    path, data = job
+    try:
+        return path, parse_test_file(Path(path), data), None
+    except Exception as e:
+        return path, None, str(e)
+
+def _upsert(db: Session, model, rows: List[Dict[str, Any]]) -> None:
+    if not rows:
+        return
+    table = model.__table__
+    stmt = dialect_insert(db, table)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=["id"],
+        set_={col: stmt.excluded[col] for col in rows[0] if col != "id"},
     )
+    db.execute(stmt, rows)
+
+def apply_records(db: Session, records: List[Dict[str, Any]]) -> None:
+    """Upsert паспортов и содержимого. Не коммитит: фиксация — на вызывающей стороне."""
+    _upsert(db, TestPassport, [r["passport"] for r in records])
+    _upsert(db, TestContent, [r["content"] for r in records])
 
-    db.add(passport)
-    db.add(content)
+def import_test_file(db: Session, path: Path) -> str:
+    record = parse_test_file(path)
+    apply_records(db, [record])
+    bump_catalog_version(db)
     db.commit()
-    return code
+    load_catalog_index(db)
+    return record["passport"]["id"]
+
+def _ms(started: float) -> float:
+    return round((time.perf_counter() - started) * 1000, 2)
 
-def import_all(db: Session, root: Path | None = None, stop_on_error: bool = False) -> Dict[str, Any]:
+@timed("import_all")
+def import_all(
+    db: Session,
+    root: Path | None = None,
+    stop_on_error: bool = False,
+    workers: int | None = None,
+    force: bool = False,
+) -> Dict[str, Any]:
+    """
+    Импортирует новые и изменённые файлы каталога. force=True — все файлы.
+    workers — процессов для разбора (по умолчанию по числу CPU, 1 — без пула).
+    """
     root = Path(root) if root else CATALOG_ROOT
+    timings: Dict[str, float] = {}
+    total_started = time.perf_counter()
+
+    started = time.perf_counter()
     files = discover_tests(root)
-    imported: List[str] = []
-    errors: Dict[str, str] = {}
+    timings["discover_ms"] = _ms(started)
+
+    # --- хэши: неизменённые файлы даже не разбираем ---
+    started = time.perf_counter()
+    known = set() if force else set(db.scalars(select(TestPassport.content_hash).where(TestPassport.content_hash.isnot(None))))
+    jobs: List[Tuple[str, bytes]] = []
+    skipped: List[str] = []
     for p in files:
-        try:
-            imported.append(import_test_file(db, p))
-        except Exception as e:
-            errors[str(p)] = str(e)
+        data = p.read_bytes()
+        if content_hash(data) in known:
+            skipped.append(str(p))
+        else:
+            jobs.append((str(p), data))
+    timings["hash_ms"] = _ms(started)
+
+    # --- разбор: что есть в бинарном снимке, берём оттуда ---
+    started = time.perf_counter()
+    snapshot = read_snapshot()
+    prebuilt = snapshot["catalog"] if snapshot else {}
+    parsed = []
+    pending: List[Tuple[str, bytes]] = []
+    for path, data in jobs:
+        record = prebuilt.get(content_hash(data))
+        if record is not None:
+            parsed.append((path, record, None))
+        else:
+            pending.append((path, data))
+    snapshot_hits = len(parsed)
+    jobs = pending
+    workers = workers if workers is not None else (os.cpu_count() or 1)
+    if workers > 1 and len(jobs) >= PARALLEL_MIN_FILES:
+        # spawn: импорт идёт и задачей catalog_import в многопоточном воркере — fork
+        # скопировал бы в дочерние процессы занятые блокировки и соединения с БД
+        spawn = multiprocessing.get_context("spawn")
+        with ProcessPoolExecutor(max_workers=min(workers, len(jobs)), mp_context=spawn) as pool:
+            parsed.extend(pool.map(_parse_job, jobs))
+    else:
+        parsed.extend(_parse_job(job) for job in jobs)
+    timings["parse_ms"] = _ms(started)
+
+    records: List[Dict[str, Any]] = []
+    errors: Dict[str, str] = {}
+    for path, record, error in parsed:
+        if error is not None:
+            errors[path] = error
             if stop_on_error:
-                raise
-    return {"imported": imported, "errors": errors, "root": str(root), "count": len(imported)}
+                raise CatalogError(error)
+        else:
+            records.append(record)
+
+    # --- запись: одна транзакция на весь импорт ---
+    started = time.perf_counter()
+    if records:
+        apply_records(db, records)
+        # другие процессы увидят новый номер и пересоберут свой индекс
+        bump_catalog_version(db)
+        db.commit()
+    timings["apply_ms"] = _ms(started)
+
+    started = time.perf_counter()
+    load_catalog_index(db)
+    timings["index_ms"] = _ms(started)
+    timings["total_ms"] = _ms(total_started)
+
+    imported = [r["passport"]["id"] for r in records]
+    return {
+        "imported": imported,
+        "skipped": len(skipped),
+        "from_snapshot": snapshot_hits,
+        "errors": errors,
+        "root": str(root),
+        "count": len(imported),
+        "timings": timings,
+    }
+
+@job_handler("catalog_import")
+def catalog_import_job(ctx: JobContext, force: bool = False, workers: int | None = None) -> Dict[str, Any]:
+    """Задача catalog_import: импорт в одной транзакции, повтор безопасен."""
+    from SPTOVZ.database import WriteSessionLocal
+
+    with WriteSessionLocal() as db:
+        return import_all(db, workers=workers, force=force)
+
 
 if __name__ == "__main__":
-    from SPTOVZ.database import SessionLocal
-    db = SessionLocal()
+    from SPTOVZ.database import WriteSessionLocal
+
+    parser = argparse.ArgumentParser(description="Импорт каталога тестов")
+    parser.add_argument("--root", type=Path, default=None)
+    parser.add_argument("--workers", type=int, default=None, help="процессов для разбора YAML")
+    parser.add_argument("--force", action="store_true", help="импортировать и неизменённые файлы")
+    args = parser.parse_args()
+
+    db = WriteSessionLocal()
     try:
-        print(import_all(db))
+        print(import_all(db, root=args.root, workers=args.workers, force=args.force))
     finally:
         db.close()
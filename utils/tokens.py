@@ -0,0 +1,167 @@
+"""
+Подписанные токены доступа (JWT, HS256) без обращения к БД при проверке.
+
+В токене — id пользователя, учреждение, тип образования, email и срок
+действия; get_current_user собирает Principal прямо из него.
+
+Ключи подписи — AUTH_SIGNING_KEYS="kid1:secret1,kid2:secret2": первым
+подписываются новые токены, проверяются все (ротация: новый ключ ставится
+первым, старый удаляется после истечения AUTH_TOKEN_TTL_S). Без переменной
+используется AUTH_SECRET, а если нет и его — секрет из файла .auth_secret
+рядом с пакетом (создаётся при первом запуске, общий для воркеров хоста).
+
+Отзыв (logout) — список jti в памяти процесса до истечения токена;
+общий для воркеров список хранится в таблице revoked_tokens и
+подтягивается в память периодически (utils/auth.sync_revocations).
+"""
+from __future__ import annotations
+import base64
+import hashlib
+import hmac
+import json
+import os
+import secrets
+import threading
+import time
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+from uuid import uuid4
+
+BASE_DIR = Path(__file__).resolve().parent.parent
+TOKEN_TTL_S = int(os.getenv("AUTH_TOKEN_TTL_S") or 12 * 3600)
+# Допуск расхождения часов между воркерами при проверке exp/iat
+LEEWAY_S = 30
+
+
+class TokenError(Exception):
+    pass
+
+
+# --------------------- Ключи ---------------------
+
+def _file_secret() -> str:
+    path = BASE_DIR / ".auth_secret"
+    try:
+        return path.read_text(encoding="utf-8").strip()
+    except FileNotFoundError:
+        pass
+    secret = secrets.token_urlsafe(48)
+    try:
+        # O_EXCL: при одновременном старте воркеров побеждает один файл
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            f.write(secret)
+        return secret
+    except FileExistsError:
+        return path.read_text(encoding="utf-8").strip()
+
+
+def load_signing_keys() -> List[Tuple[str, bytes]]:
+    """[(kid, secret)], первый — активный ключ подписи."""
+    raw = os.getenv("AUTH_SIGNING_KEYS")
+    if raw and raw.strip():
+        keys = []
+        for item in raw.split(","):
+            kid, sep, secret = item.strip().partition(":")
+            if not sep or not kid or not secret:
+                raise ValueError("AUTH_SIGNING_KEYS: ожидается kid:secret[,kid:secret...]")
+            keys.append((kid, secret.encode()))
+        return keys
+    secret = os.getenv("AUTH_SECRET") or _file_secret()
+    return [("default", secret.encode())]
+
+
+_keys = load_signing_keys()
+
+
+# --------------------- Кодирование ---------------------
+
+def _b64(data: bytes) -> str:
+    return base64.urlsafe_b64encode(data).rstrip(b"=").decode("ascii")
+
+
+def _unb64(data: str) -> bytes:
+    return base64.urlsafe_b64decode(data + "=" * (-len(data) % 4))
+
+
+def _sign(signing_input: bytes, secret: bytes) -> bytes:
+    return hmac.new(secret, signing_input, hashlib.sha256).digest()
+
+
+def issue_token(claims: Dict[str, Any], ttl_s: int = TOKEN_TTL_S) -> Tuple[str, Dict[str, Any]]:
+    """Подписывает claims активным ключом. Возвращает (токен, итоговые claims)."""
+    kid, secret = _keys[0]
+    now = int(time.time())
+    payload = {**claims, "iat": now, "exp": now + ttl_s, "jti": uuid4().hex}
+    header = {"alg": "HS256", "typ": "JWT", "kid": kid}
+    signing_input = (
+        _b64(json.dumps(header, separators=(",", ":")).encode())
+        + "."
+        + _b64(json.dumps(payload, separators=(",", ":"), ensure_ascii=False).encode())
+    ).encode("ascii")
+    return f"{signing_input.decode('ascii')}.{_b64(_sign(signing_input, secret))}", payload
+
+
+def decode_token(token: str) -> Dict[str, Any]:
+    """Проверяет подпись, срок и отзыв. Возвращает claims или бросает TokenError."""
+    try:
+        header_b64, payload_b64, signature_b64 = token.split(".")
+        header = json.loads(_unb64(header_b64))
+        signature = _unb64(signature_b64)
+    except (ValueError, TypeError) as e:
+        raise TokenError("malformed token") from e
+    if not isinstance(header, dict):  # валидный JSON, но не объект: [], 1, null
+        raise TokenError("malformed token")
+    if header.get("alg") != "HS256":
+        raise TokenError("unsupported alg")
+
+    signing_input = f"{header_b64}.{payload_b64}".encode("ascii")
+    candidates = [secret for kid, secret in _keys if kid == header.get("kid")]
+    if not any(hmac.compare_digest(_sign(signing_input, secret), signature) for secret in candidates):
+        raise TokenError("bad signature")
+
+    try:
+        payload = json.loads(_unb64(payload_b64))
+    except ValueError as e:
+        raise TokenError("malformed payload") from e
+    if not isinstance(payload, dict) or not isinstance(payload.get("iat", 0), (int, float)):
+        raise TokenError("malformed payload")
+    now = time.time()
+    if not isinstance(payload.get("exp"), (int, float)) or payload["exp"] + LEEWAY_S < now:
+        raise TokenError("expired")
+    if payload.get("iat", 0) - LEEWAY_S > now:
+        raise TokenError("issued in the future")
+    if revocations.is_revoked(payload.get("jti")):
+        raise TokenError("revoked")
+    return payload
+
+
+# --------------------- Отзыв ---------------------
+
+class RevocationList:
+    """jti отозванных токенов до истечения их срока (в памяти процесса)."""
+
+    def __init__(self) -> None:
+        self._items: Dict[str, float] = {}
+        self._lock = threading.Lock()
+
+    def revoke(self, jti: Optional[str], exp: float) -> None:
+        if not jti:
+            return
+        with self._lock:
+            self._items[jti] = exp
+            self._purge()
+
+    def is_revoked(self, jti: Optional[str]) -> bool:
+        return bool(jti) and jti in self._items
+
+    def _purge(self) -> None:
+        now = time.time() - LEEWAY_S
+        for jti in [j for j, exp in self._items.items() if exp < now]:
+            del self._items[jti]
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+
+revocations = RevocationList()